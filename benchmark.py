@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Benchmark harmonise.py on synthetic input.
+
+Generate format-valid OGER/BioBERT files of configurable size,
+time harmonise() for each merge strategy and engine, and report
+throughput, peak memory and time per stage.
+Runs offline; each measurement runs in a fresh process.
+"""
+
+
+import csv
+import sys
+import json
+import random
+import filecmp
+import argparse
+import resource
+import tempfile
+import itertools as it
+import multiprocessing as mp
+from pathlib import Path
+from array import array
+from typing import Dict
+
+import numpy as np
+
+import harmonise
+
+
+WORDS = '''
+the of and in to a with for was were by is that from as on at are be this
+patients infection virus cells protein expression receptor binding cytokine
+SARS CoV 2 COVID 19 coronavirus ACE2 spike antibody antibodies respiratory
+pneumonia lung epithelial immune response replication RNA genome sequence
+clinical symptoms treatment hydroxychloroquine remdesivir interleukin
+mitochondrial transcription inflammation ( ) + , . ; : % - / = < >
+'''.split()
+CONCEPTS = 500  # roughly the size of an ID model's tag set
+SPAN_TAGS = 'BIOOOOOOES'
+
+
+def main():
+    '''
+    Run as script.
+    '''
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(
+        '-d', '--directory', type=Path, metavar='PATH',
+        help='directory for the synthetic input and the output '
+             '(default: a temporary directory)')
+    ap.add_argument(
+        '-n', '--docs', type=int, default=1000, metavar='N',
+        help='number of synthetic documents (default: %(default)s)')
+    ap.add_argument(
+        '--seed', type=int, default=0,
+        help='random seed for the corpus generator (default: %(default)s)')
+    ap.add_argument(
+        '-m', '--merge-strategies', nargs='+', metavar='STRATEGY',
+        default=harmonise.STRATEGIES, choices=harmonise.STRATEGIES,
+        help='strategies to benchmark (default: all)')
+    ap.add_argument(
+        '-e', '--engines', nargs='+', metavar='ENGINE',
+        default=harmonise.ENGINES, choices=harmonise.ENGINES,
+        help='merge implementations to benchmark (default: all)')
+    ap.add_argument(
+        '-b', '--binary', action='store_true',
+        help='use binary (.npy) instead of text labels')
+    ap.add_argument(
+        '-j', '--json', dest='json_path', type=Path, metavar='PATH',
+        help='write the results to a JSON file')
+    args = ap.parse_args()
+    if args.directory is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            args.directory = Path(tmp)
+            ok = benchmark(**vars(args))
+    else:
+        args.directory.mkdir(parents=True, exist_ok=True)
+        ok = benchmark(**vars(args))
+    sys.exit(0 if ok else 1)
+
+
+def benchmark(directory: Path, docs: int = 1000, seed: int = 0,
+              merge_strategies=harmonise.STRATEGIES,
+              engines=harmonise.ENGINES, binary: bool = False,
+              json_path: Path = None) -> bool:
+    """
+    Generate input, run all benchmarks, and report the results.
+
+    Return False if the engines' outputs differ for any strategy.
+    """
+    paths = generate(directory, docs, seed=seed, binary=binary)
+    results = []
+    ctx = mp.get_context('spawn')
+    for strategy, engine in it.product(merge_strategies, engines):
+        tgt_path = directory / f'harmonised.{strategy}.{engine}.conll'
+        with ctx.Pool(1) as pool:
+            result = pool.apply(measure, (paths, strategy, engine, tgt_path))
+        results.append(dict(strategy=strategy, engine=engine, **result))
+        _report(results[-1])
+
+    ok = True
+    for strategy in merge_strategies:
+        outputs = [directory / f'harmonised.{strategy}.{e}.conll'
+                   for e in engines]
+        for other in outputs[1:]:
+            if not filecmp.cmp(outputs[0], other, shallow=False):
+                print(f'MISMATCH: {outputs[0]} {other}', file=sys.stderr)
+                ok = False
+    if json_path is not None:
+        with json_path.open('w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+    return ok
+
+
+def measure(paths: Dict[str, Path], strategy: str, engine: str,
+            tgt_path: Path) -> Dict[str, float]:
+    """
+    Time the stages of harmonisation for one strategy and engine.
+
+    The stage timings are those of harmonise's own metrics
+    (reading, WordPiece reconstruction, merging, writing).
+    """
+    metrics_path = tgt_path.with_suffix('.metrics.json')
+    harmonise.harmonise(
+        tgt_path, paths['oger'], paths['tokens'],
+        span_pred=paths['spans'], id_pred=paths['ids'],
+        merge_strategy=strategy, engine=engine, metrics=metrics_path)
+    with metrics_path.open(encoding='utf8') as f:
+        metrics = json.load(f)
+    seconds = metrics['seconds']
+    return dict(
+        tokens=metrics['tokens'],
+        total=seconds['total'],
+        tokens_per_sec=metrics['tokens_per_second'],
+        read=seconds['read'],
+        wordpiece=seconds['wordpiece'],
+        merge=seconds['merge'],
+        write=seconds['write'],
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+    )
+
+
+def _report(result):
+    print('{strategy:<12} {engine:<7} {tokens:>9} tokens  {total:7.2f}s  '
+          '{tokens_per_sec:>9.0f} tok/s  read {read:6.2f}s  '
+          'wordpiece {wordpiece:6.2f}s  merge {merge:6.2f}s  '
+          'write {write:6.2f}s  RSS {peak_rss_mb:6.0f} MB'.format(**result))
+
+
+def generate(directory: Path, n_docs: int, seed: int = 0,
+             max_seq_length: int = 128, binary: bool = False
+            ) -> Dict[str, Path]:
+    """
+    Write synthetic OGER and BioBERT files to a directory.
+
+    The files follow the formats of OGER's CoNLL export and
+    biobert_predict.py, including word pieces, control characters,
+    [UNK] tokens, overlong words and truncated sequences.
+    """
+    rand = random.Random(seed)
+    paths = dict(
+        oger=directory / 'oger.conll',
+        tokens=directory / 'biobert.tokens',
+        spans=directory / 'spans.labels',
+        ids=directory / 'ids.labels',
+    )
+    label_ids = dict(spans=array('l'), ids=array('l'))
+    vocabs = dict(spans={}, ids={})
+    lengths = array('l')
+    with paths['oger'].open('w', encoding='utf8') as oger, \
+            paths['tokens'].open('w', encoding='utf8') as tokens, \
+            paths['spans'].open('w', encoding='utf8') as spans, \
+            paths['ids'].open('w', encoding='utf8') as ids:
+        writer = csv.writer(oger, **harmonise.TSV_FORMAT)
+        for docid in range(10000000, 10000000+n_docs):
+            writer.writerow([f'# doc_id = {docid}'])
+            offset = 0
+            for _ in range(rand.randint(3, 12)):
+                words = [_word(rand) for _ in range(rand.randint(1, 80))]
+                for word in words:
+                    writer.writerow((word, offset, offset+len(word),
+                                     _feature(rand)))
+                    offset += len(word) + 1
+                writer.writerow(())
+                # Chunking as in biobert_predict.py:_read_data().
+                words = [w[:50] for w in words]
+                for i in range(0, len(words), 30):
+                    lines = _bert_lines(words[i:i+30], max_seq_length)
+                    lengths.append(len(lines))
+                    for line in lines:
+                        tokens.write(line + '\n')
+                        span, id_ = _predictions(rand, line)
+                        spans.write(span + '\n')
+                        ids.write(id_ + '\n')
+                        if binary:
+                            for fmt, label in (('spans', span), ('ids', id_)):
+                                code = vocabs[fmt].setdefault(
+                                    label, len(vocabs[fmt]))
+                                label_ids[fmt].append(code)
+    if binary:
+        for fmt in ('spans', 'ids'):
+            path = Path(f'{paths[fmt]}.npy')
+            np.save(path, np.array(label_ids[fmt], dtype=np.int16))
+            np.save(path.with_suffix('.lengths.npy'),
+                    np.array(lengths, dtype=np.int32))
+            with path.with_suffix('.vocab').open('w', encoding='utf8') as f:
+                f.writelines(f'{label}\n' for label in vocabs[fmt])
+            paths[fmt] = path
+    return paths
+
+
+def _word(rand):
+    r = rand.random()
+    if r < .005:
+        return rand.choice('\x07\x7f\ufffd')  # deleted by BERT's tokenizer
+    if r < .01:
+        return '☃'  # [UNK]
+    if r < .012:
+        return ''.join(rand.choice('ACGT') for _ in range(rand.randint(51, 90)))
+    return rand.choice(WORDS)
+
+
+def _wordpiece(word):
+    if word == '☃':
+        return ['[UNK]']
+    if len(word) == 1 and harmonise.PredictionMerger._is_control_char(word):
+        return []
+    if len(word) <= 6:
+        return [word]
+    return [word[:4], *(f'##{word[i:i+4]}' for i in range(4, len(word), 4))]
+
+
+def _bert_lines(words, max_seq_length):
+    pieces = [p for w in words for p in _wordpiece(w)]
+    lines = ['[CLS]', *pieces[:max_seq_length-2], '[SEP]']
+    if len(pieces) > max_seq_length - 2:
+        lines[-2] = ' '.join(pieces[max_seq_length-3:])
+    return lines
+
+
+def _feature(rand):
+    if rand.random() < .8:
+        return 'O'
+    concepts = ';'.join(f'SYN:{rand.randrange(CONCEPTS)}'
+                        for _ in range(rand.randint(1, 3)))
+    return f'{rand.choice("BIES")}-{concepts}'
+
+
+def _predictions(rand, line):
+    if line in ('[CLS]', '[SEP]'):
+        return line, line
+    if line.startswith('##'):
+        return 'X', 'X'
+    span = rand.choice(SPAN_TAGS)
+    if rand.random() < .7:
+        id_ = 'O-NIL'
+    else:
+        id_ = f'{rand.choice("BI")}-SYN:{rand.randrange(CONCEPTS)}'
+    return span, id_
+
+
+if __name__ == '__main__':
+    main()
@@ -6,17 +6,27 @@ BASED ON Google_BERT.
 @Author:zhoukaiyin
 """
 
+import io
+import os
+import sys
+import mmap
+import shutil
 import pickle
+import multiprocessing as mp
 from pathlib import Path
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import math_ops
 
 import modeling
 import tokenization
 
-import tf_threads
-del tf_threads
+import tf_threads  # also used for the sessions of the --models mode
+
+# telemetry.py lives in the parent directory.
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import telemetry
 
 
 
@@ -85,6 +95,38 @@ flags.DEFINE_bool("do_preprocess", False,
 flags.DEFINE_bool("do_predict", False,
                   "Whether to run the model in inference mode on the test set.")
 
+flags.DEFINE_bool("binary_labels", False,
+                  "Whether to write the predictions as a NumPy array of "
+                  "label IDs (.labels.npy), accompanied by a label "
+                  "vocabulary (.labels.vocab) and the sentence lengths "
+                  "(.labels.lengths.npy), instead of text labels.")
+
+flags.DEFINE_integer(
+    "preprocess_workers", 1,
+    "Number of processes for preprocessing. The input is split into "
+    "shards at document boundaries, which are converted in parallel.")
+
+flags.DEFINE_bool(
+    "sharded_records", False,
+    "With preprocess_workers > 1, whether to keep the records of each "
+    "shard in a separate file (tf_record-NNNNN-of-NNNNN, listed in "
+    "tf_record.manifest) instead of concatenating them to tf_record.")
+
+flags.DEFINE_string(
+    "models", None,
+    "TSV file with one line per model: init_checkpoint, data_dir, "
+    "configuration and (optionally) output_dir, which defaults to "
+    "output_dir/<name of data_dir>. All models are run over the "
+    "preprocessed input in this process, which is decoded only once.")
+
+flags.DEFINE_bool(
+    "dynamic_padding", False,
+    "Whether to sort the sentences by length (within windows of "
+    "consecutive sentences) and pad each batch only to its longest "
+    "sentence, instead of max_seq_length. The predictions are written "
+    "in the original order. Like --models, this runs the models in "
+    "this process rather than through the Estimator.")
+
 flags.DEFINE_integer("batch_size", 8, "Total batch size.")
 
 flags.DEFINE_integer("save_checkpoints_steps", 1000,
@@ -103,10 +145,23 @@ flags.DEFINE_integer(
 # ------------------------- FUNCTIONS ------------------------------------------
 
 
-def pred_path(suffix):
+# Shards per process with --preprocess_workers (for balancing the load).
+SHARDS_PER_WORKER = 4
+
+# Sentences decoded at a time when reading the input for --models.
+DECODE_BATCH_SIZE = 4096
+
+# Consecutive sentences sorted by length for --dynamic_padding; their
+# predictions are held in memory until the window is complete.
+BUCKET_WINDOW = 1 << 16
+
+
+def pred_path(suffix, output_dir=None):
     """Construct a path in the output directory."""
     base = Path(FLAGS.tf_record).name
-    path = Path(FLAGS.output_dir, base).with_suffix(suffix)
+    if output_dir is None:
+        output_dir = FLAGS.output_dir
+    path = Path(output_dir, base).with_suffix(suffix)
     return path
 
 
@@ -139,31 +194,35 @@ class DataProcessor:
     def _read_data(cls, input_file):
         """Read BIO data."""
         with open(input_file) as f:
-            words = []
-            labels = []
-            for line in f:
-                line = line.strip()
-                if line.startswith('# doc_id ='):
-                    continue
-                if line:
-                    word = line.split()[0]
-                    words.append(word[:50])  # truncate extremely long words
-                    labels.append('O')
-                else:
-                    while len(words) > 30:
-                        l = list(filter(None, labels[:30]))
-                        w = list(filter(None, words[:30]))
-                        yield (l, w)
-                        words = words[30:]
-                        labels = labels[30:]
-
-                    if not words:
-                        continue
-                    l = list(filter(None, labels))
-                    w = list(filter(None, words))
+            yield from cls._read_lines(f)
+
+    @staticmethod
+    def _read_lines(f):
+        words = []
+        labels = []
+        for line in f:
+            line = line.strip()
+            if line.startswith('# doc_id ='):
+                continue
+            if line:
+                word = line.split()[0]
+                words.append(word[:50])  # truncate extremely long words
+                labels.append('O')
+            else:
+                while len(words) > 30:
+                    l = list(filter(None, labels[:30]))
+                    w = list(filter(None, words[:30]))
                     yield (l, w)
-                    words = []
-                    labels = []
+                    words = words[30:]
+                    labels = labels[30:]
+
+                if not words:
+                    continue
+                l = list(filter(None, labels))
+                w = list(filter(None, words))
+                yield (l, w)
+                words = []
+                labels = []
         if words:
             l = list(filter(None, labels))
             w = list(filter(None, words))
@@ -172,6 +231,10 @@ class DataProcessor:
 
 class NerProcessor(DataProcessor):
 
+    def __init__(self, data_dir=None):
+        # The ID tag sets are read from the model directory.
+        self.data_dir = FLAGS.data_dir if data_dir is None else data_dir
+
     def get_examples(self, tsv_path):
         return self._create_example(self._read_data(tsv_path), "test")
 
@@ -204,11 +267,11 @@ class NerProcessor(DataProcessor):
 
     #? IDS FORMAT -->  CHEBI num_labels = ...-> = 481   Joseph
     def _get_labels_ids(self):
-        path_to_data = Path(FLAGS.data_dir, 'tag_set.txt')
+        path_to_data = Path(self.data_dir, 'tag_set.txt')
         return self._get_id_tagset(path_to_data)
 
     def _get_labels_pretraining(self):
-        path_to_data = Path(FLAGS.data_dir, 'tag_set_pretrained.txt')
+        path_to_data = Path(self.data_dir, 'tag_set_pretrained.txt')
         return self._get_id_tagset(path_to_data)
 
     @staticmethod
@@ -292,6 +355,7 @@ def file_based_convert_examples_to_features(
         output_path, token_path):
     writer = tf.python_io.TFRecordWriter(output_path)
     token_file = open(token_path, 'w', encoding='utf-8')
+    ex_index = -1
     for (ex_index, example) in enumerate(examples):
         if ex_index % 5000 == 0:
             tf.logging.info("Writing example %d" % ex_index)
@@ -300,7 +364,112 @@ def file_based_convert_examples_to_features(
         tf_example = tf.train.Example(
             features=tf.train.Features(feature=feature))
         writer.write(tf_example.SerializeToString())
+    writer.close()
     token_file.close()
+    return ex_index + 1
+
+
+# --------------------------- Parallel preprocessing ---------------------------
+
+def preprocess_parallel(input_file, tf_record, token_path, workers,
+                        sharded=False):
+    """
+    Convert the input in a pool of processes (see --preprocess_workers).
+
+    The shard outputs are concatenated in order, so the .tokens file
+    (and the records) are the same as with serial preprocessing.
+    With sharded, the records are kept in the shard files and listed
+    in a manifest. Return the number of sentences.
+    """
+    ranges = split_documents(input_file, workers * SHARDS_PER_WORKER)
+    names = ['{}-{:05}-of-{:05}'.format(Path(tf_record).name, i, len(ranges))
+             for i in range(len(ranges))]
+    record_shards = [str(Path(tf_record).with_name(n)) for n in names]
+    token_shards = [f'{token_path}.{i:05}' for i in range(len(ranges))]
+    tasks = [(input_file, start, end, record, tokens, FLAGS.vocab_file,
+              FLAGS.do_lower_case, FLAGS.max_seq_length)
+             for (start, end), record, tokens
+             in zip(ranges, record_shards, token_shards)]
+    # TensorFlow doesn't survive forking, so the workers are spawned.
+    with mp.get_context('spawn').Pool(workers) as pool:
+        counts = pool.map(preprocess_shard, tasks)
+
+    _concatenate(token_shards, token_path)
+    manifest = manifest_path(tf_record)
+    if sharded:
+        with open(manifest, 'w', encoding='utf-8') as f:
+            f.writelines(f'{name}\n' for name in names)
+        if Path(tf_record).exists():
+            os.remove(tf_record)  # stale single-file records
+    else:
+        # TFRecord files have no header, so they can be concatenated.
+        _concatenate(record_shards, tf_record)
+        if manifest.exists():
+            manifest.unlink()
+    return sum(counts)
+
+
+def preprocess_shard(task):
+    """Convert a byte range of the input to records and tokens."""
+    (input_file, start, end, record_path, token_path,
+     vocab_file, do_lower_case, max_seq_length) = task
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        # Decoded in the same way as by _read_data().
+        lines = io.TextIOWrapper(io.BytesIO(f.read(end-start)))
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file=vocab_file, do_lower_case=do_lower_case)
+    examples = NerProcessor._create_example(
+        NerProcessor._read_lines(lines), "test")
+    return file_based_convert_examples_to_features(
+        examples, max_seq_length, tokenizer, record_path, token_path)
+
+
+def split_documents(path, n):
+    """
+    Split a CoNLL file into up to n byte ranges of similar size.
+
+    The ranges start with a "# doc_id" line right after an empty line,
+    where _read_data() has no pending words from the previous document.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for k in range(1, n):
+                    target = max(size * k // n, bounds[-1])
+                    pos = mm.find(b'\n\n# doc_id =', target)
+                    if pos == -1:
+                        break
+                    if pos + 2 > bounds[-1]:
+                        bounds.append(pos + 2)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if end > start]
+
+
+def manifest_path(tf_record):
+    """The file listing the shards of a sharded tf_record."""
+    return Path(f'{tf_record}.manifest')
+
+
+def record_files(tf_record):
+    """The files with the preprocessed input (shards or a single one)."""
+    manifest = manifest_path(tf_record)
+    if manifest.exists():
+        with open(manifest, encoding='utf-8') as f:
+            return [str(manifest.with_name(line.strip()))
+                    for line in f if line.strip()]
+    return [str(tf_record)]
+
+
+def _concatenate(parts, target):
+    with open(target, 'wb') as f:
+        for part in parts:
+            with open(part, 'rb') as p:
+                shutil.copyfileobj(p, f)
+            os.remove(part)
 
 
 def file_based_input_fn_builder(input_file, seq_length, is_training, drop_remainder):
@@ -365,7 +534,9 @@ def create_model(bert_config, is_training, input_ids, input_mask,
         output_layer = tf.reshape(output_layer, [-1, hidden_size])
         logits = tf.matmul(output_layer, output_weight, transpose_b=True)
         logits = tf.nn.bias_add(logits, output_bias)
-        logits = tf.reshape(logits, [-1, FLAGS.max_seq_length, num_labels])
+        # The sequence length varies between batches with dynamic padding.
+        seq_length = modeling.get_shape_list(input_ids, expected_rank=2)[1]
+        logits = tf.reshape(logits, [-1, seq_length, num_labels])
         # mask = tf.cast(input_mask,tf.float32)
         # loss = tf.contrib.seq2seq.sequence_loss(logits,labels,mask)
         # return (loss, logits, predict)
@@ -413,6 +584,29 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, use_tpu,
         return output_spec
     return model_fn
 
+def write_binary_predictions(result, sent_lengths, vocab, path):
+    """
+    Write the predicted label IDs to a flat .npy array.
+
+    The label vocabulary (ID -> label) and the sentence lengths are
+    written to .vocab and .lengths.npy files next to the array.
+    """
+    dtype = np.int16 if len(vocab) <= np.iinfo(np.int16).max else np.int32
+    lengths = np.array(sent_lengths, dtype=np.int32)
+    np.save(path.with_suffix('.lengths.npy'), lengths)
+    with open(path.with_suffix('.vocab'), 'w', encoding='utf-8') as f:
+        f.writelines(f'{label}\n' for label in vocab)
+    labels = np.lib.format.open_memmap(
+        str(path), mode='w+', dtype=dtype, shape=(int(lengths.sum()),))
+    pos = 0
+    for pidx, (prediction, slen) in enumerate(zip(result, sent_lengths)):
+        if not pidx % 5000:
+            tf.logging.info('Writing prediction %d', pidx)
+        labels[pos:pos+slen] = prediction['prediction'][:slen]
+        pos += slen
+    labels.flush()
+
+
 # -------------------------------- Main ----------------------------------------
 
 def main(_):
@@ -427,16 +621,36 @@ def main(_):
     processor = processors[task_name]()
     token_path = Path(FLAGS.tf_record).with_suffix(".tokens")
 
-    if FLAGS.do_preprocess or not Path(FLAGS.tf_record).exists():
-        tokenizer = tokenization.FullTokenizer(
-            vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
-        predict_examples = processor.get_examples(FLAGS.input_text)
-        file_based_convert_examples_to_features(predict_examples,
-                                                FLAGS.max_seq_length, tokenizer,
-                                                FLAGS.tf_record, token_path)
+    preprocessed = all(map(os.path.exists, record_files(FLAGS.tf_record)))
+    if FLAGS.do_preprocess or not preprocessed:
+        with telemetry.Stage('biobert_preprocess') as items:
+            if FLAGS.preprocess_workers > 1:
+                items['sentences'] = preprocess_parallel(
+                    FLAGS.input_text, FLAGS.tf_record, token_path,
+                    FLAGS.preprocess_workers, FLAGS.sharded_records)
+            else:
+                manifest = manifest_path(FLAGS.tf_record)
+                if manifest.exists():
+                    manifest.unlink()  # stale shards
+                tokenizer = tokenization.FullTokenizer(
+                    vocab_file=FLAGS.vocab_file,
+                    do_lower_case=FLAGS.do_lower_case)
+                predict_examples = processor.get_examples(FLAGS.input_text)
+                items['sentences'] = file_based_convert_examples_to_features(
+                    predict_examples, FLAGS.max_seq_length, tokenizer,
+                    FLAGS.tf_record, token_path)
     if not FLAGS.do_predict:
         return
+    if FLAGS.models or FLAGS.dynamic_padding:
+        predict_multi(processors[task_name], token_path)
+        return
+    model = Path(FLAGS.data_dir).name  # eg. CHEBI-ids
+    with telemetry.Stage('biobert_predict', model) as items:
+        predict(processor, token_path, items)
+
 
+def predict(processor, token_path, items):
+    """Run a model over the preprocessed input and write its labels."""
     label_list = processor.get_labels(FLAGS.configuration)
     bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
 
@@ -478,9 +692,7 @@ def main(_):
         eval_batch_size=FLAGS.batch_size,
         predict_batch_size=FLAGS.batch_size)
 
-    with open(Path(FLAGS.data_dir, 'label2id.pkl'), 'rb') as rf:
-        label2id = pickle.load(rf)
-        id2label = {value: key for key, value in label2id.items()}
+    id2label = read_label_map(FLAGS.data_dir)
 
     if FLAGS.use_tpu:
         # Warning: According to tpu_estimator.py Prediction on TPU is an
@@ -488,11 +700,29 @@ def main(_):
         raise ValueError("Prediction in TPU not supported")
     predict_drop_remainder = True if FLAGS.use_tpu else False
     predict_input_fn = file_based_input_fn_builder(
-        input_file=FLAGS.tf_record,
+        input_file=record_files(FLAGS.tf_record),
         seq_length=FLAGS.max_seq_length,
         is_training=False,
         drop_remainder=predict_drop_remainder)
 
+    sent_lengths = read_sent_lengths(token_path)
+    items['sentences'] = len(sent_lengths)
+    items['predictions'] = sum(sent_lengths)
+
+    result = estimator.predict(input_fn=predict_input_fn)
+    write_predictions(result, sent_lengths, id2label, len(label_list)+1,
+                      FLAGS.configuration, pred_path(suffix=".labels"))
+
+
+def read_label_map(data_dir):
+    """Get the ID -> label mapping of a model."""
+    with open(Path(data_dir, 'label2id.pkl'), 'rb') as rf:
+        label2id = pickle.load(rf)
+    return {value: key for key, value in label2id.items()}
+
+
+def read_sent_lengths(token_path):
+    """Count the tokens of each sentence (including [CLS] and [SEP])."""
     sent_lengths = []
     with open(token_path, 'r') as reader:
         for line in reader:
@@ -502,12 +732,21 @@ def main(_):
             slen += 1
             if tok == '[SEP]':
                 sent_lengths.append(slen)
+    return sent_lengths
 
-    result = estimator.predict(input_fn=predict_input_fn)
+
+def write_predictions(result, sent_lengths, id2label, num_labels,
+                      configuration, output_predict_file):
+    """Write the labels of each sentence (as text or binary)."""
     tf.logging.info('Serializing predictions...')
-    output_predict_file = pred_path(suffix=".labels")
     id_conf = ('ids', 'pretrain', 'pretrained_ids')
-    outside_symbol = 'O-NIL' if FLAGS.configuration in id_conf else 'O'
+    outside_symbol = 'O-NIL' if configuration in id_conf else 'O'
+    if FLAGS.binary_labels:
+        vocab = [id2label.get(id, outside_symbol)
+                 for id in range(num_labels)]
+        write_binary_predictions(result, sent_lengths, vocab,
+                                 Path(f'{output_predict_file}.npy'))
+        return
     with open(output_predict_file, 'w') as p_writer:
         for pidx, (prediction, slen) in enumerate(zip(result, sent_lengths)):
             if not pidx % 5000:
@@ -518,5 +757,171 @@ def main(_):
             p_writer.write(output_line + "\n")
 
 
+# ---------------------------- Multiple models ---------------------------------
+
+def predict_multi(processor_class, token_path):
+    """
+    Run several models over the same input (see --models).
+
+    The input is decoded once into memory (token IDs and lengths).
+    Models with the same number of labels share a graph and a session,
+    into which their checkpoints are restored in turn.
+    """
+    if FLAGS.models:
+        models = read_model_list(FLAGS.models)
+    else:
+        models = [(FLAGS.init_checkpoint, FLAGS.data_dir,
+                   FLAGS.configuration, FLAGS.output_dir)]
+    bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+    if FLAGS.max_seq_length > bert_config.max_position_embeddings:
+        raise ValueError(
+            "Cannot use sequence length %d because the BERT model "
+            "was only trained up to sequence length %d" %
+            (FLAGS.max_seq_length, bert_config.max_position_embeddings))
+
+    with telemetry.Stage('biobert_decode') as items:
+        sent_lengths = read_sent_lengths(token_path)
+        input_ids, input_lengths = read_inputs(
+            record_files(FLAGS.tf_record), FLAGS.max_seq_length,
+            bert_config.vocab_size)
+        items['sentences'] = len(input_lengths)
+    if len(input_lengths) != len(sent_lengths):
+        raise ValueError('%s and %s have different numbers of sentences' %
+                         (FLAGS.tf_record, token_path))
+
+    predictors = {}
+    for checkpoint, data_dir, configuration, output_dir in models:
+        label_list = processor_class(data_dir).get_labels(configuration)
+        num_labels = len(label_list)+1
+        if num_labels not in predictors:
+            predictors[num_labels] = Predictor(bert_config, num_labels,
+                                               FLAGS.max_seq_length)
+        predictor = predictors[num_labels]
+        with telemetry.Stage('biobert_predict', Path(data_dir).name) as items:
+            tf.logging.info('Predicting with %s', checkpoint)
+            predictor.restore(checkpoint)
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+            result = predictor.predict(input_ids, input_lengths,
+                                       FLAGS.batch_size,
+                                       FLAGS.dynamic_padding)
+            write_predictions(result, sent_lengths, read_label_map(data_dir),
+                              num_labels, configuration,
+                              pred_path(".labels", output_dir))
+            items['sentences'] = len(sent_lengths)
+            items['predictions'] = sum(sent_lengths)
+    for predictor in predictors.values():
+        predictor.close()
+
+
+def read_model_list(path):
+    """Read (checkpoint, data_dir, configuration, output_dir) tuples."""
+    models = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) == 3:
+                fields.append(Path(FLAGS.output_dir, Path(fields[1]).name))
+            if len(fields) != 4:
+                raise ValueError('%s: expected 3 or 4 fields: %r' %
+                                 (path, line))
+            models.append(tuple(fields))
+    return models
+
+
+def read_inputs(paths, seq_length, vocab_size):
+    """
+    Decode all records of a .tf_record file (or its shards).
+
+    Return the token IDs (a [sentences, seq_length] array of the
+    smallest sufficient type) and the unpadded length of each sentence.
+    """
+    dtype = np.int16 if vocab_size <= np.iinfo(np.int16).max else np.int32
+    input_fn = file_based_input_fn_builder(paths, seq_length, False, False)
+    ids, lengths = [], []
+    with tf.Graph().as_default():
+        batch = input_fn(dict(batch_size=DECODE_BATCH_SIZE))\
+            .make_one_shot_iterator().get_next()
+        with tf.Session(config=tf_threads.config) as sess:
+            while True:
+                try:
+                    features = sess.run(batch)
+                except tf.errors.OutOfRangeError:
+                    break
+                ids.append(features['input_ids'].astype(dtype))
+                lengths.append(features['input_mask'].sum(axis=1))
+    if not ids:
+        return (np.zeros((0, seq_length), dtype=dtype),
+                np.zeros(0, dtype=np.int32))
+    return np.concatenate(ids), np.concatenate(lengths).astype(np.int32)
+
+
+class Predictor:
+    """Inference graph of a BERT tagger, for restoring checkpoints into."""
+
+    def __init__(self, bert_config, num_labels, seq_length):
+        self.seq_length = seq_length
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            # Batches may be shorter than seq_length (dynamic padding).
+            self.input_ids = tf.placeholder(tf.int32, [None, None])
+            self.input_mask = tf.placeholder(tf.int32, [None, None])
+            zeros = tf.zeros_like(self.input_ids)
+            *_, self.predicts = create_model(
+                bert_config, False, self.input_ids, self.input_mask,
+                zeros, zeros, num_labels, False)
+            self.saver = tf.train.Saver()
+        self.session = tf.Session(graph=self.graph, config=tf_threads.config)
+
+    def restore(self, checkpoint):
+        self.saver.restore(self.session, checkpoint)
+
+    def predict(self, input_ids, input_lengths, batch_size,
+                dynamic_padding=False, window=BUCKET_WINDOW):
+        """
+        Iterate over the predictions (in the format of the Estimator).
+
+        With dynamic_padding, each window of consecutive sentences is
+        sorted by length, so that each batch holds sentences of similar
+        length and is only padded to its longest one. The predictions
+        (trimmed to the sentence lengths) are put back in order.
+        """
+        if not dynamic_padding:
+            for batch in self._run(input_ids, input_lengths, batch_size):
+                for prediction in batch:
+                    yield dict(prediction=prediction)
+            return
+        for start in range(0, len(input_lengths), window):
+            lengths = input_lengths[start:start+window]
+            order = np.argsort(lengths, kind='stable')
+            results = [None] * len(order)
+            batches = self._run(input_ids[start:start+window][order],
+                                lengths[order], batch_size, dynamic=True)
+            pos = 0
+            for batch in batches:
+                for prediction in batch:
+                    i = order[pos]
+                    results[i] = prediction[:lengths[i]]
+                    pos += 1
+            for prediction in results:
+                yield dict(prediction=prediction)
+
+    def _run(self, input_ids, input_lengths, batch_size, dynamic=False):
+        """Predict batches of consecutive sentences."""
+        width = self.seq_length
+        for i in range(0, len(input_ids), batch_size):
+            lengths = input_lengths[i:i+batch_size]
+            if dynamic:
+                width = lengths.max()
+            yield self.session.run(self.predicts, {
+                self.input_ids: input_ids[i:i+batch_size, :width],
+                self.input_mask: np.arange(width) < lengths[:, None],
+            })
+
+    def close(self):
+        self.session.close()
+
+
 if __name__ == "__main__":
     tf.app.run()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Schedule the BioBERT prediction runs (one per vocabulary and label set).
+
+The jobs are kept in a persistent queue (an SQLite database, by default
+next to the predictions), so that an interrupted run can be continued
+and progress can be checked at any time with the "status" subcommand.
+
+The "run" subcommand starts a worker pool on the local machine and,
+optionally, on remote hosts (over ssh; the paths must be the same on
+all hosts, eg. a shared file system). Each executor gets a core budget,
+which is divided into slots of --threads cores; every job is told to
+use that many threads through TF_INTRA_OP_THREADS/TF_INTER_OP_THREADS
+(see tf_threads.py). Failed jobs are retried (on any executor) up to
+--attempts times. The predictions are written to a temporary directory
+and then moved to <output-dir>/<vocabulary>-<labels>.labels.
+
+Subcommands:
+  add      queue prediction jobs
+  run      process the queue
+  status   show the state of all jobs
+  retry    re-queue failed jobs
+"""
+
+
+import os
+import re
+import sys
+import json
+import shlex
+import shutil
+import sqlite3
+import argparse
+import datetime
+import threading
+import subprocess
+import itertools as it
+from pathlib import Path
+
+
+HERE = Path(__file__).resolve().parent
+PREDICT_SCRIPT = 'biobert_predict.py'
+VOCABULARIES = ('CHEBI', 'CL', 'GO_BP', 'GO_CC', 'GO_MF', 'MOP', 'NCBITaxon',
+                'PR', 'SO', 'UBERON')
+LABEL_SETS = ('ids', 'spans')
+STATES = ('pending', 'running', 'done', 'failed')
+# Files which mark the output of a job complete (text or binary labels).
+COMPLETE_SUFFIXES = ('.labels', '.labels.npy')
+QUEUE_NAME = 'jobs.sqlite'
+THREADS = 4  # per job, as the default in tf_threads.py
+ATTEMPTS = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    argv TEXT NOT NULL,
+    output TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    host TEXT,
+    started TEXT,
+    finished TEXT,
+    message TEXT
+);
+'''
+
+
+def main():
+    '''
+    Run as script.
+    '''
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawTextHelpFormatter)
+    ap.add_argument(
+        '-o', '--output-dir', type=Path, required=True, metavar='PATH',
+        help='directory for the .labels files (eg. ../data/biobert)')
+    ap.add_argument(
+        '-q', '--queue', type=Path, metavar='PATH',
+        help='job database (default: OUTPUT_DIR/%s)' % QUEUE_NAME)
+    sub = ap.add_subparsers(dest='command')
+    sub.required = True
+    add = sub.add_parser('add', help='queue prediction jobs')
+    add.add_argument(
+        '-t', '--tf-record', type=Path, required=True, metavar='PATH',
+        help='preprocessed input (from --do_preprocess)')
+    add.add_argument(
+        '-v', '--vocabularies', nargs='+', default=VOCABULARIES,
+        metavar='VOCAB', help='default: all')
+    add.add_argument(
+        '-l', '--label-sets', nargs='+', default=LABEL_SETS,
+        choices=LABEL_SETS, metavar='LABELS', help='default: all')
+    add.add_argument(
+        '-x', '--exclude', nargs='+', default=(), metavar='JOB',
+        help='skip these jobs, eg. PR-ids (unused with spans-only)')
+    add.add_argument(
+        '-m', '--models', type=Path, default=HERE/'models', metavar='PATH',
+        help='directory with a VOCAB-LABELS subdirectory per model, '
+             'the latest checkpoint is used (default: %(default)s)')
+    add.add_argument(
+        'extra', nargs='*', metavar='FLAG',
+        help='further flags for biobert_predict.py (after "--"), '
+             'eg. --binary_labels=true')
+    run = sub.add_parser('run', help='process the queue')
+    run.add_argument(
+        '-c', '--cores', type=int, default=os.cpu_count(), metavar='N',
+        help='core budget of the local machine (default: %(default)s)')
+    run.add_argument(
+        '-r', '--remote', nargs='+', type=_host_budget, default=(),
+        metavar='HOST=CORES', help='additional executors over ssh')
+    run.add_argument(
+        '-n', '--threads', type=int, default=THREADS, metavar='N',
+        help='threads (cores) per job (default: %(default)s)')
+    run.add_argument(
+        '-a', '--attempts', type=int, default=ATTEMPTS, metavar='N',
+        help='give up on a job after N failures (default: %(default)s)')
+    run.add_argument(
+        '-p', '--python', default=sys.executable, metavar='PATH',
+        help='Python interpreter for the jobs (default: %(default)s)')
+    sub.add_parser('status', help='show the state of all jobs')
+    sub.add_parser('retry', help='re-queue failed jobs')
+    args = ap.parse_args()
+
+    if args.queue is None:
+        args.queue = args.output_dir / QUEUE_NAME
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    queue = JobQueue(args.queue)
+    if args.command == 'add':
+        n = queue.add(prediction_jobs(
+            args.tf_record, args.output_dir, args.vocabularies,
+            args.label_sets, args.models, args.extra, args.exclude))
+        print('{} jobs queued'.format(n), file=sys.stderr)
+    elif args.command == 'run':
+        executors = [LocalExecutor(args.cores)]
+        executors.extend(RemoteExecutor(host, cores)
+                         for host, cores in args.remote)
+        ok = run_jobs(queue, executors, args.threads, args.attempts,
+                      args.python)
+        sys.exit(0 if ok else 1)
+    elif args.command == 'status':
+        for job in queue.jobs():
+            print('{name:<20} {state:<8} {attempts} {host} {finished} '
+                  '{message}'.format(**{k: '' if v is None else v
+                                        for k, v in job.items()}))
+    else:
+        print('{} jobs re-queued'.format(queue.retry()), file=sys.stderr)
+
+
+def _host_budget(arg):
+    host, _, cores = arg.partition('=')
+    try:
+        return host, int(cores)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid host budget: ' + arg)
+
+
+def prediction_jobs(tf_record, output_dir, vocabularies=VOCABULARIES,
+                    label_sets=LABEL_SETS, models=HERE/'models', extra=(),
+                    exclude=()):
+    """Iterate over (name, argv, output) triples for queueing."""
+    tf_record = Path(tf_record).resolve()
+    for vocab, labels in it.product(vocabularies, label_sets):
+        name = '{}-{}'.format(vocab, labels)
+        if name in exclude:
+            continue
+        model_dir = Path(models, name).resolve()
+        argv = ['--do_predict=true',
+                '--tf_record={}'.format(tf_record),
+                '--bert_config_file={}'.format(HERE/'common/bert_config.json'),
+                '--init_checkpoint={}'.format(latest_checkpoint(model_dir)),
+                '--data_dir={}'.format(model_dir),
+                '--configuration={}'.format(labels),
+                *extra]
+        yield name, argv, Path(output_dir, name + '.labels').resolve()
+
+
+def latest_checkpoint(model_dir):
+    """Path prefix of the checkpoint with the most training steps."""
+    steps = [int(m.group(1)) for m in
+             (re.fullmatch(r'model\.ckpt-(\d+)\.index', p.name)
+              for p in Path(model_dir).iterdir())
+             if m]
+    if not steps:
+        raise ValueError('no checkpoint in {}'.format(model_dir))
+    return Path(model_dir, 'model.ckpt-{}'.format(max(steps)))
+
+
+class JobQueue:
+    """
+    Persistent queue of prediction jobs.
+
+    The connection is shared by the worker threads (with a lock);
+    every change is committed immediately.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.RLock()
+
+    def add(self, jobs):
+        """Queue jobs (replacing finished ones). Return the count."""
+        n = 0
+        with self.lock, self.conn:
+            for name, argv, output in jobs:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO jobs (name, argv, output) '
+                    'VALUES (?, ?, ?)', (name, json.dumps(argv), str(output)))
+                n += 1
+        return n
+
+    def jobs(self):
+        with self.lock:
+            return [dict(row) for row in
+                    self.conn.execute('SELECT * FROM jobs ORDER BY name')]
+
+    def count(self, state):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE state = ?',
+                (state,)).fetchone()[0]
+
+    def claim(self, host):
+        """Mark the next pending job as running and return it (or None)."""
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT * FROM jobs WHERE state = 'pending' "
+                'ORDER BY attempts, name LIMIT 1').fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET state = 'running', host = ?, started = ?, "
+                'finished = NULL WHERE name = ?', (host, _now(), row['name']))
+            return dict(row)
+
+    def finish(self, name, error=None, attempts=ATTEMPTS):
+        """Record the outcome of a job; failed jobs may be retried."""
+        with self.lock, self.conn:
+            if error is None:
+                self.conn.execute(
+                    "UPDATE jobs SET state = 'done', finished = ?, "
+                    'message = NULL WHERE name = ?', (_now(), name))
+            else:
+                self.conn.execute(
+                    'UPDATE jobs SET attempts = attempts + 1, finished = ?, '
+                    "message = ?, state = CASE WHEN attempts + 1 >= ? "
+                    "THEN 'failed' ELSE 'pending' END WHERE name = ?",
+                    (_now(), error, attempts, name))
+
+    def reset_running(self):
+        """Re-queue jobs left running by an interrupted scheduler."""
+        with self.lock, self.conn:
+            return self.conn.execute(
+                "UPDATE jobs SET state = 'pending' "
+                "WHERE state = 'running'").rowcount
+
+    def retry(self):
+        with self.lock, self.conn:
+            return self.conn.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0 "
+                "WHERE state = 'failed'").rowcount
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+class LocalExecutor:
+    """Run jobs as subprocesses of the scheduler."""
+    host = 'localhost'
+
+    def __init__(self, cores):
+        self.cores = cores
+
+    def command(self, argv, env):
+        return argv, dict(os.environ, **env)
+
+
+class RemoteExecutor:
+    """Run jobs on another host over ssh (with the same paths)."""
+    def __init__(self, host, cores):
+        self.host = host
+        self.cores = cores
+
+    def command(self, argv, env):
+        remote = 'cd {} && env {} {}'.format(
+            shlex.quote(str(HERE)),
+            ' '.join('{}={}'.format(k, shlex.quote(v)) for k, v in env.items()),
+            ' '.join(map(shlex.quote, argv)))
+        return ['ssh', '-o', 'BatchMode=yes', self.host, remote], None
+
+
+def run_jobs(queue, executors, threads=THREADS, attempts=ATTEMPTS,
+             python=sys.executable, script=PREDICT_SCRIPT):
+    """
+    Process all pending jobs. Return False if any job failed for good.
+
+    Each executor runs cores // threads jobs at a time (at least one).
+    The jobs run script (relative to this directory) with python.
+    """
+    if queue.reset_running():
+        print('re-queued interrupted jobs', file=sys.stderr)
+    busy = threading.Condition()
+    running = [0]
+
+    def worker(executor):
+        while True:
+            with busy:
+                job = queue.claim(executor.host)
+                while job is None and running[0]:
+                    # A running job might fail and be re-queued.
+                    busy.wait()
+                    job = queue.claim(executor.host)
+                if job is None:
+                    busy.notify_all()
+                    return
+                running[0] += 1
+            error = _run_job(job, executor, threads, python, script)
+            with busy:
+                queue.finish(job['name'], error, attempts)
+                running[0] -= 1
+                busy.notify_all()
+            print('{} {} on {}{}'.format(
+                job['name'], 'failed' if error else 'done', executor.host,
+                ': ' + error if error else ''), file=sys.stderr)
+
+    workers = [threading.Thread(target=worker, args=(e,))
+               for e in executors
+               for _ in range(max(1, e.cores // threads))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return queue.count('failed') == 0
+
+
+def _run_job(job, executor, threads, python, script=PREDICT_SCRIPT):
+    """Run a prediction job and move its output into place."""
+    output = Path(job['output'])
+    tmp_dir = output.with_name('.{}.tmp'.format(job['name']))
+    shutil.rmtree(str(tmp_dir), ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    job_argv = json.loads(job['argv'])
+    argv = [python, str(script), *job_argv,
+            '--output_dir={}'.format(tmp_dir)]
+    env = {'TF_INTRA_OP_THREADS': str(threads),
+           'TF_INTER_OP_THREADS': '1'}  # stay within the budget
+    env.update((k, v) for k, v in os.environ.items()
+               if k.startswith('TELEMETRY_'))  # for remote jobs
+    cmd, cmd_env = executor.command(argv, env)
+    log_path = output.with_suffix('.log')
+    try:
+        with log_path.open('w') as log:
+            status = subprocess.call(cmd, cwd=str(HERE), env=cmd_env,
+                                     stdout=log, stderr=subprocess.STDOUT)
+        if status:
+            return 'exit status {} (see {})'.format(status, log_path)
+        # Eg. biobert.labels -> CHEBI-ids.labels (also .npy/.vocab files),
+        # named after the input as in biobert_predict.py:pred_path().
+        # The .labels (or .labels.npy) file goes last: it marks the job's
+        # output complete, eg. the .vocab file is in place before it.
+        base = Path(_flag(job_argv, 'tf_record')).stem
+        produced = sorted(tmp_dir.iterdir(), key=lambda p: (
+            p.name.endswith(COMPLETE_SUFFIXES), p.name))
+        if not produced:
+            return 'no output (see {})'.format(log_path)
+        for path in produced:
+            if not path.name.startswith(base + '.'):
+                return 'unexpected output {} (see {})'.format(
+                    path.name, log_path)
+            suffix = path.name[len(base):]
+            os.replace(str(path), str(output.with_name(output.stem + suffix)))
+        return None
+    except (OSError, ValueError) as e:
+        return str(e)
+    finally:
+        shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+
+def _flag(argv, name):
+    """Get the value of a --name=value flag."""
+    prefix = '--{}='.format(name)
+    for arg in argv:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    raise ValueError('missing flag: {}'.format(prefix))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,85 @@
 import pandas as pd
 import numpy
 import urllib.request
+import re
 import os
+import io
+import csv
+import gzip
 import json
+import time
+import zlib
+import queue
+import struct
+import shutil
+import tarfile
+import zipfile
+import warnings
+import functools
+import threading
+import contextlib
+import multiprocessing as mp
+from pathlib import Path
 from oger.ctrl.router import Router, PipelineServer
+from oger.doc import EXPORTERS
+from oger.util.misc import tsv_format
+
+import ledger
+import offsets
+import telemetry
+from streaming import StreamedCollection
 
 VOCABULARY = "CHEBI CL GO_BP GO_CC GO_MF MOP NCBITaxon PR SO UBERON"
 VOCABULARIES = VOCABULARY.split()
 
 PMID_URL = 'https://www.ncbi.nlm.nih.gov/research/coronavirus-api/export?'
 
-def get_pmids(outpath='data/ids/'):
+JSON_CHUNK_SIZE = 500  # documents per task in conll_collection_to_jsons()
+NAKED_CHUNK_SIZE = 1 << 24  # bytes rewritten at a time by get_naked_conll()
+# Last column of a CoNLL line, unless it's "O" already.
+CONLL_LABEL = re.compile(rb'\t(?!O$)[^\t\n]*$', re.MULTILINE)
+EXPORT_QUEUE_SIZE = 64  # documents buffered per writer in export_collection()
+TAR_SUFFIXES = ('.tar.gz', '.tgz')
+DOCUMENT_FORMATS = ('txt', 'pubanno_json', 'brat')  # one file per document
+ARCHIVE_COMPRESSLEVEL = 6  # same as the gzip/tar command-line default
 
-    with open('bad_pmids.txt') as f:
-        BAD_PMIDS = [str(pmid).strip() for pmid in f.read().split(', ')]
+# Appending to a zip archive keeps earlier members with the same name.
+warnings.filterwarnings('ignore', 'Duplicate name', UserWarning, 'zipfile')
 
+def get_pmids(outpath='data/ids/', run=None):
+    """
+    Download the LitCovid PMIDs and register them in the ID ledger.
 
+    Writes all_pmids.txt (without bad PMIDs) and pmids.txt, the PMIDs
+    not processed yet (new or previously failed).
+    """
     tsv_output = os.path.join(outpath, 'all_pmids.tsv')
     txt_output = os.path.join(outpath, 'all_pmids.txt')
 
-    urllib.request.urlretrieve(PMID_URL, tsv_output)
-    dataf = pd.read_csv(tsv_output, sep='\t', comment='#')
-    dataf = dataf['pmid'][~dataf['pmid'].isin(BAD_PMIDS)]
-    dataf.to_csv(txt_output, sep=' ', index=False, header=False)
+    with telemetry.Stage('get_pmids') as items:
+        urllib.request.urlretrieve(PMID_URL, tsv_output)
+        with open(tsv_output, encoding='utf8') as f:
+            rows = csv.DictReader(
+                (line for line in f if not line.startswith('#')),
+                delimiter='\t')
+            pmids = [row['pmid'] for row in rows]
+        items['ids'] = len(pmids)
+
+        with ledger.Ledger() as db:
+            run = db.start_run(run)
+            items['new_ids'] = db.add('pmid', pmids, run)
+            bad = set(db.select('pmid', 'bad'))
+            ledger.write_ids(Path(txt_output),
+                             (p for p in pmids if p not in bad))
+            ledger.write_ids(Path(outpath, 'pmids.txt'), db.pending('pmid'))
+
 
+def pmcods_to_txt(inpath='data/ids/PMID-PMCID_15062020.ods', run=None):
+    with telemetry.Stage('pmcods_to_txt') as items:
+        items['ids'], items['new_ids'] = _pmcods_to_txt(inpath, run)
 
-def pmcods_to_txt(inpath='data/ids/PMID-PMCID_15062020.ods',
-                  old='data/ids/old_pmcids.txt'):
+
+def _pmcods_to_txt(inpath, run):
     newf = pd.read_excel(inpath, engine="odf")
     newf = newf[['PMCID']]
     newf['PMCID'].replace("", numpy.nan, inplace=True)
@@ -35,18 +88,13 @@ def pmcods_to_txt(inpath='data/ids/PMID-PMCID_15062020.ods',
     outpath = os.path.join(os.path.dirname(inpath), 'pmcids.txt')
     newf['PMCID'].to_csv(outpath, index=False, header=False)
 
-    oldf = pd.read_csv(old, header=None, names=["PMCID"])
-
-    news = set(newf['PMCID'].astype(int))
-    olds = set(oldf['PMCID'])
-
-    diffs = news.difference(olds)
-
-    # TODO: remove bad_pmcids
-
+    # New and previously failed PMCIDs, without the bad ones.
     outpath = os.path.join(os.path.dirname(inpath), 'new_pmcids.txt')
-    with open(outpath, "w") as g:
-        g.write("\n".join(str(item) for item in diffs))
+    with ledger.Ledger() as db:
+        run = db.start_run(run)
+        new = db.add('pmcid', newf['PMCID'].astype(int).astype(str), run)
+        ledger.write_ids(Path(outpath), db.pending('pmcid'))
+    return len(newf), new
 
 def pmctsv_to_txt(inpath):
     dataf = pd.read_csv(inpath,header=0,delimiter='\t')
@@ -63,53 +111,422 @@ def pmctsv_to_txt(inpath):
 
 def conll_collection_to_jsons(inpath='data/merged/collection.conll',
                               outpath='data/pubannotation',
-                              sourcedb='pubmed'):
-    pl = PipelineServer(Router())
-    collection = pl.load_one(inpath, 'conll')
-    for document in collection:
-        title = document[0].text
-        pmid = document.id_
-        if not os.path.exists(outpath):
-            os.makedirs(outpath)
-
-        outfile = os.path.join(outpath, pmid + '.json')
+                              sourcedb='pubmed', workers=None):
+    """
+    Write a PubAnnotation JSON file for each document of a collection.
+
+    The collection is split into chunks of documents (using its offset
+    index), which are parsed and serialised in a pool of worker
+    processes (default: one per CPU). Each file is written once.
+    Of duplicate documents, the last one is exported.
+    """
+    os.makedirs(outpath, exist_ok=True)
+    inpath = Path(inpath)
+    docs = offsets.doc_index(inpath)
+    last = {entry.docid: i for i, entry in enumerate(docs)}
+    ends = [entry.offset for entry in docs[1:]] + [inpath.stat().st_size]
+    tasks = []
+    for i in range(0, len(docs), JSON_CHUNK_SIZE):
+        j = min(i + JSON_CHUNK_SIZE, len(docs))
+        offset = docs[i].offset
+        skip = [k-i for k in range(i, j) if last[docs[k].docid] != k]
+        tasks.append((inpath, offset, ends[j-1]-offset, skip,
+                      outpath, sourcedb))
+    if workers is None:
+        workers = os.cpu_count()
+    with telemetry.Stage('pubannotation_json') as items:
+        if workers == 1:
+            items['documents'] = sum(map(_write_jsons, tasks))
+        else:
+            with mp.Pool(workers) as pool:
+                items['documents'] = sum(
+                    pool.imap_unordered(_write_jsons, tasks))
+
+
+def _write_jsons(task):
+    inpath, offset, length, skip, outpath, sourcedb = task
+    with open(inpath, 'rb') as f:
+        f.seek(offset)
+        text = io.StringIO(f.read(length).decode('utf8'))
+    pl = _conll_server()
+    formatter = _pubanno_formatter(pl.conf, sourcedb)
+    written = 0
+    for i, document in enumerate(pl.iter_load(text, 'conll')):
+        if i in skip:
+            continue
+        outfile = os.path.join(outpath, document.id_ + '.json')
         with open(outfile, 'w', encoding='utf8') as g:
-            pl.write(document, 'pubanno_json', g)
-        with open(outfile,'r+', encoding='utf8') as g:
-            bad_json = json.load(g)
-            bad_json['sourcedb'] = sourcedb
-            good_json = bad_json
-            g.truncate(0)
-            g.seek(0)
-            json.dump(good_json, g)
+            json.dump(formatter._document(document), g)
+        written += 1
+    return written
+
+
+def _pubanno_formatter(conf, sourcedb):
+    # OGER's pubanno_json format, with the given sourcedb.
+    # Its JSON objects are serialised here, without indentation.
+    conf = Router(conf, pubanno_meta={'sourcedb': sourcedb})
+    return EXPORTERS['pubanno_json'](conf, 'pubanno_json')
+
+
+@functools.lru_cache(maxsize=None)
+def _conll_server():
+    return PipelineServer(Router())
 
 
 def get_naked_conll(inpath='oger/collection.conll',
                     outpath='data/collection.naked.conll'):
-    pl = PipelineServer()
-    coll = pl.load_one(inpath, 'conll')
-    for s in coll.get_subelements('sentence'):
-        s.entities.clear()
-    with open(outpath, 'w') as f:
-        pl.write(coll, 'conll', f, conll_include='docid offsets')
+    """
+    Copy a CoNLL collection without its annotations.
+
+    The label column is set to "O", the "# doc_id" lines and offsets
+    are kept. The file is rewritten line by line in large chunks,
+    without loading the documents into OGER.
+    """
+    with telemetry.Stage('naked_conll') as items, \
+            open(inpath, 'rb') as f, open(outpath, 'wb') as g:
+        for chunk in iter(functools.partial(f.read, NAKED_CHUNK_SIZE), b''):
+            chunk += f.readline()  # complete the last line
+            g.write(CONLL_LABEL.sub(b'\tO', chunk))
+            items['bytes'] += len(chunk)
+
 
 def conll_collection_to_txts(inpath='data/merged/collection.conll',
                              outpath='data/public/txt'):
+    export_collection({'txt': outpath}, inpath)
+
+
+def export_collection(writers, inpath='data/merged/collection.conll',
+                      sourcedb='pubmed', append=(),
+                      queue_size=EXPORT_QUEUE_SIZE):
+    """
+    Write a collection in several formats, parsing it only once.
+
+    writers maps format names (see EXPORT_WRITERS) to output locations
+    (or lists of locations, eg. a directory and an archive).
+    The per-document formats (txt, pubanno_json, brat) are written to a
+    directory, or streamed into a .tar.gz/.tgz or .zip archive.
+    The others (bioc_json, tsv, naked_conll) are written to a file,
+    which is gzipped if its name ends with .gz.
+    The outputs of the formats listed in append are extended rather
+    than replaced: archives get a new segment (.tar.gz, .gz) or new
+    members (.zip) with the documents of this collection. These must
+    exist already (see seed_archive()), otherwise a partial download
+    would be started.
+    Each writer runs on a separate thread, which is fed the documents
+    through a bounded queue. If reading fails, or a writer fails before
+    all documents are read, no file or archive is created or changed
+    (but directories may be partially filled).
+    """
+    unknown = set(writers).union(append).difference(EXPORT_WRITERS)
+    if unknown:
+        raise ValueError('unknown export format(s): {}'.format(
+            ', '.join(sorted(unknown))))
+    if 'bioc_json' in append:
+        raise ValueError('cannot append to bioc_json output')
+    targets = [(fmt, path) for fmt, paths in writers.items()
+               for path in (paths if isinstance(paths, (list, tuple))
+                            else [paths])]
+    locations = [os.path.abspath(path) for _, path in targets]
+    if len(set(locations)) < len(locations):
+        raise ValueError('export formats must have distinct output locations')
+    for fmt, path in targets:
+        if fmt in append and not _is_directory(fmt, path):
+            _check_appendable(path)
+
     pl = PipelineServer(Router())
-    collection = pl.load_one(inpath, 'conll')
-    for document in collection:
-        pmid = document.id_
-        if not os.path.exists(outpath):
-            os.makedirs(outpath)
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in targets]
+    threads = [threading.Thread(target=_run_writer,
+                                args=(EXPORT_WRITERS[fmt], q, path,
+                                      fmt in append, pl.conf, sourcedb,
+                                      errors))
+               for (fmt, path), q in zip(targets, queues)]
+    for t in threads:
+        t.start()
+    end = _ABORT  # unless all documents were read
+    stage = telemetry.Stage('export')
+    items = stage.items
+    stage.start()
+    try:
+        for document in pl.iter_load(inpath, 'conll'):
+            # Tokenise here, not concurrently in the writer threads.
+            for sentence in document.get_subelements('sentence'):
+                sentence.tokenize()
+                items['sentences'] += 1
+                items['tokens'] += len(sentence.subelements)
+            items['documents'] += 1
+            for q in queues:
+                q.put(document)
+            if errors:
+                break
+        else:
+            end = None
+    finally:
+        for q in queues:
+            q.put(end)
+        for t in threads:
+            t.join()
+        stage.stop(failed=end is not None or bool(errors))
+    if errors:
+        raise errors[0]
 
-        outfile = os.path.join(outpath, pmid + '.txt')
-        with open(outfile, 'w', encoding='utf8') as g:
-            pl.write(document, 'txt', g)
+
+class _Aborted(Exception):
+    pass
+
+
+_ABORT = object()  # end marker after a failure: discard the output
+
+
+def _run_writer(writer, documents, path, append, conf, sourcedb, errors):
+    ended = False
+
+    def docs():
+        nonlocal ended
+        for document in iter(documents.get, None):
+            if document is _ABORT:
+                ended = True
+                raise _Aborted()
+            yield document
+        ended = True
+
+    try:
+        writer(docs(), path, append, conf, sourcedb)
+    except _Aborted:
+        pass
+    except Exception as e:
+        errors.append(e)
+        while not ended:  # keep the reader from blocking
+            document = documents.get()
+            ended = document is None or document is _ABORT
+
+
+def _write_txts(docs, outpath, append, conf, sourcedb):
+    formatter = EXPORTERS['txt'](conf, 'txt')
+    _write_per_document(docs, outpath, append, formatter)
+
+
+def _write_brat(docs, outpath, append, conf, sourcedb):
+    formatter = EXPORTERS['brat'](conf, 'brat')
+    _write_per_document(docs, outpath, append, formatter.txt, formatter.ann)
+
+
+def _write_per_document(docs, outpath, append, *formatters):
+    with _document_sink(outpath, append) as add:
+        for document in docs:
+            for formatter in formatters:
+                g = io.StringIO()
+                formatter.write(g, document)
+                add('{}.{}'.format(document.id_, formatter.ext), g.getvalue())
+
+
+def _write_pubanno_jsons(docs, outpath, append, conf, sourcedb):
+    formatter = _pubanno_formatter(conf, sourcedb)
+    with _document_sink(outpath, append) as add:
+        for document in docs:
+            add(document.id_ + '.json',
+                json.dumps(formatter._document(document)))
+
+
+def _write_collection(fmt):
+    # Writer for a single-file format, streamed through an OGER formatter.
+    def _write(docs, outpath, append, conf, sourcedb):
+        formatter = EXPORTERS[fmt](conf, fmt)
+        coll_id = os.path.basename(outpath).split('.')[0]
+        with _open_output(outpath, append) as g:
+            formatter.write(g, StreamedCollection(coll_id, docs))
+    return _write
+
+
+def _write_naked_conll(docs, outpath, append, conf, sourcedb):
+    # Same as the conll format with "docid offsets" and no entities.
+    with _open_output(outpath, append) as g:
+        writer = csv.writer(g, **tsv_format)
+        for document in docs:
+            writer.writerow(['# doc_id = {}'.format(document.id_)])
+            for sentence in document.get_subelements('sentence'):
+                writer.writerows((token.text, token.start, token.end, 'O')
+                                 for token in sentence)
+                writer.writerow(())
+
+
+@contextlib.contextmanager
+def _document_sink(path, append):
+    """
+    Yield a function add(name, text) for storing per-document files.
+
+    Depending on the extension of path, the files are streamed into a
+    tar.gz or zip archive (below a directory named after the archive),
+    or written to a directory.
+
+    A tar.gz archive consists of gzip segments with tar members and a
+    final gzip segment with the end-of-archive marker (TAR_TRAILER).
+    For appending, the trailer is replaced with a new segment (and
+    the trailer), so the archive remains a single tar stream.
+    """
+    stem = re.sub(r'\.(tar\.gz|tgz|zip)$', '', os.path.basename(path))
+    if path.endswith(TAR_SUFFIXES):
+        mtime = int(time.time())
+        with _staged(path, append) as f:
+            with gzip.GzipFile(os.path.basename(path), 'wb',
+                               ARCHIVE_COMPRESSLEVEL, f) as gz:
+                def add(name, text):
+                    gz.write(_tar_member('{}/{}'.format(stem, name),
+                                         text.encode('utf8'), mtime))
+                yield add
+            f.write(TAR_TRAILER)
+    elif path.endswith('.zip'):
+        with zipfile.ZipFile(path, 'a' if append else 'w', zipfile.ZIP_DEFLATED,
+                             compresslevel=ARCHIVE_COMPRESSLEVEL) as zf:
+            def add(name, text):
+                zf.writestr('{}/{}'.format(stem, name), text)
+            yield add
+    else:
+        os.makedirs(path, exist_ok=True)
+        def add(name, text):
+            with open(os.path.join(path, name), 'w', encoding='utf8') as g:
+                g.write(text)
+        yield add
+
+
+@contextlib.contextmanager
+def _open_output(path, append):
+    # Text stream for a single-file format, gzipped for *.gz.
+    with _staged(path, append) as f:
+        if path.endswith('.gz'):
+            f = gzip.GzipFile(os.path.basename(path), 'wb',
+                              ARCHIVE_COMPRESSLEVEL, f)
+        with io.TextIOWrapper(f, encoding='utf8', newline='') as g:
+            yield g
+
+
+def _tar_member(name, data, mtime):
+    # Header and data of a file, padded to full blocks.
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    padding = -len(data) % tarfile.BLOCKSIZE
+    return b''.join([info.tobuf(tarfile.DEFAULT_FORMAT, 'utf-8',
+                                'surrogateescape'),
+                     data, tarfile.NUL * padding])
+
+
+def _stored_gzip(data):
+    # A gzip member with an uncompressed (stored) deflate block,
+    # which is the same byte for byte with any zlib version.
+    return b''.join([
+        b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff',  # no mtime or name
+        b'\x01', struct.pack('<HH', len(data), 0xffff ^ len(data)), data,
+        struct.pack('<II', zlib.crc32(data), len(data))])
+
+
+# End-of-archive marker of a tar.gz archive, see _document_sink().
+TAR_TRAILER = _stored_gzip(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+
+
+def _is_directory(fmt, path):
+    # See _document_sink().
+    return (fmt in DOCUMENT_FORMATS
+            and not path.endswith(TAR_SUFFIXES + ('.zip',)))
+
+
+def _is_appendable(path):
+    # Exists, and ends with the trailer of a tar.gz archive (if it is one).
+    trailer = TAR_TRAILER if path.endswith(TAR_SUFFIXES) else b''
+    try:
+        with open(path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(size - len(trailer), 0))
+            return f.read() == trailer
+    except FileNotFoundError:
+        return False
+
+
+def _check_appendable(path):
+    if not _is_appendable(path):
+        raise ValueError('cannot append to {}: create it (or rebuild it in '
+                         'the current layout) with seed_archive() first'
+                         .format(path))
+
+
+def seed_archive(path, source):
+    """
+    Create a download which is appended to weekly, from its full data.
+
+    source is the full single-file export (eg. litcovid19.tsv) for a .gz
+    file, or a directory with the per-document files for a .tar.gz/.tgz
+    or .zip archive. Nothing is done if path exists already, unless it
+    is a tar.gz archive in an older layout (eg. made with "tar -czf"
+    from a full path): this is rebuilt from source.
+    Return True if the archive was (re)created.
+    """
+    if _is_appendable(path):
+        return False
+    if path.endswith(TAR_SUFFIXES) or path.endswith('.zip'):
+        with _document_sink(path, append=False) as add:
+            for name in sorted(os.listdir(source)):
+                with open(os.path.join(source, name), encoding='utf8',
+                          newline='') as f:
+                    add(name, f.read())
+    else:
+        with open(source, 'rb') as f, _staged(path, append=False) as g:
+            if path.endswith('.gz'):
+                with gzip.GzipFile(os.path.basename(path), 'wb',
+                                   ARCHIVE_COMPRESSLEVEL, g) as gz:
+                    shutil.copyfileobj(f, gz)
+            else:
+                shutil.copyfileobj(f, g)
+    return True
+
+
+@contextlib.contextmanager
+def _staged(path, append):
+    """
+    Yield a binary file which replaces or is appended to path on success.
+
+    The output is written to a temporary file first, so that a failed
+    export leaves an existing archive intact.
+    Since gzip streams can be concatenated, appending a compressed
+    segment to a .gz file yields a valid file. When appending to a
+    tar.gz archive, its trailer is overwritten (see _document_sink()).
+    """
+    if append:
+        _check_appendable(path)
+    part = path + '.part'
+    try:
+        with open(part, 'wb') as f:
+            yield f
+        if append:
+            with open(part, 'rb') as src, open(path, 'r+b') as dest:
+                dest.seek(0, os.SEEK_END)
+                if path.endswith(TAR_SUFFIXES):
+                    dest.seek(dest.tell() - len(TAR_TRAILER))
+                shutil.copyfileobj(src, dest)
+                dest.truncate()
+            os.remove(part)
+        else:
+            os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+EXPORT_WRITERS = {
+    'txt': _write_txts,
+    'pubanno_json': _write_pubanno_jsons,
+    'brat': _write_brat,
+    'bioc_json': _write_collection('bioc_json'),
+    'tsv': _write_collection('tsv'),
+    'naked_conll': _write_naked_conll,
+}
 
 
 def bioc_to_brat(inpath='data/merged/collection.bioc.json',
                  outpath='data/merged/brat'):
-    pl = PipelineServer()
-    coll = pl.load_one(inpath, "bioc_json")
-    for doc in coll:
-        pl.export(doc, output_directory=outpath, export_format='brat')
+    with telemetry.Stage('bioc_to_brat') as items:
+        pl = PipelineServer()
+        coll = pl.load_one(inpath, "bioc_json")
+        for doc in coll:
+            pl.export(doc, output_directory=outpath, export_format='brat')
+            items['documents'] += 1
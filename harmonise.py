@@ -9,15 +9,40 @@ Harmonise predictions from BERT-ids, BERT-spans, and OGER.
 """
 
 
+import sys
 import csv
+import json
+import time
+import cProfile
 import argparse
+import threading
 import unicodedata
 import itertools as it
 from pathlib import Path
-from typing import Tuple, Iterator
+import shutil
+from operator import itemgetter, methodcaller
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, List, Dict, Iterator, Iterable, Sequence, Optional
+
+import numpy as np
+
+import offsets
+import telemetry
 
 
 NIL = 'NIL'
+STRATEGIES = ('spans-only', 'spans-first', 'ids-first', 'ids-only',
+              'spans-alone')
+ENGINES = ('python', 'numpy')
+BINARY_CHUNK_SIZE = 1 << 16
+WORD_CHUNK_SIZE = 1 << 14  # lines
+SHARDS_PER_WORKER = 4  # smaller shards balance the load better
+CHECKPOINT_INTERVAL = 1000  # documents
+CHECKPOINT_SUFFIX = '.checkpoint'
+PROFILERS = ('cprofile', 'sample')
+SAMPLE_INTERVAL = .005  # seconds
 TSV_FORMAT = dict(delimiter='\t', quotechar=None, lineterminator='\n')
 
 
@@ -37,38 +62,455 @@ def main():
         help='input file containing BERT tokens')
     ap.add_argument(
         '-s', '--span-pred', type=Path, metavar='PATH',
-        help='input file containing BERT span predictions')
+        help='input file containing BERT span predictions '
+             '(text labels, or label IDs in a .npy file)')
     ap.add_argument(
         '-i', '--id-pred', type=Path, metavar='PATH',
-        help='input file containing BERT ID predictions')
+        help='input file containing BERT ID predictions '
+             '(text labels, or label IDs in a .npy file)')
     ap.add_argument(
         '-m', '--merge-strategy', metavar='STRATEGY', default='ids-first',
-        choices=('spans-only', 'spans-first', 'ids-first', 'ids-only',
-                 'spans-alone'),
+        choices=STRATEGIES,
         help='strategy for span/ID predictions (default: %(default)s)')
+    ap.add_argument(
+        '--start', metavar='DOCID',
+        help='skip all documents before DOCID '
+             '(uses the offset indices of offsets.py, '
+             'which are created if missing)')
+    ap.add_argument(
+        '--stop', metavar='DOCID',
+        help='stop before DOCID (uses the offset indices)')
+    ap.add_argument(
+        '-w', '--workers', type=int, default=1, metavar='N',
+        help='split the input into contiguous document ranges and '
+             'harmonise them in N parallel processes '
+             '(uses the offset indices)')
+    ap.add_argument(
+        '--resume', action='store_true',
+        help='continue an interrupted run from its checkpoint '
+             '(all other arguments must be the same as before)')
+    ap.add_argument(
+        '--only-docids', type=Path, metavar='PATH',
+        help='only harmonise the documents listed in this file '
+             '(one ID per line) and append them to the existing output '
+             '(uses the offset indices)')
+    ap.add_argument(
+        '--metrics', type=Path, metavar='PATH',
+        help='write a JSON report with timings and counts to PATH')
+    ap.add_argument(
+        '--profile', choices=PROFILERS,
+        help='run the main loop under cProfile or a sampling profiler; '
+             'the output is written next to the target '
+             '(*.prof or collapsed *.stacks for flame graphs)')
+    ap.add_argument(
+        '-e', '--engine', default='python', choices=ENGINES,
+        help='merge implementation: per-token reference implementation '
+             'or vectorised per-document kernel (default: %(default)s)')
+    ap.add_argument(
+        '-v', '--vocabularies', nargs='+', type=_vocab_strategy,
+        metavar='VOCAB=STRATEGY',
+        help='harmonise multiple vocabularies in a single pass; '
+             'the paths given with -t/-o/-s/-i are then treated as '
+             'templates with a "{}" placeholder for the vocabulary name, '
+             'and -m is ignored')
     args = ap.parse_args()
-    harmonise(**vars(args))
+    if args.vocabularies:
+        del args.merge_strategy
+        args.vocabularies = dict(args.vocabularies)
+        harmonise_multi(**vars(args))
+    else:
+        del args.vocabularies
+        harmonise(**vars(args))
 
 
-def harmonise(tgt_path: Path, oger_pred: Path, **kwargs) -> None:
+def _vocab_strategy(arg):
+    vocab, _, strategy = arg.partition('=')
+    if strategy not in STRATEGIES:
+        raise argparse.ArgumentTypeError(f'invalid strategy: {arg}')
+    return vocab, strategy
+
+
+def harmonise(tgt_path: Path, oger_pred: Path, bert_tokens: Path,
+              span_pred: Path = None, id_pred: Path = None,
+              merge_strategy: str = 'ids-first',
+              start: str = None, stop: str = None, workers: int = 1,
+              engine: str = 'python', resume: bool = False,
+              only_docids: Path = None, metrics: Path = None,
+              profile: str = None) -> None:
     """
     Merge BERT predictions and restore document boundaries.
+
+    If start or stop are given, only process the documents
+    in this range (by document ID, excluding stop).
+    With workers > 1, the documents are split into shards,
+    which are processed in parallel.
+    With resume, continue an interrupted run from its checkpoint.
+    With only_docids (a file with one ID per line), only process
+    the listed documents and append them to the target.
+    With metrics, write a JSON report of timings and counts.
+    With profile ("cprofile" or "sample"), profile the main loop.
     """
-    docs = _iter_input_docs(oger_pred)
-    with PredictionMerger(**kwargs) as predictions:
-        with tgt_path.open('w', encoding='utf8') as f:
-            writer = csv.writer(f, **TSV_FORMAT)
-            for docid, ref_rows in docs:
-                writer.writerow([f'# doc_id = {docid}'])
-                writer.writerows(predictions.iter_merge(ref_rows))
+    _harmonise_all([merge_strategy], [tgt_path], [oger_pred], bert_tokens,
+                   [span_pred], [id_pred], start, stop, workers, engine,
+                   resume, only_docids, metrics, profile)
+
+
+def harmonise_multi(vocabularies: Dict[str, str], tgt_path: Path,
+                    oger_pred: Path, bert_tokens: Path,
+                    span_pred: Path = None, id_pred: Path = None,
+                    start: str = None, stop: str = None,
+                    workers: int = 1, engine: str = 'python',
+                    resume: bool = False, only_docids: Path = None,
+                    metrics: Path = None, profile: str = None) -> None:
+    """
+    Harmonise multiple vocabularies in a single pass over the BERT tokens.
+
+    The vocabularies map names to merge strategies.
+    All paths except for bert_tokens are templates, where "{}" is
+    replaced with each vocabulary name.
+    """
+    def paths(template):
+        if template is None:
+            return [None] * len(vocabularies)
+        return [Path(str(template).format(v)) for v in vocabularies]
+
+    _harmonise_all(list(vocabularies.values()), paths(tgt_path),
+                   paths(oger_pred), bert_tokens, paths(span_pred),
+                   paths(id_pred), start, stop, workers, engine,
+                   resume, only_docids, metrics, profile)
+
+
+def iter_harmonised(vocabularies: Dict[str, str], oger_preds: Sequence[Path],
+                    bert_tokens: Path,
+                    span_preds: Sequence[Optional[Path]],
+                    id_preds: Sequence[Optional[Path]],
+                    start: str = None, stop: str = None,
+                    engine: str = 'python'
+                   ) -> Iterator[Tuple[str, Iterator[list]]]:
+    """
+    Iterate over harmonised documents of multiple vocabularies.
+
+    The paths are given as sequences parallel to the vocabularies.
+    For each document, yield its ID and an iterator over tuples of
+    merged rows (one row per vocabulary), which must be consumed
+    before advancing to the next document.
+    """
+    (i, j), = _doc_ranges(oger_preds[0], start, stop)
+    docs = _iter_merged(list(vocabularies.values()), oger_preds, bert_tokens,
+                        span_preds, id_preds, i, j, engine)
+    for _, docid, rows in docs:
+        yield docid, rows
+
+
+def required_predictions(merge_strategy: str) -> Tuple[str, ...]:
+    """The BERT predictions ("spans", "ids") used by a merge strategy."""
+    if merge_strategy not in STRATEGIES:
+        raise ValueError(f'unknown merge strategy: {merge_strategy}')
+    required = ()
+    if merge_strategy != 'ids-only':
+        required += ('spans',)
+    if merge_strategy not in ('spans-only', 'spans-alone'):
+        required += ('ids',)
+    return required
 
 
-def _iter_input_docs(path):
-    with open(path, encoding='utf8') as f:
+def _harmonise_all(strategies, tgt_paths, oger_preds, bert_tokens,
+                   span_preds, id_preds, start, stop, workers, engine,
+                   resume, only_docids, metrics_path, profile):
+    # The counts are reported to the telemetry as well.
+    if metrics_path or telemetry.enabled():
+        metrics = Metrics(tgt_paths, strategies)
+    else:
+        metrics = None
+    vocabulary = ','.join(p.stem for p in tgt_paths)
+    t0 = time.perf_counter()
+    with telemetry.Stage('harmonise', vocabulary) as items:
+        if workers > 1:
+            _harmonise_parallel(workers, strategies, tgt_paths, oger_preds,
+                                bert_tokens, span_preds, id_preds, start,
+                                stop, engine, resume, only_docids, metrics,
+                                profile)
+        else:
+            _harmonise_serial(strategies, tgt_paths, oger_preds, bert_tokens,
+                              span_preds, id_preds, start, stop, engine,
+                              resume, only_docids, bool(only_docids),
+                              metrics, profile)
+        if metrics is not None:
+            items['documents'] = metrics.counts['documents']
+            items['tokens'] = metrics.counts['tokens']
+    if metrics_path is not None:
+        metrics.seconds['total'] = time.perf_counter() - t0
+        metrics.dump(metrics_path)
+
+
+def _harmonise_serial(strategies, tgt_paths, oger_preds, bert_tokens,
+                      span_preds, id_preds, start, stop, engine,
+                      resume, only_docids, append, metrics=None,
+                      profile=None):
+    """
+    Harmonise a document range, committing completed documents.
+
+    After each document, its position in the document index and
+    the target sizes are noted; they are saved in a checkpoint
+    every so often, as well as when the run fails.
+
+    Return the metrics object (if any) for collecting it
+    from worker processes.
+    """
+    checkpoint = Checkpoint(tgt_paths)
+    state = checkpoint.load() if resume else None
+    if resume and state is None and all(p.exists() for p in tgt_paths):
+        return metrics  # completed earlier
+    resume_at = 0
+    if state is not None:
+        resume_at, last_docid, sizes = state
+        checkpoint.verify(oger_preds[0], resume_at, last_docid)
+        checkpoint.truncate(sizes)
+        append = True
+    ranges = _doc_ranges(oger_preds[0], start, stop, only_docids, resume_at)
+
+    # Save a checkpoint before creating the targets, since
+    # a target without a checkpoint counts as completed.
+    position, docid = (ranges[0][0] if ranges else 0), ''
+    sizes = [p.stat().st_size if append and p.exists() else 0
+             for p in tgt_paths]
+    checkpoint.save(position, docid, sizes)
+    mode = 'a' if append else 'w'
+    with ExitStack() as stack:
+        files = [stack.enter_context(p.open(mode, encoding='utf8'))
+                 for p in tgt_paths]
+        writers = [csv.writer(f, **TSV_FORMAT) for f in files]
+        docs = it.chain.from_iterable(
+            _iter_merged(strategies, oger_preds, bert_tokens,
+                         span_preds, id_preds, i, j, engine, metrics)
+            for i, j in ranges)
+        if metrics is not None:
+            docs = metrics.timed('read', docs)
+        stack.enter_context(_profiled(profile, tgt_paths[0]))
+        try:
+            for n, (pos, current, merged_rows) in enumerate(docs, 1):
+                if metrics is not None:
+                    merged_rows = metrics.consume(merged_rows)
+                    t = time.perf_counter()
+                for writer in writers:
+                    writer.writerow([f'# doc_id = {current}'])
+                if len(writers) == 1:
+                    writers[0].writerows(it.chain.from_iterable(merged_rows))
+                else:
+                    for rows in merged_rows:
+                        for writer, row in zip(writers, rows):
+                            writer.writerow(row)
+                if metrics is not None:
+                    metrics.seconds['write'] += time.perf_counter() - t
+                position, docid = pos + 1, current
+                sizes = [f.tell() for f in files]
+                if n % CHECKPOINT_INTERVAL == 0:
+                    for f in files:
+                        f.flush()
+                    checkpoint.save(position, docid, sizes)
+        except BaseException:
+            for f in files:
+                f.flush()
+            checkpoint.save(position, docid, sizes)
+            raise
+    checkpoint.clear()
+    return metrics
+
+
+def _harmonise_parallel(workers, strategies, tgt_paths, oger_preds,
+                        bert_tokens, span_preds, id_preds, start, stop,
+                        engine, resume, only_docids, metrics, profile):
+    """
+    Run the harmonisation on document shards in a process pool.
+
+    Each shard is written to a separate part file, which are then
+    concatenated in order to the final targets.
+    Part files are kept after a failure, for resuming.
+    """
+    checkpoint = Checkpoint(tgt_paths)
+    state = checkpoint.load() if resume else None
+    if resume and state is None and all(p.exists() for p in tgt_paths):
+        return  # completed earlier
+    if state is not None:
+        checkpoint.truncate(state[2])
+    else:
+        sizes = [p.stat().st_size if only_docids and p.exists() else 0
+                 for p in tgt_paths]
+        checkpoint.save(0, '', sizes)
+
+    shards = offsets.split_docs(oger_preds[0], workers * SHARDS_PER_WORKER,
+                                start, stop)
+    suffixes = [f'.part{i:04}' for i in range(len(shards))]
+    parts = [[Path(f'{tgt}{suffix}') for suffix in suffixes]
+             for tgt in tgt_paths]
+    jobs = [(strategies, [tgt[n] for tgt in parts], oger_preds, bert_tokens,
+             span_preds, id_preds, shard_start, shard_stop, engine,
+             resume, only_docids, False,
+             Metrics(tgt_paths, strategies) if metrics else None, profile)
+            for n, (shard_start, shard_stop) in enumerate(shards)]
+    with ProcessPoolExecutor(workers) as pool:
+        for shard_metrics in pool.map(_call_serial, jobs):
+            if metrics is not None and shard_metrics is not None:
+                metrics.add(shard_metrics)
+    mode = 'ab' if only_docids else 'wb'
+    for tgt, tgt_parts in zip(tgt_paths, parts):
+        with tgt.open(mode) as f:
+            for part in tgt_parts:
+                with part.open('rb') as p:
+                    shutil.copyfileobj(p, f)
+    checkpoint.clear()
+    for part in it.chain.from_iterable(parts):
+        part.unlink()
+
+
+def _call_serial(args):
+    return _harmonise_serial(*args)
+
+
+def _iter_merged(strategies, oger_preds, bert_tokens, span_preds, id_preds,
+                 i, j, engine, metrics=None):
+    """
+    Iterate over harmonised documents at the index positions [i, j).
+
+    Yield triples <position, docid, merged rows>.
+    """
+    predictions = list(zip(span_preds, id_preds, strategies))
+    doc_offsets, sentences = _locate(oger_preds, i, j)
+    limit = j - i if j is not None else None
+    if len(oger_preds) == 1:
+        # Avoid the overhead of aligning rows for a single vocabulary.
+        docs = _iter_input_docs(oger_preds[0], doc_offsets[0], limit)
+        if engine == 'numpy':
+            merger = ArrayPredictionMerger(bert_tokens, predictions, sentences)
+
+            def merge(rows):
+                return merger.iter_merge(zip(rows))
+        else:
+            merger = PredictionMerger(bert_tokens, *predictions[0], sentences)
+
+            def merge(rows):
+                return zip(merger.iter_merge(rows))
+    else:
+        docs = _iter_input_docs_multi(oger_preds, doc_offsets, limit)
+        merger_class = (ArrayPredictionMerger if engine == 'numpy'
+                        else MultiPredictionMerger)
+        merger = merger_class(bert_tokens, predictions, sentences)
+        merge = merger.iter_merge
+    if metrics is not None:
+        merger.metrics = metrics
+        merger.predictions = metrics.timed('wordpiece', merger.predictions)
+    with _report_docid(docs) as docs, merger:
+        for position, docid, ref_rows in docs:
+            if metrics is not None:
+                ref_rows = metrics.timed('read', ref_rows)
+            yield (i + position, docid,
+                   _report_errors(docid, merge(ref_rows)))
+
+
+def _report_errors(docid, rows):
+    # The rows are consumed outside of _report_docid()'s context.
+    try:
+        yield from rows
+    except ValueError as e:
+        raise ValueError(f'document {docid}: {e}') from e
+
+
+@contextmanager
+def _report_docid(docs):
+    """Prefix error messages with the ID of the current document."""
+    current = None
+
+    def track():
+        nonlocal current
+        for position, docid, rows in docs:
+            current = docid
+            yield position, docid, rows
+
+    try:
+        yield track()
+    except ValueError as e:
+        raise ValueError(f'document {current}: {e}') from e
+
+
+def _doc_ranges(path, start=None, stop=None, only_docids=None, resume_at=0):
+    """
+    Get the document ranges to process as index positions [i, j).
+
+    Without any restrictions, this is [0, None) and
+    the offset index is not needed.
+    """
+    if start is None and stop is None and only_docids is None \
+            and not resume_at:
+        return [(0, None)]
+    i, j = offsets.doc_positions(path, start, stop)
+    i = max(i, resume_at)
+    if only_docids is None:
+        return [(i, j)] if i < j else []
+    with open(only_docids, encoding='utf8') as f:
+        wanted = set(line.strip() for line in f) - {''}
+    docs = offsets.doc_index(path)
+    ranges = []
+    for selected, run in it.groupby(range(i, j),
+                                    key=lambda k: docs[k].docid in wanted):
+        if selected:
+            run = list(run)
+            ranges.append((run[0], run[-1]+1))
+    return ranges
+
+
+def _locate(paths, i, j):
+    """Get byte offsets and the sentence range for index positions."""
+    if i == 0 and j is None:
+        return [0] * len(paths), None
+    located = [offsets.locate_positions(p, i, j) for p in paths]
+    if len(set(loc[1:] for loc in located)) > 1:
+        raise ValueError(f'misaligned input: {paths}')
+    return [offset for offset, _, _ in located], located[0][1:]
+
+
+def _iter_input_docs(path, offset=0, limit=None):
+    with offsets.open_range(path, offset) as f:
         rows = csv.reader(f, **TSV_FORMAT)
-        for docid, doc_rows in it.groupby(rows, DocIDTracker()):
-            if docid is not DocIDTracker.DocumentSeparator:
-                yield docid, doc_rows
+        yield from _iter_docs(rows, DocIDTracker(), limit)
+
+
+def _iter_input_docs_multi(paths, offsets_, limit=None):
+    """Iterate over documents from parallel CoNLL files in lock step."""
+    with ExitStack() as stack:
+        readers = [
+            csv.reader(stack.enter_context(offsets.open_range(p, offset)),
+                       **TSV_FORMAT)
+            for p, offset in zip(paths, offsets_)]
+        rows = _check_aligned(it.zip_longest(*readers), paths)
+        tracker = DocIDTracker()
+        yield from _iter_docs(rows, tracker, limit,
+                              key=lambda r: tracker(r[0]))
+
+
+def _iter_docs(rows, tracker, limit, key=None):
+    """
+    Group rows by document, stopping after limit document headers.
+
+    Yield triples <position, docid, rows>, where position
+    counts the headers (including empty documents).
+    """
+    for docid, doc_rows in it.groupby(rows, key or tracker):
+        if limit is not None and tracker.headers > limit:
+            break
+        if docid is not DocIDTracker.DocumentSeparator:
+            yield tracker.headers - 1, docid, doc_rows
+
+
+def _check_aligned(row_tuples, paths):
+    """Make sure all files have the same tokens and document IDs."""
+    for rows in row_tuples:
+        if None in rows:
+            raise ValueError(f'unequal length: {paths}')
+        ref = rows[0][:3]
+        for row in rows[1:]:
+            if row[:3] != ref:
+                raise ValueError(f'misaligned input: {ref} vs. {row[:3]}')
+        yield rows
 
 
 class DocIDTracker:
@@ -78,34 +520,257 @@ class DocIDTracker:
 
     def __init__(self):
         self.docid = None
+        self.headers = 0
 
     def __call__(self, row):
         if row and row[0].startswith('# doc_id = '):
             self.docid = row[0].split('=', 1)[1].strip()
+            self.headers += 1
             return self.DocumentSeparator
         return self.docid
 
 
+class Checkpoint:
+    """
+    Committed state of a harmonisation run, for resuming.
+
+    The state is a TSV row <position, docid, size...>: the index
+    position of the next document, the ID of the last completed
+    document, and the sizes of all targets after it.
+    It is stored next to the first target.
+    """
+
+    def __init__(self, tgt_paths: Sequence[Path]):
+        self.tgt_paths = tgt_paths
+        self.path = tgt_paths[0].with_name(
+            tgt_paths[0].name + CHECKPOINT_SUFFIX)
+
+    def load(self) -> Optional[Tuple[int, str, List[int]]]:
+        """Read the checkpoint, if there is one."""
+        try:
+            with self.path.open(encoding='utf8') as f:
+                position, docid, *sizes = next(csv.reader(f, **TSV_FORMAT))
+        except FileNotFoundError:
+            return None
+        if len(sizes) != len(self.tgt_paths):
+            raise ValueError(f'{self.path}: wrong number of targets')
+        return int(position), docid, [int(s) for s in sizes]
+
+    def save(self, position: int, docid: str, sizes: Sequence[int]):
+        """Atomically replace the checkpoint."""
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w', encoding='utf8') as f:
+            csv.writer(f, **TSV_FORMAT).writerow([position, docid, *sizes])
+        tmp.replace(self.path)
+
+    def clear(self):
+        """Remove the checkpoint after completion."""
+        if self.path.exists():
+            self.path.unlink()
+
+    def verify(self, oger_pred: Path, position: int, docid: str):
+        """Make sure the checkpoint fits the input."""
+        if not docid:
+            return
+        docs = offsets.doc_index(oger_pred)
+        if not 0 < position <= len(docs) or docs[position-1].docid != docid:
+            raise ValueError(f'{self.path}: checkpoint does not match '
+                             f'{oger_pred} at {docid}')
+
+    def truncate(self, sizes: Sequence[int]):
+        """Discard anything written after the checkpoint."""
+        for path, size in zip(self.tgt_paths, sizes):
+            with path.open('ab') as f:
+                if f.tell() < size:
+                    raise ValueError(f'{path}: shorter than checkpoint')
+                f.truncate(size)
+
+
+class Metrics:
+    """
+    Timings and counts of a harmonisation run.
+
+    The time spent in "merge" excludes the reading and WordPiece
+    reconstruction that happen while merging.
+    """
+
+    def __init__(self, tgt_paths: Sequence[Path], strategies: Sequence[str]):
+        self.targets = [str(p) for p in tgt_paths]
+        self.strategies = list(strategies)
+        self.seconds = Counter()
+        self.counts = Counter()
+        self.labels = [Counter() for _ in tgt_paths]
+
+    def timed(self, stage: str, iterable: Iterable) -> Iterator:
+        """Add the time spent in producing each item to a stage."""
+        timer = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            t = timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds[stage] += timer() - t
+                return
+            self.seconds[stage] += timer() - t
+            yield item
+
+    def consume(self, merged_rows: Iterable[list]) -> List[list]:
+        """Materialise the merged rows of a document and count them."""
+        nested = self.seconds['read'] + self.seconds['wordpiece']
+        t = time.perf_counter()
+        merged_rows = list(merged_rows)
+        elapsed = time.perf_counter() - t
+        nested = self.seconds['read'] + self.seconds['wordpiece'] - nested
+        self.seconds['merge'] += elapsed - nested
+
+        self.counts['documents'] += 1
+        for rows in merged_rows:
+            if not rows[0]:
+                continue
+            tok = rows[0][0]
+            self.counts['tokens'] += 1
+            if len(tok) == 1 and PredictionMerger._is_control_char(tok):
+                self.counts['control_chars'] += 1
+            for labels, row in zip(self.labels, rows):
+                labels[row[3].split('-', 1)[0]] += 1
+        return merged_rows
+
+    def add(self, other: 'Metrics'):
+        """Include the metrics of another (partial) run."""
+        self.seconds.update(other.seconds)
+        self.counts.update(other.counts)
+        for labels, other_labels in zip(self.labels, other.labels):
+            labels.update(other_labels)
+
+    def dump(self, path: Path):
+        """Write a JSON report."""
+        report = dict(self.counts)
+        report['seconds'] = dict(self.seconds)
+        if self.seconds['total']:
+            report['tokens_per_second'] = \
+                self.counts['tokens'] / self.seconds['total']
+        report['labels'] = [
+            dict(target=target, strategy=strategy, tags=dict(labels))
+            for target, strategy, labels
+            in zip(self.targets, self.strategies, self.labels)]
+        with path.open('w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+
+
+@contextmanager
+def _profiled(profiler, tgt_path):
+    """Run the enclosed code under a profiler, if any."""
+    if profiler is None:
+        yield
+    elif profiler == 'cprofile':
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(f'{tgt_path}.prof')
+    else:
+        with _sampled(Path(f'{tgt_path}.stacks')):
+            yield
+
+
+@contextmanager
+def _sampled(path, interval=SAMPLE_INTERVAL):
+    """
+    Periodically sample the stack of the current thread.
+
+    The samples are written in the collapsed format of
+    flamegraph.pl/speedscope (one "f1;f2;f3 count" line per stack).
+    """
+    thread_id = threading.get_ident()
+    stacks = Counter()
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} '
+                             f'({Path(code.co_filename).name}:'
+                             f'{code.co_firstlineno})')
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+        with path.open('w', encoding='utf8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
 class PredictionMerger:
     """Handler for iteratively joining span/ID predictions."""
 
+    metrics = None  # type: Metrics
+
     def __init__(self, bert_tokens: Path,
                  span_pred: Path = None, id_pred: Path = None,
-                 merge_strategy: str = 'ids-first'):
-        self.spans = (_undo_wordpiece(bert_tokens, span_pred, 'spans')
-                      if merge_strategy != 'ids-only' else None)
-        self.ids = (_undo_wordpiece(bert_tokens, id_pred, 'ids')
-                    if merge_strategy not in ('spans-only', 'spans-alone')
-                    else None)
-        method_name = f'_next_label_{merge_strategy}'.replace('-', '_')
-        self._next_label = getattr(self, method_name)
+                 merge_strategy: str = 'ids-first',
+                 sentences: Tuple[int, Optional[int]] = None):
+        self._setup(bert_tokens, [(span_pred, id_pred, merge_strategy)],
+                    sentences)
+
+    def _setup(self, bert_tokens, vocabularies, sentences):
+        """
+        Open a joint prediction stream for all vocabularies.
+
+        Each vocabulary is a triple <span_pred, id_pred, merge_strategy>.
+        Every label file is only read if the strategy requires it.
+        If sentences is given as a range <start, stop>, only this part
+        of the input is read (stop=None means the end of the file).
+        """
+        pred_paths, label_formats = [], []
+
+        def column(path, label_format):
+            if path is None:
+                raise ValueError(f'missing {label_format} predictions')
+            pred_paths.append(path)
+            label_formats.append(label_format)
+            return len(pred_paths) - 1
+
+        self._strategies = []
+        for span_pred, id_pred, merge_strategy in vocabularies:
+            required = required_predictions(merge_strategy)
+            spans = (column(span_pred, 'spans')
+                     if 'spans' in required else None)
+            ids = column(id_pred, 'ids') if 'ids' in required else None
+            method_name = f'{self._method_prefix}{merge_strategy}'
+            method = getattr(self, method_name.replace('-', '_'))
+            self._strategies.append((method, spans, ids))
+        self.predictions = self._decode(bert_tokens,
+                                        pred_paths, label_formats,
+                                        sentences, self._encoders(
+                                            label_formats))
+
+    _method_prefix = '_label_'
+
+    @staticmethod
+    def _decode(*args):
+        return _undo_wordpiece(*args)
+
+    @staticmethod
+    def _encoders(_):
+        # Labels are kept as strings.
+        return None
 
     def close(self):
         """Make sure all files are closed."""
-        for fmt in (self.spans, self.ids):
-            if fmt is not None:
-                if next(fmt, None) is not None:
-                    raise ValueError('left-over predictions!')
+        if next(self.predictions, None) is not None:
+            raise ValueError('left-over predictions!')
 
     def __enter__(self):
         return self
@@ -122,13 +787,24 @@ class PredictionMerger:
                 yield ()
                 continue
             tok, start, end, feat = row
-            feat = NIL if feat == 'O' else min(feat.split('-', 1)[1].split(';'))
-            if len(tok) == 1 and self._is_control_char(tok):
-                label = f'O-{NIL}'
-            else:
-                label = self._next_label(tok, feat)
+            label, = self._next_labels(tok, [self._feature(feat)])
             yield tok, start, end, label
 
+    @staticmethod
+    def _feature(feat):
+        return NIL if feat == 'O' else min(feat.split('-', 1)[1].split(';'))
+
+    def _next_labels(self, tok, feats):
+        if len(tok) == 1 and self._is_control_char(tok):
+            return [f'O-{NIL}'] * len(feats)
+        labels = self._next_prediction(tok)
+        return [
+            label(labels[spans] if spans is not None else None,
+                  labels[ids] if ids is not None else None,
+                  feat)
+            for (label, spans, ids), feat in zip(self._strategies, feats)
+        ]
+
     @staticmethod
     def _is_control_char(tok):
         """
@@ -136,33 +812,35 @@ class PredictionMerger:
         """
         return unicodedata.category(tok).startswith('C') or tok == '\ufffd'
 
-    def _next_label_spans_alone(self, ref_tok, _):
-        tag = self._next_prediction(self.spans, ref_tok)
+    @staticmethod
+    def _label_spans_alone(tag, _, __):
         # Append dummy ID labels in order for
         # conll2standoff conversion to work properly.
         tag += '-NIL' if tag == 'O' else '-MISC'
         return tag
 
-    def _next_label_spans_only(self, ref_tok, feat):
-        tag = self._next_prediction(self.spans, ref_tok)
+    @staticmethod
+    def _label_spans_only(tag, _, feat):
         if tag != 'O' and feat != NIL:
             label = f'{tag}-{feat}'
         else:
             label = f'O-{NIL}'
         return label
 
-    def _next_label_ids_only(self, ref_tok, _):
-        return self._next_prediction(self.ids, ref_tok)
+    @staticmethod
+    def _label_ids_only(_, id_, __):
+        return id_
 
-    def _next_label_spans_first(self, ref_tok, feat):
-        return self._next_label_both(ref_tok, feat, spans_first=True)
+    @classmethod
+    def _label_spans_first(cls, span, id_, feat):
+        return cls._label_both(span, id_, feat, spans_first=True)
 
-    def _next_label_ids_first(self, ref_tok, feat):
-        return self._next_label_both(ref_tok, feat, spans_first=False)
+    @classmethod
+    def _label_ids_first(cls, span, id_, feat):
+        return cls._label_both(span, id_, feat, spans_first=False)
 
-    def _next_label_both(self, ref_tok, feat, spans_first):
-        span = self._next_prediction(self.spans, ref_tok)
-        id_ = self._next_prediction(self.ids, ref_tok)
+    @staticmethod
+    def _label_both(span, id_, feat, spans_first):
         id_ = id_.split('-', 1)[1]  # strip leading I/O tag
         if span != 'O':
             if feat != NIL and (spans_first or id_ == NIL):
@@ -174,33 +852,278 @@ class PredictionMerger:
         label = f'{span}-{id_}'
         return label
 
-    def _next_prediction(self, pred, ref_tok):
+    def _next_prediction(self, ref_tok):
         try:
-            pred_tok, label = next(pred)
+            pred_tok, labels = next(self.predictions)
         except StopIteration:
             raise ValueError('predictions exhausted early!')
-        self._assert_same_token(ref_tok, pred_tok)
-        return label
+        exception = self._assert_same_token(ref_tok, pred_tok)
+        if exception is not None and self.metrics is not None:
+            self.metrics.counts[exception] += 1
+        return labels
 
     @staticmethod
     def _assert_same_token(ref_tok, pred_tok):
+        """Check alignment, returning the name of the exception taken."""
         if ref_tok == pred_tok:  # regular case
-            return
+            return None
         if pred_tok == '[UNK]':  # rare unknown token
-            return
+            return 'unk_tokens'
         if len(ref_tok) > 50 and ref_tok.startswith(pred_tok):  # long DNA seq.
-            return
+            return 'long_dna_tokens'
         raise ValueError(f'conflicting tokens: {ref_tok} vs. {pred_tok}')
 
 
-def _undo_wordpiece(token_path: Path, pred_path: Path, label_format: str
-                   ) -> Iterator[Tuple[str, str]]:
-    """Iterate over pairs <token, label>."""
-    ctrl_labels = _get_ctrl_labels(label_format)
-    with token_path.open(encoding='utf8') as t, pred_path.open() as l:
-        previous = None  # type: Tuple[str, str]
-        for token, label in _restore_truncated(t, l):
-            token, label = token.strip(), label.strip()
+class MultiPredictionMerger(PredictionMerger):
+    """Join predictions for multiple vocabularies over a shared token stream."""
+
+    def __init__(self, bert_tokens: Path,
+                 vocabularies: Iterable[Tuple[Path, Path, str]],
+                 sentences: Tuple[int, Optional[int]] = None):
+        self._setup(bert_tokens, vocabularies, sentences)
+
+    def iter_merge(self, ref_rows):
+        """Iterate over tuples of merged rows, one per vocabulary."""
+        for rows in ref_rows:
+            if not any(rows[0]):
+                yield [()] * len(rows)
+                continue
+            tok, start, end, _ = rows[0]
+            feats = [self._feature(row[3]) for row in rows]
+            labels = self._next_labels(tok, feats)
+            yield [(tok, start, end, label) for label in labels]
+
+
+class ArrayPredictionMerger(MultiPredictionMerger):
+    """
+    Vectorised variant of MultiPredictionMerger.
+
+    The BioBERT output is decoded in chunks of words with integer
+    label codes (see _iter_word_chunks()). For each document, the
+    OGER features are encoded as integers as well, and the merge
+    strategies are applied as array operations.
+    The results are only turned into strings for writing.
+    The output is identical to that of PredictionMerger.
+    """
+
+    _method_prefix = '_array_'
+
+    # Fixed codes in the tag/concept tables.
+    O, I = 0, 1
+    NIL, MISC = 0, 1
+    NO_CONCEPT = -1
+
+    @staticmethod
+    def _decode(*args):
+        return _iter_word_chunks(*args)
+
+    def _encoders(self, label_formats):
+        self._tags = LabelCodes(['O', 'I'])
+        self._concepts = LabelCodes([NIL, 'MISC'])
+        self._feature_codes = CachedCodes(self._concepts, self._feature)
+        self._strings = {}
+        self._label_codes = [LabelCodes() for _ in label_formats]
+        self._tables = [(np.empty(0, int), np.empty(0, int))
+                        for _ in label_formats]
+        # Words decoded ahead of the current document.
+        self._words = np.empty(0, dtype=object)
+        self._word_labels = np.empty((0, len(label_formats)), dtype=np.int64)
+        return self._label_codes
+
+    def close(self):
+        """Make sure all files are closed."""
+        if len(self._words) or next(self.predictions, None) is not None:
+            raise ValueError('left-over predictions!')
+
+    def iter_merge(self, ref_rows):
+        """Iterate over tuples of merged rows, one per vocabulary."""
+        rows = list(ref_rows)
+        is_content = list(map(any, map(itemgetter(0), rows)))
+        columns = list(zip(*it.compress(rows, is_content)))
+        if not columns:
+            yield from ([()] * len(row) for row in rows)
+            return
+        tokens, starts, ends, _ = zip(*columns[0])
+        ctrl = self._control_chars(tokens)
+        predictions = self._next_predictions(
+            np.array(tokens, dtype=object)[~ctrl])
+
+        labels = []
+        for (kernel, spans, ids), column in zip(self._strategies, columns):
+            feats = np.fromiter(
+                map(self._feature_codes.__getitem__,
+                    map(itemgetter(3), column)),
+                dtype=np.int64, count=len(column))
+            tags = np.full(len(column), self.O)
+            concepts = np.full(len(column), self.NIL)
+            tags[~ctrl], concepts[~ctrl] = kernel(
+                self._lookup(predictions, spans, tags=True),
+                self._lookup(predictions, ids, tags=False),
+                self._lookup(predictions, ids, tags=True),
+                feats[~ctrl])
+            labels.append(zip(tokens, starts, ends,
+                              self._to_strings(tags, concepts)))
+
+        # Put the blank rows between sentences back in.
+        merged = list(zip(*labels))
+        blank = ((),) * len(columns)
+        output, i = [], 0
+        for j in np.flatnonzero(np.logical_not(is_content)):
+            n = j - len(output)  # content rows before this blank
+            output.extend(merged[i:i+n])
+            output.append(blank)
+            i += n
+        output.extend(merged[i:])
+        yield from output
+
+    def _control_chars(self, tokens):
+        """Mask the tokens deleted by BERT's tokeniser."""
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64,
+                              count=len(tokens))
+        ctrl = np.zeros(len(tokens), dtype=bool)
+        single = np.flatnonzero(lengths == 1)
+        ctrl[single] = list(map(self._is_control_char,
+                                map(tokens.__getitem__, single)))
+        return ctrl
+
+    def _next_predictions(self, tokens):
+        """Take the label codes of the next words, checking alignment."""
+        n = len(tokens)
+        while len(self._words) < n:
+            try:
+                words, labels = next(self.predictions)
+            except StopIteration:
+                raise ValueError('predictions exhausted early!')
+            self._words = np.concatenate([self._words, words])
+            self._word_labels = np.concatenate([self._word_labels, labels])
+        words, self._words = self._words[:n], self._words[n:]
+        labels, self._word_labels = (self._word_labels[:n],
+                                     self._word_labels[n:])
+        for i in np.flatnonzero(tokens != words):
+            exception = self._assert_same_token(tokens[i], words[i])
+            if exception is not None and self.metrics is not None:
+                self.metrics.counts[exception] += 1
+        return labels
+
+    @classmethod
+    def _array_spans_alone(cls, span, _, __, ___):
+        # Dummy ID labels, as in _label_spans_alone().
+        return span, np.where(span == cls.O, cls.NIL, cls.MISC)
+
+    @classmethod
+    def _array_spans_only(cls, span, _, __, feat):
+        keep = (span != cls.O) & (feat != cls.NIL)
+        return np.where(keep, span, cls.O), np.where(keep, feat, cls.NIL)
+
+    @classmethod
+    def _array_ids_only(cls, _, __, label, ___):
+        return label, np.full_like(label, cls.NO_CONCEPT)
+
+    @classmethod
+    def _array_spans_first(cls, span, id_, _, feat):
+        return cls._array_both(span, id_, feat, spans_first=True)
+
+    @classmethod
+    def _array_ids_first(cls, span, id_, _, feat):
+        return cls._array_both(span, id_, feat, spans_first=False)
+
+    @classmethod
+    def _array_both(cls, span, id_, feat, spans_first):
+        # Same decisions as _label_both().
+        outside = span == cls.O
+        nil = id_ == cls.NIL
+        use_feat = ~outside & (feat != cls.NIL)
+        if not spans_first:
+            use_feat &= nil
+        tags = np.where(~outside & ~use_feat & nil, cls.O, span)
+        tags = np.where(outside & ~nil, cls.I, tags)
+        concepts = np.where(use_feat, feat, id_)
+        return tags, concepts
+
+    def _lookup(self, predictions, column, tags):
+        """
+        Map label codes to tag codes (full label) or concept codes.
+
+        The concept of an ID label is the part after the leading I/O tag.
+        """
+        if column is None:
+            return None
+        codes = self._label_codes[column]
+        if len(self._tables[column][0]) < len(codes):
+            # New labels were seen since the last update.
+            self._tables[column] = (
+                np.array([self._tags[label] for label in codes]),
+                np.array([self._concepts[label.split('-', 1)[1]]
+                          if '-' in label else self.NO_CONCEPT
+                          for label in codes]))
+        return self._tables[column][0 if tags else 1][predictions[:, column]]
+
+    def _to_strings(self, tags, concepts):
+        base = len(self._concepts) + 1
+        unique, inverse = np.unique(tags * base + concepts + 1,
+                                    return_inverse=True)
+        strings = np.array([self._label_string(*divmod(int(c), base))
+                            for c in unique], dtype=object)
+        return strings[inverse.ravel()].tolist()
+
+    def _label_string(self, tag, concept):
+        try:
+            return self._strings[tag, concept]
+        except KeyError:
+            label = self._tags.label(tag)
+            if concept:  # shifted by one: 0 means NO_CONCEPT
+                label = f'{label}-{self._concepts.label(concept-1)}'
+            self._strings[tag, concept] = label
+            return label
+
+
+class CachedCodes(dict):
+    """Map raw strings to the codes of their parsed form."""
+
+    def __init__(self, codes, parse):
+        super().__init__()
+        self._codes = codes
+        self._parse = parse
+
+    def __missing__(self, raw):
+        code = self[raw] = self._codes[self._parse(raw)]
+        return code
+
+
+class LabelCodes(dict):
+    """Assign consecutive integer codes to labels on first lookup."""
+
+    def __init__(self, labels=()):
+        super().__init__()
+        self._labels = []
+        for label in labels:
+            _ = self[label]
+
+    def __missing__(self, label):
+        code = self[label] = len(self._labels)
+        self._labels.append(label)
+        return code
+
+    def label(self, code):
+        """Look up a label by its code."""
+        return self._labels[code]
+
+
+def _undo_wordpiece(token_path: Path, pred_paths: Sequence[Path],
+                    label_formats: Sequence[str],
+                    sentences: Tuple[int, Optional[int]] = None,
+                    encoders: Sequence['LabelCodes'] = None
+                   ) -> Iterator[Tuple[str, tuple]]:
+    """
+    Iterate over pairs <token, labels>, with one label per pred path.
+
+    If encoders are given, the labels are replaced with integer codes.
+    """
+    with _open_predictions(token_path, pred_paths, label_formats,
+                           sentences, encoders) as (t, ls, outside):
+        previous = None  # type: Tuple[str, Tuple[str, ...]]
+        for token, labels in _restore_truncated(t, ls, outside):
+            token = token.strip()
             if token.startswith('##'):
                 # Merge word pieces.
                 token = previous[0] + token[2:]
@@ -215,25 +1138,164 @@ def _undo_wordpiece(token_path: Path, pred_path: Path, label_format: str
                     previous = None
                 else:
                     # Regular case.
-                    label = ctrl_labels.get(label, label)  # replace with 'O'
-                    previous = token, label
+                    previous = token, tuple(labels)
         if previous is not None:
             yield previous
+
+
+def _iter_word_chunks(token_path: Path, pred_paths: Sequence[Path],
+                      label_formats: Sequence[str],
+                      sentences: Tuple[int, Optional[int]] = None,
+                      encoders: Sequence['LabelCodes'] = None
+                     ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Iterate over chunks of words and their label codes.
+
+    Array counterpart of _undo_wordpiece(), decoding WORD_CHUNK_SIZE
+    lines at a time: the words are given as an object array, the
+    labels as an integer array with one column per pred path.
+    """
+    with _open_predictions(token_path, pred_paths, label_formats,
+                           sentences, encoders) as (t, ls, outside):
+        pieces, labels = [], np.empty((0, len(ls)), dtype=np.int64)
+        while True:
+            lines = list(it.islice(t, WORD_CHUNK_SIZE))
+            line_labels = [np.fromiter(it.islice(l, len(lines)), np.int64)
+                           for l in ls]
+            if any(len(l) != len(lines) for l in line_labels):
+                raise ValueError(
+                    f'unequal length: {token_path} {pred_paths}')
+            line_labels = np.stack(line_labels, axis=1)
+            # Space-separated lines hold a truncated sequence; as in
+            # _restore_truncated(), only the first token keeps its labels.
+            counts = np.fromiter(map(len, map(str.split, lines)), np.int64,
+                                 len(lines))
+            if (counts != 1).any():
+                line_labels = np.repeat(line_labels, counts, axis=0)
+                rest = np.ones(len(line_labels), dtype=bool)
+                rest[(np.cumsum(counts) - counts)[counts > 0]] = False
+                line_labels[rest] = outside
+            pieces.extend(''.join(lines).split())
+            labels = np.concatenate([labels, line_labels])
+
+            starts = np.flatnonzero(~np.fromiter(
+                map(methodcaller('startswith', '##'), pieces),
+                bool, len(pieces)))
+            done = len(lines) < WORD_CHUNK_SIZE
+            # Keep the last word for the next chunk, which
+            # might continue it (unless the input is exhausted).
+            end = len(pieces) if done else (starts[-1] if starts.size else 0)
+            starts = starts[starts < end]
+            if end and (not starts.size or starts[0] != 0):
+                raise ValueError(f'word piece without a word: {token_path}')
+            if starts.size:
+                words = '\n'.join(pieces[:end]).replace('\n##', '')
+                words = np.array(words.split('\n'), dtype=object)
+                keep = ~np.fromiter(map(CTRL_TOKENS.__contains__, words),
+                                    bool, len(words))
+                if keep.any():
+                    yield words[keep], labels[starts][keep]
+            pieces, labels = pieces[end:], labels[end:]
+            if done:
+                break
+
+
+@contextmanager
+def _open_predictions(token_path, pred_paths, label_formats, sentences,
+                      encoders):
+    """
+    Open the token and label files in parallel.
+
+    Yield the token lines, the label iterators and the outside
+    label of each pred path (encoded if encoders are given).
+    """
+    ctrl_labels = [_get_ctrl_labels(fmt) for fmt in label_formats]
+    outside = [ctrl['X'] for ctrl in ctrl_labels]
+    if encoders is not None:
+        outside = [codes[label] for codes, label in zip(encoders, outside)]
+    else:
+        encoders = [None] * len(pred_paths)
+    if sentences is None:
+        token_range = 0, None
+    else:
+        token_range = offsets.sentence_range(token_path, *sentences)
+    with ExitStack() as stack:
+        t = stack.enter_context(offsets.open_range(token_path, *token_range))
+        ls = [stack.enter_context(_open_labels(p, ctrl, token_path,
+                                               sentences, codes))
+              for p, ctrl, codes in zip(pred_paths, ctrl_labels, encoders)]
+        yield t, ls, outside
         # Sanity check: all file iterators must be exhausted.
-        if any(map(list, (t, l))):
-            raise ValueError(f'unequal length: {token_path} {pred_path}')
+        if any(map(list, (t, *ls))):
+            raise ValueError(f'unequal length: {token_path} {pred_paths}')
 
 
-def _restore_truncated(tokens, labels):
+def _restore_truncated(tokens, label_files, outside):
     """
     Handle space-separated lines in order to restore truncated sequences.
     """
-    for tok_line, label in zip(tokens, labels):
+    for tok_line, *labels in zip(tokens, *label_files):
         for token in tok_line.split():
-            yield token, label
+            yield token, labels
             # If there is more than one token on this line,
-            # unset the label for the non-first iteration.
-            label = 'X'
+            # unset the labels for the non-first iteration.
+            labels = outside
+
+
+@contextmanager
+def _open_labels(path, ctrl_labels, token_path, sentences, codes=None):
+    """
+    Iterate over labels from a text or binary (.npy) label file.
+
+    The control labels are replaced with 'O' already here.
+    If codes is given, labels are encoded as integers.
+    """
+    if path.suffix == '.npy':
+        yield _iter_binary_labels(path, ctrl_labels, sentences, codes)
+        return
+    if sentences is None:
+        label_range = 0, None
+    else:
+        label_range = offsets.sentence_range(path, *sentences, token_path)
+    with offsets.open_range(path, *label_range) as lines:
+        if codes is None:
+            yield (ctrl_labels.get(label, label)
+                   for label in map(str.strip, lines))
+        else:
+            # Parse every distinct line only once.
+            yield map(CachedCodes(codes, lambda line: ctrl_labels.get(
+                line.strip(), line.strip())).__getitem__, lines)
+
+
+def _iter_binary_labels(path, ctrl_labels, sentences, codes=None):
+    """
+    Read label IDs through a memory map and look up their labels.
+
+    The label IDs are stored in an .npy array, accompanied by a
+    label vocabulary (.vocab) and the number of labels per sentence
+    (.lengths.npy), as written by biobert_predict.py --binary_labels.
+    """
+    label_ids = np.load(path, mmap_mode='r')
+    lengths = np.load(path.with_suffix('.lengths.npy'))
+    with path.with_suffix('.vocab').open(encoding='utf8') as f:
+        vocab = [line.rstrip('\n') for line in f]
+    vocab = [ctrl_labels.get(label, label) for label in vocab]
+    if codes is None:
+        vocab = np.array(vocab, dtype=object)
+    else:
+        vocab = np.array([codes[label] for label in vocab], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    if (ends[-1] if ends.size else 0) != len(label_ids):
+        raise ValueError(f'inconsistent sentence lengths: {path}')
+    start, stop = 0, len(label_ids)
+    if sentences is not None:
+        first, last = sentences
+        start = int(ends[first-1]) if first else 0
+        if last is not None:
+            stop = int(ends[last-1]) if last else 0
+    for i in range(start, stop, BINARY_CHUNK_SIZE):
+        chunk = label_ids[i:min(i+BINARY_CHUNK_SIZE, stop)]
+        yield from vocab[chunk].tolist()
 
 
 def _get_ctrl_labels(label_format):
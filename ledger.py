@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Keep track of all PMIDs/PMCIDs seen by the pipeline.
+
+The ledger is an SQLite database which records the state of every ID:
+  - new: listed in an ID export, not processed yet
+  - processed: annotated by OGER (found in its output)
+  - failed: submitted to OGER, but missing from its output
+  - bad: failed repeatedly (or listed as bad), never submitted again
+and the run (eg. weekly update) in which it was first seen and last
+changed. Pending IDs (new or failed) are what the next run has to do.
+
+Subcommands:
+  add      register the IDs of an export and write the pending ones
+  record   mark submitted IDs as processed or failed, given OGER's output
+  bad      mark IDs as bad (eg. from the old bad_pmids.txt)
+  list     print IDs by state and/or run
+"""
+
+
+import re
+import sys
+import sqlite3
+import argparse
+import datetime
+import itertools as it
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import offsets
+
+
+LEDGER = Path(__file__).with_name('ids.sqlite')
+KINDS = ('pmid', 'pmcid')
+STATES = ('new', 'processed', 'failed', 'bad')
+MAX_ATTEMPTS = 3  # failed IDs become bad after this many attempts
+BATCH_SIZE = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    started TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ids (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    first_run INTEGER REFERENCES runs,
+    run INTEGER REFERENCES runs,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ids_state ON ids (kind, state);
+CREATE INDEX IF NOT EXISTS ids_first_run ON ids (kind, first_run);
+'''
+
+
+def main():
+    '''
+    Run as script.
+    '''
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawTextHelpFormatter)
+    ap.add_argument(
+        '-l', '--ledger', type=Path, default=LEDGER, metavar='PATH',
+        help='SQLite database (default: %(default)s)')
+    ap.add_argument(
+        '-k', '--kind', choices=KINDS, default='pmid',
+        help='type of IDs (default: %(default)s)')
+    ap.add_argument(
+        '-r', '--run', metavar='NAME',
+        help='name of the current run (default: today\'s date)')
+    sub = ap.add_subparsers(dest='command', required=True)
+    add = sub.add_parser('add', help='register IDs, write the pending ones')
+    add.add_argument('paths', nargs='+', type=Path, metavar='PATH',
+                     help='ID lists (one per line, or separated by commas)')
+    add.add_argument('-o', '--pending', type=Path, metavar='PATH',
+                     help='write the pending (new or failed) IDs here')
+    record = sub.add_parser('record', help='record the outcome of an OGER run')
+    record.add_argument('submitted', type=Path, metavar='IDS',
+                        help='ID list given to OGER')
+    record.add_argument('conll', nargs='+', type=Path, metavar='CONLL',
+                        help='OGER output (with "# doc_id" lines)')
+    bad = sub.add_parser('bad', help='mark IDs as bad')
+    bad.add_argument('paths', nargs='+', type=Path, metavar='PATH',
+                     help='ID lists (one per line, or separated by commas)')
+    list_ = sub.add_parser('list', help='print IDs')
+    list_.add_argument('-s', '--state', choices=STATES,
+                       help='only IDs in this state')
+    list_.add_argument('--since', metavar='NAME',
+                       help='only IDs first seen after this run')
+    args = ap.parse_args()
+
+    with Ledger(args.ledger) as ledger:
+        if args.command != 'list':
+            run = ledger.start_run(args.run)
+        if args.command == 'add':
+            ids = it.chain.from_iterable(map(read_ids, args.paths))
+            n = ledger.add(args.kind, ids, run)
+            print(f'{n} new {args.kind}s', file=sys.stderr)
+            if args.pending is not None:
+                write_ids(args.pending, ledger.pending(args.kind))
+        elif args.command == 'record':
+            processed, failed = ledger.record(
+                args.kind, read_ids(args.submitted),
+                it.chain.from_iterable(map(read_docids, args.conll)), run)
+            print(f'{processed} processed, {failed} failed', file=sys.stderr)
+        elif args.command == 'bad':
+            ids = it.chain.from_iterable(map(read_ids, args.paths))
+            ledger.mark(args.kind, ids, 'bad', run)
+        else:
+            ids = ledger.select(args.kind, args.state, args.since)
+            sys.stdout.writelines(f'{id_}\n' for id_ in ids)
+
+
+class Ledger:
+    """
+    SQLite-backed record of IDs and their processing state.
+
+    Use as a context manager; changes are committed on exit.
+    """
+
+    def __init__(self, path: Path = LEDGER):
+        self.conn = sqlite3.connect(str(path))
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.conn.close()
+
+    def start_run(self, name: str = None) -> int:
+        """Get the ID of a run, registering it if needed."""
+        if name is None:
+            name = datetime.date.today().isoformat()
+        self.conn.execute(
+            'INSERT OR IGNORE INTO runs (name, started) VALUES (?, ?)',
+            (name, datetime.datetime.now().isoformat(timespec='seconds')))
+        return self._run_id(name)
+
+    def add(self, kind: str, ids: Iterable[str], run: int) -> int:
+        """Register IDs as new, unless known already. Return the count."""
+        before = self.conn.total_changes
+        for batch in _batches(ids):
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO ids (kind, id, state, first_run, run) '
+                "VALUES (?, ?, 'new', ?, ?)",
+                ((kind, id_, run, run) for id_ in batch))
+        return self.conn.total_changes - before
+
+    def mark(self, kind: str, ids: Iterable[str], state: str, run: int):
+        """Set the state of IDs (registering unknown ones)."""
+        if state not in STATES:
+            raise ValueError(f'unknown state: {state}')
+        for batch in _batches(ids):
+            self.conn.executemany(
+                'INSERT INTO ids (kind, id, state, first_run, run) '
+                'VALUES (?, ?, ?, ?, ?) ON CONFLICT (kind, id) '
+                'DO UPDATE SET state = excluded.state, run = excluded.run',
+                ((kind, id_, state, run, run) for id_ in batch))
+
+    def record(self, kind: str, submitted: Iterable[str],
+               found: Iterable[str], run: int) -> tuple:
+        """
+        Record the outcome of processing the submitted IDs.
+
+        Submitted IDs among the found ones are processed, the others
+        failed; after MAX_ATTEMPTS failures, they are marked bad.
+        Return the number of processed and failed IDs.
+        """
+        submitted = set(submitted)
+        found = submitted.intersection(found)
+        failed = submitted - found
+        self.mark(kind, found, 'processed', run)
+        for batch in _batches(failed):
+            self.conn.executemany(
+                'INSERT INTO ids (kind, id, state, first_run, run, attempts) '
+                "VALUES (?, ?, 'failed', ?, ?, 1) ON CONFLICT (kind, id) "
+                'DO UPDATE SET run = excluded.run, attempts = attempts + 1, '
+                "state = CASE WHEN attempts + 1 >= ? THEN 'bad' "
+                "ELSE 'failed' END",
+                ((kind, id_, run, run, MAX_ATTEMPTS) for id_ in batch))
+        return len(found), len(failed)
+
+    def pending(self, kind: str) -> Iterator[str]:
+        """IDs that still need to be processed (new or failed)."""
+        return self._ids(
+            "SELECT id FROM ids WHERE kind = ? AND state IN ('new', 'failed') "
+            'ORDER BY id', kind)
+
+    def select(self, kind: str, state: str = None,
+               since: str = None) -> Iterator[str]:
+        """IDs in a given state and/or first seen after a given run."""
+        query, params = 'SELECT id FROM ids WHERE kind = ?', [kind]
+        if state is not None:
+            query += ' AND state = ?'
+            params.append(state)
+        if since is not None:
+            query += ' AND first_run > ?'
+            params.append(self._run_id(since))
+        return self._ids(query + ' ORDER BY id', *params)
+
+    def state(self, kind: str, id_: str) -> Optional[str]:
+        """The state of a single ID (None if unknown)."""
+        row = self.conn.execute(
+            'SELECT state FROM ids WHERE kind = ? AND id = ?',
+            (kind, id_)).fetchone()
+        return None if row is None else row[0]
+
+    def _ids(self, query, *params):
+        return (id_ for id_, in self.conn.execute(query, params))
+
+    def _run_id(self, name):
+        row = self.conn.execute(
+            'SELECT run FROM runs WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            raise ValueError(f'unknown run: {name}')
+        return row[0]
+
+
+def read_ids(path: Path) -> Iterator[str]:
+    """Read IDs separated by newlines and/or commas."""
+    with path.open(encoding='utf8') as f:
+        for line in f:
+            yield from filter(None, re.split(r'[,\s]+', line))
+
+
+def read_docids(path: Path) -> Iterator[str]:
+    """Get the document IDs of a CoNLL file."""
+    return (entry.docid for entry in offsets.doc_index(path))
+
+
+def write_ids(path: Path, ids: Iterable[str]):
+    """Write one ID per line."""
+    with path.open('w', encoding='utf8') as f:
+        f.writelines(f'{id_}\n' for id_ in ids)
+
+
+def _batches(ids):
+    ids = iter(ids)
+    while True:
+        batch = list(it.islice(ids, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Build and query sidecar offset indices for the harmonisation input files.
+
+For every indexed file, a TSV file with the same name plus ".idx"
+is stored next to it:
+  - OGER CoNLL files: one row <docid, byte offset, sentence> per document,
+    where "sentence" is the number of BioBERT input sequences (ie. [CLS]
+    lines in the .tokens file) preceding the document.
+  - BioBERT .tokens and .labels files: one row <line, byte offset> per
+    sentence, plus a final row pointing to the end of the file.
+The first line of each index records the size and modification time
+of the indexed file, which are used for detecting stale indices.
+"""
+
+
+import io
+import csv
+import bisect
+import argparse
+import itertools as it
+from pathlib import Path
+from contextlib import contextmanager
+from typing import List, Tuple, Iterator, Optional, NamedTuple
+
+
+TSV_FORMAT = dict(delimiter='\t', quotechar=None, lineterminator='\n')
+INDEX_SUFFIX = '.idx'
+MAX_WORDS = 30  # BioBERT input chunk size (see _read_data())
+
+
+class DocEntry(NamedTuple):
+    """Position of a document in a CoNLL file."""
+    docid: str
+    offset: int
+    sentence: int
+
+
+class SentEntry(NamedTuple):
+    """Position of a sentence in a .tokens/.labels file."""
+    line: int
+    offset: int
+
+
+def main():
+    '''
+    Run as script.
+    '''
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawTextHelpFormatter)
+    ap.add_argument(
+        'paths', nargs='+', type=Path, metavar='PATH',
+        help='CoNLL, .tokens or .labels files to index')
+    ap.add_argument(
+        '-b', '--bert-tokens', type=Path, metavar='PATH',
+        help='input file containing BERT tokens\n'
+             '(required for indexing .labels files)')
+    args = ap.parse_args()
+    for path in args.paths:
+        if path.suffix == '.conll':
+            doc_index(path, rebuild=True)
+        elif path.suffix == '.labels':
+            if args.bert_tokens is None:
+                ap.error(f'{path}: -b/--bert-tokens is required')
+            sentence_index(path, args.bert_tokens, rebuild=True)
+        else:
+            sentence_index(path, rebuild=True)
+
+
+def index_path(path: Path) -> Path:
+    """Location of the sidecar index for this file."""
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+def doc_index(path: Path, rebuild: bool = False) -> List[DocEntry]:
+    """Load the document index of a CoNLL file, building it if needed."""
+    rows = None if rebuild else _load(path)
+    if rows is None:
+        rows = list(_scan_docs(path))
+        _dump(path, rows)
+    return [DocEntry(docid, int(offset), int(sentence))
+            for docid, offset, sentence in rows]
+
+
+def sentence_index(path: Path, token_path: Path = None,
+                   rebuild: bool = False) -> List[SentEntry]:
+    """
+    Load the sentence index of a .tokens/.labels file, building it if needed.
+
+    Label files have no sentence delimiters, therefore indexing
+    them requires the corresponding token file.
+    """
+    rows = None if rebuild else _load(path)
+    if rows is None:
+        if token_path is None or token_path == path:
+            rows = list(_scan_sentences(path))
+        else:
+            lines = [e.line for e in sentence_index(token_path)]
+            rows = list(_scan_lines(path, lines))
+        _dump(path, rows)
+    return [SentEntry(int(line), int(offset)) for line, offset in rows]
+
+
+def locate_docs(path: Path, start: str = None, stop: str = None
+               ) -> Tuple[int, int, Optional[int]]:
+    """
+    Find the document range [start, stop) in a CoNLL file.
+
+    Documents are identified by the first occurrence of their ID.
+    None means the beginning and end of the file, respectively.
+
+    Return the byte offset of the start document and the sentence
+    range <first, last>, where last is None for the end of the file.
+    """
+    return locate_positions(path, *doc_positions(path, start, stop))
+
+
+def doc_positions(path: Path, start: str = None, stop: str = None
+                 ) -> Tuple[int, int]:
+    """
+    Find the index positions <i, j> of the document range [start, stop).
+    """
+    docs = doc_index(path)
+    positions = _first_positions(docs)
+    try:
+        i = positions[start] if start is not None else 0
+        j = positions[stop] if stop is not None else len(docs)
+    except KeyError as e:
+        raise ValueError(f'{path}: unknown document: {e}')
+    if i >= j:
+        raise ValueError(f'{path}: empty range: {start}..{stop}')
+    return i, j
+
+
+def locate_positions(path: Path, i: int, j: int
+                    ) -> Tuple[int, int, Optional[int]]:
+    """
+    Find the documents at the index positions [i, j) in a CoNLL file.
+
+    Return the same as locate_docs().
+    """
+    docs = doc_index(path)
+    last = docs[j].sentence if j < len(docs) else None
+    return docs[i].offset, docs[i].sentence, last
+
+
+def split_docs(path: Path, n: int, start: str = None, stop: str = None
+              ) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Split the document range [start, stop) into up to n contiguous shards.
+
+    The shards are balanced by number of sentences.
+    Return a list of <start, stop> document IDs.
+    """
+    docs = doc_index(path)
+    positions = _first_positions(docs)
+    i = positions[start] if start is not None else 0
+    j = positions[stop] if stop is not None else len(docs)
+    # Only the first occurrence of a (duplicate) ID can be a boundary.
+    candidates = [k for k in range(i+1, j) if positions[docs[k].docid] == k]
+    bounds = [start]
+    if candidates:
+        first = docs[i].sentence
+        last = docs[j].sentence if j < len(docs) else docs[-1].sentence
+        sentences = [docs[k].sentence for k in candidates]
+        for s in range(1, n):
+            target = first + (last-first) * s / n
+            k = bisect.bisect_left(sentences, target, hi=len(sentences)-1)
+            docid = docs[candidates[k]].docid
+            if docid != bounds[-1]:
+                bounds.append(docid)
+    bounds.append(stop)
+    return list(zip(bounds, bounds[1:]))
+
+
+def sentence_range(path: Path, start: int, stop: Optional[int],
+                   token_path: Path = None) -> Tuple[int, int]:
+    """
+    Find the sentence range [start, stop) in a .tokens/.labels file.
+
+    Return the byte offset and the number of lines.
+    """
+    index = sentence_index(path, token_path)
+    first, last = index[start], index[stop if stop is not None else -1]
+    return first.offset, last.line - first.line
+
+
+@contextmanager
+def open_range(path: Path, offset: int = 0, n_lines: int = None
+              ) -> Iterator[Iterator[str]]:
+    """Open a text file for reading n lines from a given byte offset."""
+    with path.open('rb') as f:
+        f.seek(offset)
+        lines = io.TextIOWrapper(f, encoding='utf8')
+        if n_lines is not None:
+            lines = it.islice(lines, n_lines)
+        yield lines
+
+
+def _first_positions(docs):
+    positions = {}
+    for i, entry in enumerate(docs):
+        positions.setdefault(entry.docid, i)
+    return positions
+
+
+def _scan_docs(path):
+    sentences, words = 0, 0
+    offset = 0
+    with path.open('rb') as f:
+        for line in f:
+            if line.startswith(b'# doc_id ='):
+                if words:
+                    raise ValueError(f'{path}: no blank line before {line}')
+                docid = line.split(b'=', 1)[1].strip().decode('utf8')
+                yield docid, offset, sentences
+            elif line.strip():
+                words += 1
+            elif words:
+                sentences += -(-words // MAX_WORDS)  # ceiling division
+                words = 0
+            offset += len(line)
+
+
+def _scan_sentences(path):
+    offset = 0
+    n = -1
+    with path.open('rb') as f:
+        for n, line in enumerate(f):
+            if line.strip() == b'[CLS]':
+                yield n, offset
+            offset += len(line)
+    yield n+1, offset
+
+
+def _scan_lines(path, lines):
+    targets = iter(lines)
+    target = next(targets)
+    offset = 0
+    with path.open('rb') as f:
+        for n, line in enumerate(it.chain(f, [b''])):
+            if n == target:
+                yield n, offset
+                target = next(targets, None)
+            offset += len(line)
+    if target is not None:
+        raise ValueError(f'unequal length: {path}')
+
+
+def _load(path):
+    try:
+        f = index_path(path).open(encoding='utf8')
+    except FileNotFoundError:
+        return None
+    with f:
+        header = next(f, '')
+        if header != _header(path):
+            return None  # stale index
+        return list(csv.reader(f, **TSV_FORMAT))
+
+
+def _dump(path, rows):
+    with index_path(path).open('w', encoding='utf8') as f:
+        f.write(_header(path))
+        csv.writer(f, **TSV_FORMAT).writerows(rows)
+
+
+def _header(path):
+    stat = path.stat()
+    return f'# size = {stat.st_size}, mtime = {stat.st_mtime_ns}\n'
+
+
+if __name__ == '__main__':
+    main()
@@ -9,16 +9,38 @@ Postfilter for merging external annotations in CoNLL format.
 """
 
 
+import os
 import re
+import sys
+import io
 import csv
+import queue
+import time
+import sqlite3
 import logging
+import operator
+import threading
+import functools
+import contextlib
+import collections
+import configparser
+import itertools as it
+import multiprocessing as mp
 from pathlib import Path
 
 from oger.ctrl.router import PipelineServer, Router
 from oger.doc.document import Entity
+from oger.doc.conll import fix_tag, OUTSIDE, INSIDE, BEGIN
+from oger.post import badFP
 from oger.util.misc import tsv_format
 from oger.util.stream import ropen
 
+# harmonise.py, offsets.py and telemetry.py live in the parent directory.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import harmonise
+import offsets
+import telemetry
+
 
 # The postfilters don't have access to the Router object of the main program,
 # so it gets its own instance.
@@ -28,42 +50,471 @@ SERVER = PipelineServer(ROUTER, lazy=True)
 # All types used here (CL, MOP, SO, UBERON) use the same URI prefix.
 URI_PREFIX = 'http://purl.obolibrary.org/obo/'
 
+# Compiled lookup table for the termlists (see _terminology_index()).
+TERMINOLOGY_INDEX = Path(__file__).with_suffix('.terminology.sqlite')
+LOOKUP_CACHE_SIZE = 1 << 16
+
+# Number of documents parsed ahead per external file in merge_stream.
+READ_AHEAD = 16
+
+# Number of documents per task when merge runs in parallel.
+MERGE_CHUNK_SIZE = 200
+
+# Same order as Entity.sort_key, but faster.
+ENTITY_ORDER = operator.attrgetter('start', 'end')
+
+
+def _recorded(postfilter):
+    """Report the time spent and the documents/entities kept."""
+    @functools.wraps(postfilter)
+    def _postfilter(collection):
+        with telemetry.Stage(postfilter.__name__) as items:
+            postfilter(collection)
+            for doc in collection:
+                _count(doc, items)
+    return _postfilter
+
+
+def _count(doc, items):
+    items['documents'] += 1
+    for sent in doc.get_subelements('Sentence'):
+        items['sentences'] += 1
+        items['entities'] += len(sent.entities)
 
+
+@_recorded
 def merge(collection):
     """Include external annotations."""
-    external = [SERVER.iter_load(str(path), 'conll')
-                for path in Path(ROUTER.p.input_directory).glob('*.conll')]
-    if not external:
+    paths = _external_paths()
+    if not paths:
         logging.warning('%s: no external annotations found', collection.id_)
         return
-    logging.info('%s: merging annotations from %d collections',
-                 collection.id_, len(external))
+    settings = _merge_settings()
+    logging.info('%s: merging annotations from %d collections '
+                 '(%d workers)', collection.id_, len(paths),
+                 settings['workers'])
+
+    # Look up the external docs by ID, so they might be out of order.
+    locations = _external_locations(collection.id_, paths)
+    docids = {d.id_: d for d in collection}
+    for id_ in locations:
+        if id_ not in docids:
+            logging.error('%s: missing document: %s', collection.id_, id_)
+            raise ValueError('missing document')
+
+    docs = [d for id_, d in docids.items() if id_ in locations]
+    for doc, ext in _iter_with_external(docs, paths, locations, settings):
+        _merge_document(collection.id_, doc, ext)
+
+    # Sanity check: were all IDs used?
+    for id_ in docids:
+        if id_ not in locations:
+            logging.warning('%s: unmerged document: %s', collection.id_, id_)
+
+
+@_recorded
+def filter_chain(collection):
+    """
+    Run all postfilters in a single pass over the collection.
+
+    Same as delete_duplicate_docs, delete_empty_docs, merge, frequentFP
+    and remove_sametype_submatches in sequence, but each document goes
+    through the whole chain before the next one, and dropped documents
+    are never merged. The entity filters are applied while merging
+    (see _filter_entities()), which also collapses exact duplicates.
+    The time spent and the number of documents or entities removed
+    are logged for each filter.
+    """
+    stats = _FilterStats(collection.id_)
+    paths = _external_paths()
+    if not paths:
+        logging.warning('%s: no external annotations found', collection.id_)
+    settings = _merge_settings()
+    locations = _external_locations(collection.id_, paths)
+    last = {d.id_: i for i, d in enumerate(collection)}
+
+    def select():
+        for i, doc in enumerate(collection):
+            with stats.timed('delete_duplicate_docs'):
+                if last[doc.id_] != i:
+                    stats.counts['delete_duplicate_docs'] += 1
+                    continue
+            with stats.timed('delete_empty_docs'):
+                if not any(doc.get_subelements('Sentence')):
+                    stats.counts['delete_empty_docs'] += 1
+                    continue
+            yield doc
+
+    kept = []
+    merged = _iter_with_external(select(), paths, locations, settings,
+                                 timer=functools.partial(stats.timed, 'merge'))
+    sweep = functools.partial(_filter_entities, counts=stats.counts)
+    for doc, ext in merged:
+        if ext is None:
+            if paths:
+                logging.warning('%s: unmerged document: %s',
+                                collection.id_, doc.id_)
+                stats.counts['merge'] += 1
+            ext = ()
+        with stats.timed('merge'):
+            _merge_document(collection.id_, doc, ext, sweep)
+        kept.append(doc)
+
+    # Sanity check: were all external docs used?
+    kept_ids = set(d.id_ for d in kept)
+    for id_ in locations:
+        if id_ not in kept_ids:
+            logging.error('%s: missing document: %s', collection.id_, id_)
+            raise ValueError('missing document')
+
+    collection.subelements[:] = kept
+    stats.log()
+
+
+class _FilterStats:
+    """Timing and drop counts for the filters of filter_chain()."""
+
+    filters = {
+        'delete_duplicate_docs': 'documents removed',
+        'delete_empty_docs': 'documents removed',
+        'merge': 'documents unmerged',
+        'frequentFP': 'entities removed',
+        'remove_sametype_submatches': 'entities removed',
+        'remove_duplicate_entities': 'entities removed',
+    }
+    # The entity filters run inside merge and are timed with it.
+    timed_filters = ('delete_duplicate_docs', 'delete_empty_docs', 'merge')
+
+    def __init__(self, collection_id):
+        self.collection_id = collection_id
+        self.seconds = dict.fromkeys(self.timed_filters, 0.)
+        self.counts = dict.fromkeys(self.filters, 0)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Add the time spent in this block to a filter."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def log(self):
+        """Report the figures for each filter."""
+        for name, what in self.filters.items():
+            if name in self.seconds:
+                logging.info('%s: %s: %.2fs, %d %s',
+                             self.collection_id, name, self.seconds[name],
+                             self.counts[name], what)
+            else:
+                logging.info('%s: %s: %d %s', self.collection_id, name,
+                             self.counts[name], what)
+
+
+def _iter_with_external(docs, paths, locations, settings,
+                        timer=contextlib.nullcontext):
+    """
+    Pair documents with their external annotations.
+
+    The external files are read ahead in chunks of documents, in a
+    process pool if configured. Docs without external annotations
+    are paired with None. Reading (or waiting for) the external
+    annotations is timed with the timer context manager.
+    """
+    with contextlib.ExitStack() as stack:
+        if settings['workers'] > 1:
+            pool = stack.enter_context(mp.Pool(settings['workers']))
+            def read(task):
+                return pool.apply_async(_read_external, (task,)).get
+        else:
+            def read(task):
+                return functools.partial(_read_external, task)
+        pending = collections.deque()
+        docs = iter(docs)
+        while True:
+            chunk = list(it.islice(docs, settings['chunk_size']))
+            if chunk:
+                todo = [(d.id_, locations[d.id_])
+                        for d in chunk if d.id_ in locations]
+                pending.append((chunk, read((paths, todo))))
+            if pending and (not chunk or len(pending) > settings['workers']):
+                chunk_docs, result = pending.popleft()
+                with timer():
+                    ext = dict(result())
+                for doc in chunk_docs:
+                    yield doc, ext.get(doc.id_)
+            elif not chunk:
+                break
+
+
+def _external_locations(collection_id, paths):
+    """
+    Map each document ID to its byte range in every external file.
+
+    The ranges are taken from the offset indices (see offsets.py).
+    """
+    locations = {}
+    for n, path in enumerate(paths):
+        entries = offsets.doc_index(path)
+        ends = [e.offset for e in entries[1:]] + [path.stat().st_size]
+        for entry, end in zip(entries, ends):
+            ranges = locations.setdefault(entry.docid, [])
+            if len(ranges) > n:
+                logging.warning('%s: duplicate document in %s: %s',
+                                collection_id, path.name, entry.docid)
+            elif len(ranges) < n:
+                continue  # missing from a previous file
+            else:
+                ranges.append((entry.offset, end-entry.offset))
+    for id_, ranges in locations.items():
+        if len(ranges) < len(paths):
+            logging.error('%s: inconsistent IDs: %s not in %s',
+                          collection_id, id_, paths[len(ranges)].name)
+            raise ValueError('inconsistent IDs')
+    return locations
+
+
+def _read_external(chunk):
+    """Parse a chunk of documents from all external files."""
+    paths, todo = chunk
+    docs = []
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(path.open('rb')) for path in paths]
+        for id_, ranges in todo:
+            ext = []
+            for f, (offset, length) in zip(files, ranges):
+                f.seek(offset)
+                text = io.StringIO(f.read(length).decode('utf8'))
+                ext.append(_Annotations(*SERVER.iter_load(text, 'conll')))
+            docs.append((id_, ext))
+    return docs
+
+
+class _Annotations:
+    """Picklable stand-in for an external document."""
+    def __init__(self, doc):
+        self.id_ = doc.id_
+        self.sentences = [_Sentence(s.start, s.text, s.entities)
+                          for s in doc.get_subelements('Sentence')]
+
+    def get_subelements(self, _):
+        return iter(self.sentences)
+
+
+_Sentence = collections.namedtuple('_Sentence', 'start text entities')
+
+
+class StreamMerger:
+    """
+    Postfilter for merging external annotations in a streaming fashion.
+
+    Unlike merge(), this can be called repeatedly with consecutive parts
+    of the collection (eg. a single document at a time, as done by
+    stream_merge.py). Each external CoNLL file is parsed on a separate
+    thread, and only a few documents are held in memory at a time.
+    Base and external documents must come in the same order.
+    Call close() after the last document for the final sanity check.
+    """
+
+    def __init__(self, queue_size=READ_AHEAD):
+        self.queue_size = queue_size
+        self._external = None
+        self._known = None
+        self._merged = set()
+        self._stage = telemetry.Stage('merge_stream')
 
-    # Align collections doc by doc. External docs might be out of order.
+    def __call__(self, collection):
+        if self._external is None:
+            self._stage.start()
+            self._open(collection.id_)
+        for doc in collection:
+            if doc.id_ not in self._known or doc.id_ in self._merged:
+                logging.warning('%s: unmerged document: %s',
+                                collection.id_, doc.id_)
+                continue
+            ext = next(self._external, None)
+            if ext is None or ext[0].id_ != doc.id_:
+                # The external docs before this one are missing from the base.
+                missing = doc.id_ if ext is None else ext[0].id_
+                logging.error('%s: missing document: %s',
+                              collection.id_, missing)
+                raise ValueError('missing document')
+            _merge_document(collection.id_, doc, ext)
+            self._merged.add(doc.id_)
+            _count(doc, self._stage.items)
+
+    def _open(self, collection_id):
+        paths = _external_paths()
+        if not paths:
+            logging.warning('%s: no external annotations found',
+                            collection_id)
+            self._external, self._known = iter(()), set()
+            return
+        logging.info('%s: streaming annotations from %d collections',
+                     collection_id, len(paths))
+        # The offset index gives all IDs without parsing the documents.
+        self._known = set(e.docid for e in offsets.doc_index(paths[0]))
+        readers = [_read_ahead(SERVER.iter_load(str(path), 'conll'),
+                               self.queue_size)
+                   for path in paths]
+        self._external = zip(*readers)
+
+    def close(self):
+        """Make sure all external documents were merged."""
+        if self._external is None:
+            return
+        leftover = next(self._external, None)
+        self._stage.stop(failed=leftover is not None)
+        if leftover is not None:
+            logging.error('missing document: %s', leftover[0].id_)
+            raise ValueError('missing document')
+
+
+merge_stream = StreamMerger()
+
+
+def _external_paths():
+    return sorted(Path(ROUTER.p.input_directory).glob('*.conll'))
+
+
+def _read_ahead(iterable, size):
+    """Consume an iterable on a separate thread, buffering some items."""
+    buffer = queue.Queue(maxsize=size)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except BaseException as e:
+            buffer.put(e)
+        else:
+            buffer.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def _merge_document(collection_id, doc, ext, sweep=None):
+    """
+    Add the entities of the external docs to the base doc.
+
+    Each external entity list is sorted already, so sorting their
+    concatenation amounts to a k-way merge of these runs (Timsort
+    detects and merges them in C, which is faster than heapq.merge).
+    The optional sweep function is applied to the merged list.
+    """
+    if any(e.id_ != doc.id_ for e in ext):
+        logging.error('%s: inconsistent IDs: %s',
+                      collection_id, [d.id_ for d in (doc, *ext)])
+        raise ValueError('inconsistent IDs')
+
+    # Align sentences. They must all be in the same order, but differences
+    # are allowed wrt. sectioning and spacing.
+    sentences = (d.get_subelements('Sentence') for d in (doc, *ext))
+    for sent, *ext_sent in zip(*sentences):
+        for e in ext_sent:
+            if e.start != sent.start and _diff_no_ws(e.text, sent.text):
+                logging.error("%s, %s: sentence text doesn't match:\n%a\n%a",
+                              collection_id, doc.id_, sent.text, e.text)
+                raise ValueError('sentence mismatch')
+        runs = [sent.entities,
+                *(map(_restore_annotation, e.entities) for e in ext_sent)]
+        entities = sorted(it.chain.from_iterable(runs), key=ENTITY_ORDER)
+        if sweep is not None:
+            entities = sweep(entities)
+        sent.entities = entities
+
+
+def _filter_entities(entities, counts):
+    """
+    Remove bad, duplicate and same-type contained entities in one sweep.
+
+    The entities must be sorted by offsets. The result is the same
+    as with frequentFP followed by remove_sametype_submatches, except
+    that exact duplicates (same offsets and info) are collapsed.
+    For each entity type, the sweep keeps the current reference interval
+    and the entities with exactly these offsets. Since the entities are
+    sorted, a later entity is either contained in the reference, starts
+    at the same offset (and contains it or has the same offsets), or
+    begins a new reference.
+    """
+    by_type = {}  # entity type -> [kept entities, ref start, ref end, ref n]
+    is_bad = _is_bad
+    for e in entities:
+        if is_bad(e.text):
+            counts['frequentFP'] += 1
+            continue
+        start, end = e.start, e.end
+        state = by_type.get(e.info[0])
+        if state is None:
+            by_type[e.info[0]] = [[e], start, end, 1]
+            continue
+        kept, ref_start, ref_end, n = state
+        if end < ref_end or (end == ref_end and start > ref_start):
+            counts['remove_sametype_submatches'] += 1
+            continue
+        if start == ref_start:
+            if end > ref_end:
+                # Contains the reference group: replace it.
+                del kept[-n:]
+                counts['remove_sametype_submatches'] += n
+                state[2:] = end, 1
+            elif any(other.info == e.info for other in kept[-n:]):
+                counts['remove_duplicate_entities'] += 1
+                continue
+            else:
+                state[3] += 1
+        else:
+            state[1:] = start, end, 1
+        kept.append(e)
+
+    # Merge the per-type runs, like remove_sametype_submatches does.
+    runs = (state[0] for state in by_type.values())
+    return sorted(it.chain.from_iterable(runs), key=ENTITY_ORDER)
+
+
+# The same terms are found over and over again.
+_is_bad = functools.lru_cache(maxsize=LOOKUP_CACHE_SIZE)(badFP.is_bad)
+
+
+@_recorded
+def harmonise_merge(collection):
+    """
+    Harmonise OGER/BioBERT predictions and include them directly.
+
+    This replaces running harmonise.py and then merge(): the entities
+    of all vocabularies are attached to the collection's sentences
+    without writing and re-reading intermediate CoNLL files.
+    """
+    settings = _harmonise_settings()
+    logging.info('%s: harmonising annotations for %d vocabularies',
+                 collection.id_, len(settings['vocabularies']))
+    ids = [it.count(1) for _ in settings['vocabularies']]
     docids = {d.id_: d for d in collection}
-    print([path for path in Path(ROUTER.p.input_directory).glob('*.conll')])
-    for ext in zip(*external):
-        docid = ext[0].id_
+    for docid, rows in harmonise.iter_harmonised(**settings):
         try:
             doc = docids.pop(docid)
         except KeyError:
             logging.error('%s: missing document: %s', collection.id_, docid)
             raise ValueError('missing document')
-        if any(e.id_ != docid for e in ext):
-            logging.error('%s: inconsistent IDs: %s',
-                          collection.id_, [d.id_ for d in (doc, *ext)])
-            raise ValueError('inconsistent IDs')
 
-        # Align sentences. They must all be in the same order, but differences
-        # are allowed wrt. sectioning and spacing.
-        sentences = (d.get_subelements('Sentence') for d in (doc, *ext))
-        for sent, *ext_sent in zip(*sentences):
-            for e in ext_sent:
-                if e.start != sent.start and _diff_no_ws(e.text, sent.text):
-                    logging.error("%s, %s: sentence text doesn't match:\n%a\n%a",
-                                  collection.id_, doc.id_, sent.text, e.text)
-                    raise ValueError('sentence mismatch')
-                sent.entities.extend(map(_restore_annotation, e.entities))
+        sentences = doc.get_subelements('Sentence')
+        for text, start, entities in _iter_harmonised_sentences(rows, ids):
+            sent = next(sentences, None)
+            if sent is None or (start != sent.start
+                                and _diff_no_ws(text, sent.text)):
+                logging.error("%s, %s: sentence text doesn't match:\n%a\n%a",
+                              collection.id_, doc.id_,
+                              getattr(sent, 'text', None), text)
+                raise ValueError('sentence mismatch')
+            sent.entities.extend(entities)
             sent.entities.sort(key=Entity.sort_key)
 
     # Sanity check: were all IDs used?
@@ -71,13 +522,92 @@ def merge(collection):
         logging.warning('%s: unmerged document: %s', collection.id_, id_)
 
 
+def _merge_settings():
+    """Read the (optional) [Merge] section of the postfilter settings."""
+    parser = _read_settings()
+    section = parser['Merge'] if parser.has_section('Merge') else {}
+    return dict(
+        workers=int(section.get('workers', 1)),
+        chunk_size=int(section.get('chunk-size', MERGE_CHUNK_SIZE)),
+    )
+
+
+def _harmonise_settings():
+    """Read the [Harmonise] section of the postfilter settings."""
+    section = _read_settings()['Harmonise']
+    vocabularies = dict(v.split('=') for v in section['vocabularies'].split())
+
+    def paths(key):
+        template = section.get(key)
+        return [Path(template.format(v)) if template else None
+                for v in vocabularies]
+
+    return dict(
+        vocabularies=vocabularies,
+        oger_preds=paths('oger-pred'),
+        bert_tokens=Path(section['bert-tokens']),
+        span_preds=paths('span-pred'),
+        id_preds=paths('id-pred'),
+        engine=section.get('engine', 'python'),
+    )
+
+
+def _read_settings():
+    parser = configparser.ConfigParser(
+        interpolation=configparser.ExtendedInterpolation())
+    parser.read(Path(__file__).with_suffix('.ini'))
+    return parser
+
+
+def _iter_harmonised_sentences(rows, ids):
+    """Convert harmonised rows to sentences with restored entities."""
+    for non_blank, sent_rows in it.groupby(rows, key=lambda r: any(r[0])):
+        if non_blank:
+            yield _harmonised_sentence(sent_rows, ids)
+
+
+def _harmonised_sentence(rows, ids):
+    # Same logic as oger.doc.conll.CoNLLLoader, for all vocabularies at once.
+    text, spans = [], [[] for _ in ids]
+    first_start, last_end = None, None
+    last_tags = [(OUTSIDE[0], None)] * len(ids)
+    for row_tuple in rows:
+        token, start, end, _ = row_tuple[0]
+        start, end = int(start), int(end)
+        if last_end is None:
+            first_start = start
+        elif start > last_end:
+            text.append(' ' * (start-last_end))
+        text.append(token)
+        last_end = end
+
+        for i, (*_, tag) in enumerate(row_tuple):
+            tag, label = last_tags[i] = fix_tag(tag, last_tags[i])
+            if tag in BEGIN:
+                spans[i].append([label, start, end])
+            elif tag in INSIDE:
+                spans[i][-1][2] = end
+
+    text = ''.join(text)
+    n_fields = len(ROUTER.entity_fields)
+    entities = []
+    for vocab_ids, vocab_spans in zip(ids, spans):
+        for cid, start, end in vocab_spans:
+            info = ('unknown', 'unknown', 'unknown', cid,
+                    *['unknown'] * (n_fields-4))
+            term = text[start-first_start:end-first_start]
+            entity = Entity(next(vocab_ids), term, start, end, info)
+            entities.append(_restore_annotation(entity))
+    return text, first_start, entities
+
+
 def _diff_no_ws(a, b):
     """Strings differ even after stripping and unifying whitespace."""
     a, b = (re.sub(r'\s', ' ', s).strip() for s in (a, b))
     return a != b
 
 
-def _restore_annotation(entity, terminology={}):
+def _restore_annotation(entity):
     """
     Restore missing information for this annotation.
 
@@ -86,24 +616,85 @@ def _restore_annotation(entity, terminology={}):
     - Add the ontology symbol (not used).
     - Add a prefix to the ID to make it a URI.
     """
-    if not terminology:  # hack alert: default-arg caching trick
-        _read_terminology(terminology)
-    type_, pref, db = terminology[entity.cid]
+    type_, pref, db = _lookup_concept(entity.cid)
     # uri = URI_PREFIX + entity.cid.replace(':', '_')
     uri = entity.cid
     entity.info = (type_, pref, db, uri, *entity.info[4:])
     return entity
 
 
-def _read_terminology(destination):
+@functools.lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def _lookup_concept(cid):
+    """Get <type, pref, db> from the compiled terminology index."""
+    row = _terminology_index(os.getpid()).execute(
+        'SELECT type, pref, db FROM concepts WHERE cid = ?', (cid,)
+    ).fetchone()
+    if row is None:
+        raise KeyError(cid)
+    return row
+
+
+@functools.lru_cache(maxsize=None)
+def _terminology_index(pid):
+    """
+    Open the compiled terminology index, (re)building it if needed.
+
+    There is one connection per process ID, since SQLite connections
+    must not be shared with forked processes.
+
+    The index is an SQLite database next to this script. It records
+    the path, size and mtime of each termlist it was compiled from;
+    if any of these differ from the configured termlists, it is rebuilt.
+    """
+    sources = sorted(_source_stamp(params.path)
+                     for params in ROUTER.p.recognizers)
+    try:
+        conn = sqlite3.connect(f'file:{TERMINOLOGY_INDEX}?mode=ro', uri=True)
+        indexed = sorted(conn.execute(
+            'SELECT path, size, mtime_ns FROM sources'))
+    except sqlite3.Error:
+        indexed = None
+    if indexed != sources:
+        if indexed is not None:
+            conn.close()
+        _compile_terminology(sources)
+        conn = sqlite3.connect(f'file:{TERMINOLOGY_INDEX}?mode=ro', uri=True)
+    return conn
+
+
+def _source_stamp(path):
+    stat = Path(path).stat()
+    return str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns
+
+
+def _compile_terminology(sources):
+    """Build the terminology index in a temporary file, then replace it."""
+    tmp = TERMINOLOGY_INDEX.with_name(
+        f'{TERMINOLOGY_INDEX.name}.{os.getpid()}.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    conn = sqlite3.connect(str(tmp))
+    with conn:
+        conn.execute('CREATE TABLE sources '
+                     '(path TEXT, size INTEGER, mtime_ns INTEGER)')
+        conn.execute('CREATE TABLE concepts (cid TEXT PRIMARY KEY, '
+                     'type TEXT, pref TEXT, db TEXT) WITHOUT ROWID')
+        conn.executemany('INSERT INTO sources VALUES (?, ?, ?)', sources)
+        for path, _, _ in sources:
+            logging.info('compiling external terminology: %s', path)
+            conn.executemany('INSERT OR REPLACE INTO concepts VALUES '
+                             '(?, ?, ?, ?)', _read_terminology(path))
+    conn.close()
+    tmp.replace(TERMINOLOGY_INDEX)
+
+
+def _read_terminology(path):
     # Note: assume BTH format without header
-    for params in ROUTER.p.recognizers:
-        logging.info('loading external terminology: %s', params.path)
-        with ropen(params.path, encoding='utf8', newline='') as f:
-            rows = csv.reader(f, **tsv_format)
-            for _, db, cid, _, pref, type_ in rows:
-                type_ = type_.replace('/', '_')
-                destination[cid] = type_, pref, db
+    with ropen(path, encoding='utf8', newline='') as f:
+        rows = csv.reader(f, **tsv_format)
+        for _, db, cid, _, pref, type_ in rows:
+            type_ = type_.replace('/', '_')
+            yield cid, type_, pref, db
 
 
 def delete_duplicate_docs(collection):
@@ -122,12 +713,11 @@ def delete_empty_docs(collection):
 
 
 def _delete_docs(collection, test, reason):
-    n_del = 0
-    # Traverse the collection backwards. Delete removable docs immediately.
-    for i in reversed(range(len(collection.subelements))):
-        if test(collection[i]):
-            del collection.subelements[i]
-            n_del += 1
+    # Traverse the collection backwards, then compact it in one go.
+    kept = [d for d in reversed(collection.subelements) if not test(d)]
+    kept.reverse()
+    n_del = len(collection.subelements) - len(kept)
+    collection.subelements[:] = kept
     if n_del:
         logging.warning('%s: deleted %d %s documents',
                         collection.id_, n_del, reason)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Run the merge step one document at a time.
+
+Equivalent to "oger run -s oger-settings-all.ini" in collection mode,
+but each document is loaded, annotated, postfiltered and handed to the
+exporters before the next one is read, so memory use does not grow with
+the size of the collection. Use the merge_stream postfilter instead of
+merge in the settings. All postfilters must be document-local.
+"""
+
+
+import os
+import sys
+import queue
+import logging
+import argparse
+import threading
+from pathlib import Path
+
+from oger.ctrl.router import Router, PipelineServer
+from oger.doc import EXPORTERS
+from oger.doc.brat import DualFormatter
+from oger.doc.document import Collection
+
+# streaming.py lives in the parent directory.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from streaming import StreamedCollection
+
+
+# Number of documents buffered per exporter.
+QUEUE_SIZE = 64
+
+
+def main():
+    '''
+    Run as script.
+    '''
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(
+        '-s', '--settings', nargs='+', required=True, metavar='PATH',
+        help='OGER settings files (as for "oger run")')
+    ap.add_argument(
+        '-q', '--queue-size', type=int, default=QUEUE_SIZE, metavar='N',
+        help='documents buffered per output format (default: %(default)s)')
+    args = ap.parse_args()
+    stream_merge(args.settings, args.queue_size)
+
+
+def stream_merge(settings, queue_size=QUEUE_SIZE):
+    """Process and export all collections document by document."""
+    conf = Router(settings=settings)
+    server = PipelineServer(conf, lazy=False)
+    for path, id_ in conf.iter_path_ID():
+        if id_ is None:
+            id_ = os.path.basename(path).split('.')[0]
+        logging.info('Streaming collection %s', id_)
+        docs = _iter_processed(server, path, id_)
+        _export(_get_exporters(conf), id_, docs, queue_size)
+    for postfilter in conf.postfilters:
+        close = getattr(postfilter, 'close', None)
+        if close is not None:
+            close()
+    logging.info('Finished processing.')
+
+
+def _iter_processed(server, path, coll_id):
+    for article in server.iter_load(path, server.conf.p.article_format):
+        coll = Collection(coll_id)
+        coll.add_article(article)
+        server.process(coll)
+        server.postfilter(coll)
+        for doc in coll:  # empty if the postfilters deleted the document
+            # Tokenise here, not concurrently in the exporter threads.
+            for sent in doc.get_subelements('sentence'):
+                sent.tokenize()
+            yield doc
+
+
+def _get_exporters(conf):
+    exporters = []
+    for fmt in conf.p.export_format:
+        exporter = EXPORTERS[fmt](conf, fmt)
+        if isinstance(exporter, DualFormatter):
+            # Text and annotations are written in separate passes.
+            exporters.extend((exporter.txt, exporter.ann))
+        else:
+            exporters.append(exporter)
+    return exporters
+
+
+def _export(exporters, coll_id, docs, queue_size):
+    """Feed the documents to all exporters in parallel."""
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in exporters]
+    threads = [threading.Thread(target=_run_exporter,
+                                args=(e, coll_id, q, errors))
+               for e, q in zip(exporters, queues)]
+    for t in threads:
+        t.start()
+    try:
+        for doc in docs:
+            for q in queues:
+                q.put(doc)
+            if errors:
+                break
+    finally:
+        for q in queues:
+            q.put(None)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+
+def _run_exporter(exporter, coll_id, docs, errors):
+    articles = iter(docs.get, None)
+    try:
+        exporter.export(StreamedCollection(coll_id, articles))
+    except Exception as e:
+        logging.exception('%s export failed', exporter.fmt_name)
+        errors.append(e)
+    for _ in articles:
+        pass  # keep the producer from blocking
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Run the weekly pipeline (steps 1-6 of run.sh) as a DAG of stages.
+
+Each stage declares the files it reads and writes. A stage is skipped
+if its outputs exist and neither its inputs (by content hash) nor its
+commands changed since its last successful run. Stages that don't
+depend on each other run concurrently (eg. the ten OGER runs, the
+BioBERT predictions and the harmonisations). Stages whose outputs are
+not needed for the requested targets are not run at all, eg. the PR
+ID predictions, which the spans-only strategy ignores.
+
+Targets are stage names or patterns (eg. "harmonise-*"); by default,
+the merged collection, the exports and the ledger update are built.
+The state (stage digests and cached file hashes) is kept in
+pipeline.state.json. Copying the results to the distribution servers
+(step 6 of run.sh) is not part of the pipeline.
+"""
+
+
+import os
+import sys
+import json
+import shutil
+import fnmatch
+import hashlib
+import logging
+import argparse
+import functools
+import threading
+import subprocess
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterable, List, Sequence
+
+from harmonise import required_predictions
+
+
+HOME = Path(__file__).parent
+STATE = HOME / 'pipeline.state.json'
+HASH_CHUNK_SIZE = 1 << 20
+
+VOCABULARIES = ('CHEBI', 'CL', 'GO_BP', 'GO_CC', 'GO_MF', 'MOP', 'NCBITaxon',
+                'PR', 'SO', 'UBERON')
+MERGE_STRATEGIES = dict(CHEBI='spans-first', CL='spans-first',
+                        GO_BP='spans-first', GO_CC='spans-first',
+                        GO_MF='spans-first', MOP='spans-first',
+                        NCBITaxon='ids-first', PR='spans-only',
+                        SO='spans-first', UBERON='spans-first')
+# Training steps of the BioBERT checkpoints (same for ids and spans).
+CHECKPOINTS = dict(CHEBI=52715, CL=52714, GO_BP=52715, GO_CC=52712,
+                   GO_MF=52710, MOP=52710, NCBITaxon=52710, PR=52720,
+                   SO=52714, UBERON=52717)
+
+Corpus = namedtuple('Corpus', 'kind ids suffix collection oger_config '
+                              'merge_settings sourcedb')
+# Outputs of the merge settings that would overwrite each other.
+MERGE_RENAMES = ((('json', 'bioc.json'),),
+                 (('json', 'pubannotation.json'),
+                  ('tgz', 'pubannotation.tgz')))
+CORPORA = {
+    'pubmed': Corpus(
+        kind='pmid', ids='data/ids/pmids.txt', suffix='',
+        collection='collection', oger_config='config/common.ini',
+        merge_settings=('oger-settings-all.ini',
+                        'oger-settings-pubannotation.ini'),
+        sourcedb='pubmed'),
+    'pmc': Corpus(
+        kind='pmcid', ids='data/ids/new_pmcids.txt', suffix='_pmc',
+        collection='collection_pmc', oger_config='config/common_pmc.ini',
+        merge_settings=('oger-pmc-settings.ini',
+                        'oger-pmc-settings-pubannotation.ini'),
+        sourcedb='PMC'),
+}
+
+
+def main():
+    '''
+    Run as script.
+    '''
+    ap = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    ap.add_argument(
+        'targets', nargs='*', metavar='STAGE',
+        help='stages to build, with their dependencies (default: all)')
+    ap.add_argument(
+        '-c', '--corpus', choices=CORPORA, default='pubmed',
+        help='document collection (default: %(default)s)')
+    ap.add_argument(
+        '--ods', type=Path, metavar='PATH',
+        help='PMID-PMCID spreadsheet (required for PMC)')
+    ap.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(), metavar='N',
+        help='maximum number of concurrent stages (default: %(default)s)')
+    ap.add_argument(
+        '-l', '--limit', nargs='+', type=_pool_limit, default=[],
+        metavar='POOL=N',
+        help='maximum number of concurrent stages of a kind '
+             '(oger, biobert, harmonise), eg. biobert=2')
+    ap.add_argument(
+        '-f', '--force', nargs='+', default=[], metavar='STAGE',
+        help='run these stages (names or patterns) even if up to date')
+    ap.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help='only show which stages would run')
+    ap.add_argument(
+        '--state', type=Path, default=STATE, metavar='PATH',
+        help='state file (default: %(default)s)')
+    args = ap.parse_args()
+    logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+    pipeline = Pipeline(build(args.corpus, args.ods), args.state)
+    if args.dry_run:
+        for name, status in pipeline.plan(args.targets, args.force):
+            print(f'{status:<10} {name}')
+    else:
+        pipeline.run(args.targets, args.jobs, dict(args.limit), args.force)
+
+
+def _pool_limit(arg):
+    pool, _, n = arg.partition('=')
+    try:
+        return pool, int(n)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid limit: {arg}')
+
+
+class Stage:
+    """
+    A pipeline step with declared inputs and outputs.
+
+    The steps are callables (usually functools.partial objects) that
+    are run in order. Inputs and outputs are paths relative to HOME;
+    directory inputs are fingerprinted by the names, sizes and
+    modification times of their files, not by content.
+    A final stage (eg. a database update) is a target even without
+    outputs.
+    """
+    def __init__(self, name: str, steps: Sequence[Callable],
+                 inputs: Iterable[str] = (), outputs: Iterable[str] = (),
+                 pool: str = None, final: bool = False):
+        self.name = name
+        self.steps = list(steps)
+        self.inputs = [HOME / p for p in inputs]
+        self.outputs = [HOME / p for p in outputs]
+        self.pool = pool
+        self.final = final
+
+    def key(self) -> str:
+        """A description of the steps, for detecting changed commands."""
+        return '\n'.join(map(_describe, self.steps))
+
+    def run(self):
+        for path in self.outputs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        for step in self.steps:
+            step()
+
+
+def _describe(step):
+    if isinstance(step, functools.partial):
+        args = [repr(a) for a in step.args]
+        args.extend(f'{k}={v!r}' for k, v in sorted(step.keywords.items()))
+        return '{}({})'.format(_describe(step.func), ', '.join(args))
+    return f'{step.__module__}.{step.__qualname__}'
+
+
+class Pipeline:
+    """
+    Stages connected through their input and output files.
+
+    Use run() to build targets, plan() for a dry run.
+    """
+    def __init__(self, stages: Sequence[Stage], state_path: Path = STATE):
+        self.stages = {}
+        self.producers = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f'duplicate stage: {stage.name}')
+            self.stages[stage.name] = stage
+            for path in stage.outputs:
+                if path in self.producers:
+                    raise ValueError(f'{path} is produced by both '
+                                     f'{self.producers[path]} and {stage.name}')
+                self.producers[path] = stage.name
+        self.upstream = {
+            name: {self.producers[p] for p in stage.inputs
+                   if p in self.producers}
+            for name, stage in self.stages.items()}
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        try:
+            with state_path.open(encoding='utf8') as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = dict(stages={}, files={})
+
+    def needed(self, targets: Sequence[str] = ()) -> List[str]:
+        """
+        The stages required for the targets, in topological order.
+
+        Stages that only produce outputs nobody consumes are omitted.
+        """
+        if targets:
+            todo = self._match(targets)
+        else:
+            todo = [n for n, s in self.stages.items() if s.final]
+        needed, order = set(), []
+
+        def visit(name, path=()):
+            if name in path:
+                raise ValueError('cyclic dependency: {}'.format(
+                    ' -> '.join(path + (name,))))
+            if name in needed:
+                return
+            for dep in sorted(self.upstream[name]):
+                visit(dep, path + (name,))
+            needed.add(name)
+            order.append(name)
+
+        for name in todo:
+            visit(name)
+        return order
+
+    def plan(self, targets: Sequence[str] = (), force: Sequence[str] = ()):
+        """
+        Predict the status of each needed stage, without running anything.
+
+        Stages are assumed to run if any upstream stage runs.
+        """
+        forced = set(self._match(force))
+        running = set()
+        for name in self.needed(targets):
+            stage = self.stages[name]
+            if name in forced or self.upstream[name] & running:
+                status = 'run'
+            elif any(not p.exists() for p in stage.inputs):
+                status = 'missing'  # input neither present nor produced
+            elif self._is_current(stage, self._digest(stage)):
+                status = 'current'
+            else:
+                status = 'run'
+            if status == 'run':
+                running.add(name)
+            yield name, status
+
+    def run(self, targets: Sequence[str] = (), jobs: int = 1,
+            limits: Dict[str, int] = None, force: Sequence[str] = ()):
+        """
+        Build the targets, running independent stages concurrently.
+
+        At most jobs stages run at the same time, and at most
+        limits[pool] stages of the same pool.
+        After a failure, the running stages are completed, but no new
+        stages are started.
+        """
+        limits = limits or {}
+        forced = set(self._match(force))
+        waiting = self.needed(targets)
+        done, active, errors = set(), {}, []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while waiting or active:
+                if not errors:
+                    for name in self._ready(waiting, done, active, limits):
+                        waiting.remove(name)
+                        future = executor.submit(self._execute, name,
+                                                 name in forced)
+                        active[future] = name
+                if not active:
+                    break
+                finished, _ = wait(active, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = active.pop(future)
+                    try:
+                        digest = future.result()
+                    except Exception as e:
+                        logging.error('Stage %s failed: %s', name, e)
+                        errors.append(e)
+                        continue
+                    done.add(name)
+                    with self._lock:
+                        self.state['stages'][name] = digest
+                    self._save()
+        if errors:
+            raise errors[0]
+        logging.info('Finished %d stages.', len(done))
+
+    def _ready(self, waiting, done, active, limits):
+        running = [self.stages[n].pool for n in active.values()]
+        for name in list(waiting):
+            stage = self.stages[name]
+            if not self.upstream[name] <= done:
+                continue
+            if running.count(stage.pool) >= limits.get(stage.pool, sys.maxsize):
+                continue
+            running.append(stage.pool)
+            yield name
+
+    def _execute(self, name, forced):
+        stage = self.stages[name]
+        missing = [str(p) for p in stage.inputs if not p.exists()]
+        if missing:
+            raise FileNotFoundError('missing input(s): ' + ', '.join(missing))
+        digest = self._digest(stage)
+        if not forced and self._is_current(stage, digest):
+            logging.info('Skipping %s (up to date)', name)
+            return digest
+        logging.info('Running %s', name)
+        with self._lock:
+            # Not current anymore, even if the stage fails.
+            self.state['stages'].pop(name, None)
+        self._save()
+        stage.run()
+        missing = [str(p) for p in stage.outputs if not p.exists()]
+        if missing:
+            raise FileNotFoundError('output(s) not created: '
+                                    + ', '.join(missing))
+        logging.info('Finished %s', name)
+        return digest
+
+    def _is_current(self, stage, digest):
+        return (self.state['stages'].get(stage.name) == digest
+                and all(p.exists() for p in stage.outputs))
+
+    def _digest(self, stage):
+        h = hashlib.sha1(stage.key().encode('utf8'))
+        for path in stage.inputs:
+            h.update('\n{}\t{}'.format(path, self._hash(path)).encode('utf8'))
+        return h.hexdigest()
+
+    def _hash(self, path):
+        if path.is_dir():
+            listing = sorted(
+                (str(p.relative_to(path)), p.stat().st_size,
+                 p.stat().st_mtime_ns)
+                for p in path.rglob('*') if p.is_file())
+            return hashlib.sha1(repr(listing).encode('utf8')).hexdigest()
+        stat = path.stat()
+        key = str(path)
+        with self._lock:
+            cached = self.state['files'].get(key)
+        if cached is not None and cached[:2] == [stat.st_size,
+                                                 stat.st_mtime_ns]:
+            return cached[2]
+        h = hashlib.sha1()
+        with path.open('rb') as f:
+            for chunk in iter(functools.partial(f.read, HASH_CHUNK_SIZE), b''):
+                h.update(chunk)
+        with self._lock:
+            self.state['files'][key] = [stat.st_size, stat.st_mtime_ns,
+                                        h.hexdigest()]
+        return h.hexdigest()
+
+    def _save(self):
+        tmp = self.state_path.with_name(self.state_path.name + '.part')
+        with self._lock:
+            with tmp.open('w', encoding='utf8') as f:
+                json.dump(self.state, f, indent=1)
+            os.replace(tmp, self.state_path)
+
+    def _match(self, patterns):
+        names = []
+        for pattern in patterns:
+            matches = fnmatch.filter(self.stages, pattern)
+            if not matches:
+                raise ValueError(f'no such stage: {pattern}')
+            names.extend(matches)
+        return names
+
+
+def build(corpus: str = 'pubmed', ods: Path = None,
+          vocabularies: Sequence[str] = VOCABULARIES) -> List[Stage]:
+    """Create the stages for the weekly update of a collection."""
+    c = CORPORA[corpus]
+    data = lambda name: f'data/{name}{c.suffix}'
+    python = sys.executable
+    stages = []
+
+    # 1: IDs (new and previously failed ones, according to the ledger).
+    # Once they exist, they are only updated with --force ids.
+    if corpus == 'pmc':
+        if ods is None:
+            raise ValueError('the PMC pipeline needs a PMID-PMCID spreadsheet')
+        ids_step = _call('covid', 'pmcods_to_txt', inpath=str(ods))
+        stages.append(Stage('ids', [ids_step], inputs=[ods],
+                            outputs=[c.ids]))
+    else:
+        ids_step = _call('covid', 'get_pmids', outpath=str(HOME/'data/ids'))
+        stages.append(Stage('ids', [ids_step], outputs=[c.ids]))
+
+    # 2: OGER, one run per vocabulary.
+    for v in vocabularies:
+        out_dir = HOME / data('oger') / v
+        stages.append(Stage(
+            f'oger-{v}',
+            [functools.partial(_rmtree, out_dir),
+             _command(['oger', 'run', '-s', c.oger_config, f'config/{v}.ini',
+                       '-o', str(out_dir)], cwd='oger'),
+             functools.partial(_keep_newest, out_dir, '*.conll')],
+            inputs=[c.ids, f'oger/{c.oger_config}', f'oger/config/{v}.ini',
+                    f'oger/vocab/{v}.tsv'],
+            outputs=[f'{data("oger")}/{v}.conll'],
+            pool='oger'))
+    base = f'{data("oger")}/{vocabularies[0]}.conll'
+    stages.append(Stage(
+        'ledger',
+        [_command([python, 'ledger.py', '-k', c.kind, 'record', c.ids, base])],
+        inputs=[c.ids, base], final=True))
+
+    # 3: BioBERT, preprocessing and one run per vocabulary and model type.
+    tf_record = f'{data("biobert")}.tf_record'
+    tokens = f'{data("biobert")}.tokens'
+    stages.append(Stage(
+        'biobert-preprocess',
+        [_command([python, 'biobert_predict.py', '--do_preprocess=true',
+                   f'--input_text={HOME/base}', f'--tf_record={HOME/tf_record}',
+                   '--vocab_file=common/vocab.txt'], cwd='biobert')],
+        inputs=[base, 'biobert/common/vocab.txt'],
+        outputs=[tf_record, tokens],
+        pool='biobert'))
+    for v in vocabularies:
+        for fmt in ('spans', 'ids'):
+            model = f'models/{v}-{fmt}'
+            out_dir = HOME / data('biobert') / f'{v}-{fmt}'
+            labels = Path(tf_record).with_suffix('.labels').name
+            stages.append(Stage(
+                f'biobert-{v}-{fmt}',
+                [functools.partial(_rmtree, out_dir),
+                 _command([python, 'biobert_predict.py', '--do_predict=true',
+                           f'--tf_record={HOME/tf_record}',
+                           '--bert_config_file=common/bert_config.json',
+                           f'--init_checkpoint={model}/model.ckpt-'
+                           f'{CHECKPOINTS[v]}',
+                           f'--data_dir={model}',
+                           f'--output_dir={out_dir}',
+                           f'--configuration={fmt}'], cwd='biobert'),
+                 functools.partial(_keep_newest, out_dir, labels)],
+                inputs=[tf_record, 'biobert/common/bert_config.json',
+                        f'biobert/{model}'],
+                outputs=[f'{data("biobert")}/{v}-{fmt}.labels'],
+                pool='biobert'))
+
+    # 4: Harmonisation, one run per vocabulary.
+    for v in vocabularies:
+        strategy = MERGE_STRATEGIES[v]
+        preds = {fmt: f'{data("biobert")}/{v}-{fmt}.labels'
+                 for fmt in required_predictions(strategy)}
+        argv = [python, 'harmonise.py', '-t', f'{data("harmonised")}/{v}.conll',
+                '-o', f'{data("oger")}/{v}.conll', '-b', tokens,
+                '-m', strategy]
+        if 'spans' in preds:
+            argv.extend(('-s', preds['spans']))
+        if 'ids' in preds:
+            argv.extend(('-i', preds['ids']))
+        stages.append(Stage(
+            f'harmonise-{v}', [_command(argv)],
+            inputs=[f'{data("oger")}/{v}.conll', tokens, *preds.values()],
+            outputs=[f'{data("harmonised")}/{v}.conll'],
+            pool='harmonise'))
+
+    # 5: Merging, with the settings for BioC/TSV and PubAnnotation.
+    merged = data('merged')
+    coll = f'oger/{c.collection}.conll'
+    postfilter = ['oger/oger-postfilter-all.py', 'oger/oger-postfilter-all.ini',
+                  'oger/covid19.tsv']
+    merge_steps = [functools.partial(
+        shutil.copyfile, HOME/data('harmonised')/f'{vocabularies[0]}.conll',
+        HOME/coll)]
+    for settings, renames in zip(c.merge_settings, MERGE_RENAMES):
+        merge_steps.append(_command(['oger', 'run', '-s', settings],
+                                    cwd='oger'))
+        for src, tgt in renames:
+            merge_steps.append(functools.partial(
+                os.replace, HOME/merged/f'{c.collection}.{src}',
+                HOME/merged/f'{c.collection}.{tgt}'))
+    merge_steps.append(functools.partial(os.remove, HOME/coll))
+    stages.append(Stage(
+        'merge', merge_steps,
+        inputs=[*(f'{data("harmonised")}/{v}.conll' for v in vocabularies),
+                *(f'oger/{s}' for s in c.merge_settings), *postfilter],
+        outputs=[f'{merged}/{c.collection}.{ext}'
+                 for ext in ('conll', 'tsv', 'bioc.json',
+                             'pubannotation.json')],
+        final=True))
+
+    # 6: Exports for distribution (brat, TXT and PubAnnotation archives).
+    writers = {'brat': str(HOME/merged/'brat'),
+               'txt': str(HOME/f'data/public/{c.collection}.txt.tgz')}
+    if corpus == 'pmc':
+        writers['pubanno_json'] = str(HOME/'data/pubannotation_pmc.tgz')
+    stages.append(Stage(
+        'export',
+        [_call('covid', 'export_collection', writers,
+               inpath=str(HOME/merged/f'{c.collection}.conll'),
+               sourcedb=c.sourcedb)],
+        inputs=[f'{merged}/{c.collection}.conll'],
+        outputs=[os.path.relpath(p, HOME) for p in writers.values()],
+        final=True))
+    return stages
+
+
+def _command(argv, cwd=None):
+    cwd = HOME if cwd is None else HOME / cwd
+    return functools.partial(subprocess.run, argv, cwd=str(cwd), check=True)
+
+
+def _call(module, name, *args, **kwargs):
+    return functools.partial(_call_function, module, name, *args, **kwargs)
+
+
+def _call_function(module, name, *args, **kwargs):
+    # Import lazily, eg. covid.py needs pandas.
+    func = getattr(__import__(module), name)
+    return func(*args, **kwargs)
+
+
+def _keep_newest(directory, pattern):
+    """Move the newest matching file out of directory and remove the rest."""
+    candidates = sorted(directory.glob(pattern),
+                        key=lambda p: p.stat().st_mtime)
+    if not candidates:
+        raise FileNotFoundError(f'no {pattern} file in {directory}')
+    newest = candidates[-1]
+    os.replace(newest, directory.with_name(directory.name + newest.suffix))
+    shutil.rmtree(directory)
+
+
+def _rmtree(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,19 @@
 
 home=$(pwd)
 
+# Timings, throughput and memory use of all stages are appended to
+# telemetry.jsonl (compare weekly runs with "python telemetry.py report").
+export TELEMETRY_PATH=$home/telemetry.jsonl
+export TELEMETRY_RUN=$(date +'%Y-%m-%d')
+
 # Script cannot be run as is, since some steps take quite long
 # Instead, copy & paste the individual steps as needed.
+# Steps 1-5 (and the local exports of step 6) can also be run with
+# pipeline.py, which skips up-to-date stages and runs independent ones
+# concurrently, eg.:
+# python pipeline.py -f ids -l biobert=2      (weekly update, new IDs)
+# python pipeline.py -c pmc --ods data/ids/PMID-PMCID_02092020.ods -f ids
+# python pipeline.py -n                       (show what would run)
 
 ###########################
 # 0: Setting up directories
@@ -23,12 +34,16 @@ mkdir data data/ids data/oger_pmc/ data/biobert_pmc/ data/harmonised_pmc/ data/h
 echo '1: Downloading PMIDs'
 python -c 'import covid; covid.get_pmids()'
 
-# differences (change date to last time you ran the pipeline)
-diff --new-line-format="" --unchanged-line-format="" data/ids/all_pmids.txt data.$CHANGEME/ids/all_pmids.txt > data/ids/pmids.txt
+# get_pmids() registers the PMIDs in the ID ledger (ids.sqlite) and writes
+# data/ids/pmids.txt with the new and previously failed ones.
+# To set up the ledger from an earlier run (change the date):
+# python ledger.py bad bad_pmids.txt
+# python ledger.py -k pmcid bad bad_pmcids.txt
+# python ledger.py record data.$CHANGEME/ids/all_pmids.txt data.$CHANGEME/oger/CHEBI.conll
+# python ledger.py -k pmcid record data.$CHANGEME/ids/pmcids.txt data.$CHANGEME/oger_pmc/CHEBI.conll
 
-# for PMC, use the pmcods_to_txt() from covid.py
-# place the pmcids.txt file from the last run's data/ids into the current data/ids
-# and rename it to old_pmcids.txt. Place the new .ods into the new data/ids, too
+# for PMC, use the pmcods_to_txt() from covid.py, which writes the new
+# PMCIDs to data/ids/new_pmcids.txt. Place the new .ods into the new data/ids
 python -c 'import covid; covid.pmcods_to_txt(inpath="data/ids/PMID-PMCID_02092020.ods")'
 
 
@@ -37,9 +52,9 @@ python -c 'import covid; covid.pmcods_to_txt(inpath="data/ids/PMID-PMCID_0209202
 #################
 cd $home/oger
 
-# During this step, OGER will produce errors for some IDs. These should be
-# noted manually in the bad_pmids.txt so that they will not be tried to DL
-# again.
+# During this step, OGER will produce errors for some IDs. These are
+# recorded in the ID ledger after the housekeeping below; IDs that fail
+# repeatedly are marked as bad and not tried to DL again.
 
 for value in CHEBI CL GO_BP GO_CC GO_MF MOP NCBITaxon PR SO UBERON
 do
@@ -75,6 +90,12 @@ cp $collection ../data/oger_pmc/$value.conll
 rm -r ../data/oger_pmc/$value
 done
 
+# record processed and failed IDs
+cd $home
+python ledger.py record data/ids/pmids.txt data/oger/CHEBI.conll
+python ledger.py -k pmcid record data/ids/new_pmcids.txt data/oger_pmc/CHEBI.conll
+cd $home/oger
+
 ####################
 # 3: RUNNING BIOBERT
 ####################
@@ -85,6 +106,7 @@ done
 
 cd $home/biobert
 echo '3.1: Preprocessing for BB'
+# add --preprocess_workers=N to preprocess in N parallel processes
 time python3 biobert_predict.py \
 --do_preprocess=true \
 --input_text=../data/oger/CHEBI.conll \
@@ -99,6 +121,10 @@ time python3 biobert_predict.py \
 
 # refer to the readme.md for more information
 # to restrict CPU usage, change variables in tf_threads.py
+# or, instead of the screens below, queue and run all predictions with
+# python3 scheduler.py -o ../data/biobert add -t ../data/biobert.tf_record
+# python3 scheduler.py -o ../data/biobert run --cores 32 -r server2=32
+# (the labels end up in ../data/biobert/$v-$s.labels, skip the housekeeping)
 
 cd $home
 for SERVER in 1 2 3 ...
@@ -160,6 +186,10 @@ echo '4: Harmonising' $v
 python harmonise.py -t data/harmonised_pmc/$v.conll -o data/oger_pmc/$v.conll -b data/biobert_pmc.tokens -i data/biobert_pmc/$v-ids.labels -s data/biobert_pmc/$v-spans.labels -m $k
 done
 
+# Alternatively, harmonise all vocabularies in a single pass over the tokens
+# (much faster on large corpora, since the .tokens file is read only once)
+python harmonise.py -t 'data/harmonised/{}.conll' -o 'data/oger/{}.conll' -b data/biobert.tokens -i 'data/biobert/{}-ids.labels' -s 'data/biobert/{}-spans.labels' -v $(for v k in ${(kv)vocabularies}; do echo $v=$k; done)
+
 #################################
 # 5: MERGING and COVID-ANNOTATION
 #################################
@@ -171,6 +201,15 @@ cp ../data/harmonised/CHEBI.conll collection.conll
 oger run -s oger-settings-all.ini
 mv ../data/merged/collection.json ../data/merged/collection.bioc.json
 
+# Alternatively, skip step 4 and harmonise while merging: set the postfilter
+# to harmonise_merge in oger-settings-all.ini and start from the plain text
+# (cd $home && python -c 'import covid; covid.get_naked_conll(inpath="data/oger/CHEBI.conll", outpath="oger/collection.conll")')
+# oger run -s oger-settings-all.ini
+
+# For bounded memory, set the postfilter to merge_stream in
+# oger-settings-all.ini and process one document at a time:
+# python stream_merge.py -s oger-settings-all.ini
+
 oger run -s oger-settings-pubannotation.ini
 mv ../data/merged/collection.json ../data/merged/collection.pubannotation.json
 mv ../data/merged/collection.tgz ../data/merged/collection.pubannotation.tgz
@@ -199,9 +238,24 @@ rm collection.conll collection_pmc.conll collection_pmc.bioc_json
 
 echo '6: Splitting, .tgz-ing and moving to DL directories'
 cd $home
+dl=/mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19
 
 # 6.0 backing up
 
+# 6.0 seeding the downloads which are appended to below
+
+# Only does something on the first run: the downloads are created from the
+# full TSV files and TXT directories (before this week's documents are
+# added). A .tgz made with "tar -czf" is rebuilt once in the appendable
+# layout.
+python -c 'import sys, covid; covid.seed_archive(*sys.argv[1:])' $dl/LitCovid/litcovid19.tsv.gz $dl/LitCovid/litcovid19.tsv
+python -c 'import sys, covid; covid.seed_archive(*sys.argv[1:])' $dl/LitCovid-PMC/covid19lit-pmc.tsv.gz $dl/LitCovid-PMC/covid19lit-pmc.tsv
+python -c 'import sys, covid; covid.seed_archive(*sys.argv[1:])' $dl/LitCovid/litcovid19.txt.tgz $dl/LitCovid/litcovid19.txt
+python -c 'import sys, covid; covid.seed_archive(*sys.argv[1:])' $dl/LitCovid-PMC/covid19lit-pmc.txt.tgz $dl/LitCovid-PMC/covid19lit-pmc.txt
+# The TSV downloads used to be .tsv.tgz archives (replaced by .tsv.gz,
+# see readme.md), remove them rather than leaving them stale.
+rm -f $dl/LitCovid/litcovid19.tsv.tgz $dl/LitCovid-PMC/covid19lit-pmc.tsv.tgz
+
 # 6.1 PUBANNOTATION / PUBMED
 
 # Possibly, update PA collection with data/ids/pmids.txt or pmcids.txt first
@@ -210,19 +264,21 @@ cp data/merged/collection.pubannotation.json data/collection.pubannotation.json
 
 # 6.1 PUBANNOTATION / PMC
 
-python -c 'import covid; covid.conll_collection_to_jsons(inpath="data/merged_pmc/collection_pmc.conll",outpath="data/pubannotation_pmc",sourcedb="PMC")'
-tar -czvf data/pubannotation_pmc.tgz data/pubannotation_pmc/
+# PubAnnotation JSON, brat, TXT and TSV files are written in one pass.
+# The TXT files are added to the public directory, and the TXT and TSV
+# downloads (6.4, 6.5) get a new segment with this week's documents.
+python -c 'import sys, covid; covid.export_collection({"pubanno_json": "data/pubannotation_pmc.tgz", "brat": "data/merged_pmc/brat", "txt": sys.argv[1:3], "tsv": sys.argv[3]}, inpath="data/merged_pmc/collection_pmc.conll", sourcedb="PMC", append=["txt", "tsv"])' $dl/LitCovid-PMC/covid19lit-pmc.txt $dl/LitCovid-PMC/covid19lit-pmc.txt.tgz $dl/LitCovid-PMC/covid19lit-pmc.tsv.gz
 
 # 6.2 BRAT / PUBMED
 
-# Creating Brat files and adding new files to directory
-python -c 'import covid; covid.bioc_to_brat()'
+# Creating Brat files and adding new files to directory (and to the TXT
+# directory and the TXT and TSV downloads, see 6.1)
+python -c 'import sys, covid; covid.export_collection({"brat": "data/merged/brat", "txt": sys.argv[1:3], "tsv": sys.argv[3]}, append=["txt", "tsv"])' $dl/LitCovid/litcovid19.txt $dl/LitCovid/litcovid19.txt.tgz $dl/LitCovid/litcovid19.tsv.gz
 cp -r /mnt/shared/apaches/transfer/brat/brat_ontogene/data/LitCovid /mnt/shared/apaches/transfer/brat/brat_ontogene/data/LitCovid.$(date +'%d%m%Y')
 cp data/merged/brat/* /mnt/shared/apaches/transfer/brat/brat_ontogene/data/LitCovid
 
 # 6.2 BRAT / PMC
 
-python -c 'import covid; covid.bioc_to_brat(inpath="data/merged_pmc/collection_pmc.bioc.json", outpath="data/merged_pmc/brat")'
 cp -r /mnt/shared/apaches/transfer/brat/brat_ontogene/data/LitCovidPMC /mnt/shared/apaches/transfer/brat/brat_ontogene/data/LitCovidPMC.$(date +'%d%m%Y')
 cp data/merged_pmc/brat/* /mnt/shared/apaches/transfer/brat/brat_ontogene/data/LitCovidPMC
 
@@ -243,26 +299,22 @@ tar -czvf /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/p
 # 6.4 File downloads : TSV / PubMed
 
 cp data/merged/collection.tsv data/public/litcovid19.tsv
-cat data/public/litcovid19.tsv >> /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid/litcovid19.tsv
-tar -czvf /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid/litcovid19.tsv.tgz /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid/litcovid19.tsv
+cat data/public/litcovid19.tsv >> $dl/LitCovid/litcovid19.tsv
+# litcovid19.tsv.gz is appended to in 6.2
 
 # 6.4 File downloads: TSV / PMC
 
 cp data/merged_pmc/collection_pmc.tsv data/public/covid19lit-pmc.tsv
-cat data/public/covid19lit-pmc.tsv >> /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid-PMC/covid19lit-pmc.tsv
-tar -czvf /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid-PMC/covid19lit-pmc.tsv.tgz /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid-PMC/covid19lit-pmc.tsv
+cat data/public/covid19lit-pmc.tsv >> $dl/LitCovid-PMC/covid19lit-pmc.tsv
+# covid19lit-pmc.tsv.gz is appended to in 6.1
 
 # 6.5 File downloads: TXT / PubMed
 
-python -c 'import covid; covid.conll_collection_to_txts()'
-cp data/public/txt/* /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid/litcovid19.txt
-tar -czvf /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid/litcovid19.txt.tgz /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid/litcovid19.txt
+# litcovid19.txt and litcovid19.txt.tgz are updated in 6.2
 
 # 6.5 File downloads: TXT / PMC
 
-python -c 'import covid; covid.conll_collection_to_txts(inpath="data/merged_pmc/collection_pmc.conll",outpath="data/public/txt")'
-cp data/public/txt/* /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid-PMC/covid19lit-pmc.txt
-tar -czvf /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid-PMC/covid19lit-pmc.txt.tgz /mnt/storage/clfiles/projects/clresources/pub.cl.uzh.ch/public/https/projects/COVID19/LitCovid-PMC/covid19lit-pmc.txt
+# covid19lit-pmc.txt and covid19lit-pmc.txt.tgz are updated in 6.1
 
 # Verify for EuroPMC
 python -c 'import covid; covid.get_naked_conll()'
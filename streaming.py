@@ -0,0 +1,33 @@
+# coding: utf8
+
+
+"""
+Helpers for streaming documents through OGER's exporters.
+
+Used by covid.py (the public exports) and oger/stream_merge.py.
+"""
+
+
+from oger.doc.document import Collection
+
+
+class StreamedCollection(Collection):
+    """
+    A collection whose articles are consumed while iterating.
+
+    Only a single pass over the articles is possible.
+    """
+    def __init__(self, id_, articles, basename=None):
+        super().__init__(id_, basename)
+        self._articles = articles
+
+    def __iter__(self):
+        return iter(self._articles)
+
+    def get_subelements(self, subelement_type, include_self=False):
+        if include_self and subelement_type in (Collection, 'collection'):
+            return iter([self])
+        return (elem
+                for article in self._articles
+                for elem in article.get_subelements(subelement_type,
+                                                    include_self=True))
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Record timings, memory use and throughput of the pipeline stages.
+
+Instrumented code measures a stage with
+
+    with telemetry.Stage('harmonise', vocabulary='CHEBI') as items:
+        ...
+        items['documents'] += 1
+
+which records wall and CPU time (including waited-for child processes),
+the peak RSS of the process, the items processed and the throughput.
+Recording is enabled with env variables, so it reaches all processes
+(OGER, BioBERT, the scripts) alike:
+
+    $ export TELEMETRY_PATH=telemetry.jsonl      # one JSON record per line
+    $ export TELEMETRY_PROMETHEUS=covid.prom     # optional textfile
+    $ export TELEMETRY_RUN=2020-09-07            # default: today's date
+
+The Prometheus textfile (for node_exporter's textfile collector) holds
+the latest record of every stage and vocabulary of the latest run.
+These records are also kept in a small state file (the JSON lines
+path plus ".latest"), so that adding a record does not need to read
+back the whole history.
+
+Subcommands:
+  report      compare two runs stage by stage
+  prometheus  write the textfile from the JSON lines
+"""
+
+
+import os
+import sys
+import json
+import time
+import fcntl
+import socket
+import argparse
+import datetime
+import resource
+from collections import Counter, OrderedDict
+
+
+PATH_ENV = 'TELEMETRY_PATH'
+PROMETHEUS_ENV = 'TELEMETRY_PROMETHEUS'
+RUN_ENV = 'TELEMETRY_RUN'
+PREFIX = 'covid_stage_'
+STATE_SUFFIX = '.latest'
+
+
+def main():
+    '''
+    Run as script.
+    '''
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawTextHelpFormatter)
+    ap.add_argument(
+        '-p', '--path', default=os.environ.get(PATH_ENV), metavar='PATH',
+        help='JSON lines file (default: $%s)' % PATH_ENV)
+    sub = ap.add_subparsers(dest='command')
+    sub.required = True
+    report = sub.add_parser('report', help='compare two runs')
+    report.add_argument(
+        'runs', nargs='*', metavar='RUN',
+        help='baseline and current run (default: the last two)')
+    prom = sub.add_parser('prometheus', help='write a Prometheus textfile')
+    prom.add_argument(
+        'target', nargs='?', default=os.environ.get(PROMETHEUS_ENV),
+        metavar='PATH', help='default: $%s' % PROMETHEUS_ENV)
+    args = ap.parse_args()
+
+    if args.path is None:
+        ap.error('no telemetry file given')
+    with open(args.path, encoding='utf8') as f:
+        records = [json.loads(line) for line in f]
+    if not records:
+        sys.exit('no telemetry records in {}'.format(args.path))
+    if args.command == 'report':
+        try:
+            print_report(records, *args.runs[-2:])
+        except ValueError as e:
+            sys.exit(str(e))
+    else:
+        if args.target is None:
+            ap.error('no textfile given')
+        write_prometheus(records, args.target)
+
+
+def enabled():
+    """Are stages recorded in this process?"""
+    return bool(os.environ.get(PATH_ENV))
+
+
+class Stage:
+    """
+    Measure a stage of the pipeline.
+
+    Use as a context manager (which yields a Counter for the items
+    processed), or call start() and stop() explicitly, eg. for a stage
+    spread over multiple calls. The record is written on stop, with
+    status "failed" if the stage ended with an exception.
+    """
+    def __init__(self, name, vocabulary=None):
+        self.name = name
+        self.vocabulary = vocabulary
+        self.items = Counter()
+        self._started = None
+
+    def __enter__(self):
+        self.start()
+        return self.items
+
+    def __exit__(self, exc_type, *_):
+        self.stop(failed=exc_type is not None)
+
+    def start(self):
+        self._started = datetime.datetime.now()
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_seconds()
+
+    def stop(self, failed=False):
+        if self._started is None or not enabled():
+            return
+        wall = time.perf_counter() - self._wall
+        record = OrderedDict(
+            run=os.environ.get(RUN_ENV) or datetime.date.today().isoformat(),
+            stage=self.name,
+            vocabulary=self.vocabulary,
+            status='failed' if failed else 'ok',
+            started=self._started.isoformat(timespec='seconds'),
+            host=socket.gethostname(),
+            pid=os.getpid(),
+            wall_seconds=round(wall, 3),
+            cpu_seconds=round(_cpu_seconds() - self._cpu, 3),
+            peak_rss_bytes=_peak_rss(),
+            items=dict(self.items),
+            per_second={kind: round(n/wall, 1) if wall else None
+                        for kind, n in self.items.items()},
+        )
+        self._started = None
+        _append(record)
+
+
+def _cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux.
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _append(record):
+    """Add a record, and update the state and the textfile (if any)."""
+    path = os.environ[PATH_ENV]
+    line = json.dumps(record) + '\n'
+    with open(path, 'a', encoding='utf8') as f:
+        # Concurrent stages (eg. BioBERT jobs) take turns.
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(line)
+        f.flush()
+        current = list(latest(_read_state(path) + [record]).values())
+        _write_atomically(path + STATE_SUFFIX, json.dumps(current))
+        textfile = os.environ.get(PROMETHEUS_ENV)
+        if textfile:
+            write_prometheus(current, textfile)
+
+
+def _read_state(path):
+    """The latest records of the latest run (as of the last append)."""
+    try:
+        with open(path + STATE_SUFFIX, encoding='utf8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def latest(records, run=None):
+    """The last record per stage and vocabulary of a run (default: last)."""
+    if run is None and records:
+        run = records[-1]['run']
+    by_stage = OrderedDict()
+    for record in records:
+        if record['run'] == run:
+            by_stage[record['stage'], record['vocabulary']] = record
+    return by_stage
+
+
+def write_prometheus(records, path):
+    """Write the latest run in the Prometheus text format (atomically)."""
+    gauges = OrderedDict([
+        ('wall_seconds', 'Wall-clock time of the stage.'),
+        ('cpu_seconds', 'CPU time of the process (and its children).'),
+        ('peak_rss_bytes', 'Peak resident set size of the process.'),
+        ('items', 'Items processed by the stage.'),
+        ('items_per_second', 'Throughput of the stage.'),
+        ('success', 'Whether the stage completed.'),
+        ('finished_timestamp_seconds', 'When the stage completed.'),
+    ])
+    samples = {name: [] for name in gauges}
+    for (stage, vocab), r in latest(records).items():
+        labels = [('stage', stage), ('vocabulary', vocab or ''),
+                  ('run', r['run'])]
+        started = datetime.datetime.strptime(r['started'],
+                                             '%Y-%m-%dT%H:%M:%S').timestamp()
+        for name in ('wall_seconds', 'cpu_seconds', 'peak_rss_bytes'):
+            samples[name].append((labels, r[name]))
+        for kind, n in r['items'].items():
+            samples['items'].append((labels + [('kind', kind)], n))
+            rate = r['per_second'][kind]
+            if rate is not None:
+                samples['items_per_second'].append(
+                    (labels + [('kind', kind)], rate))
+        samples['success'].append((labels, int(r['status'] == 'ok')))
+        samples['finished_timestamp_seconds'].append(
+            (labels, round(started + r['wall_seconds'])))
+    lines = []
+    for name, help_ in gauges.items():
+        lines.append('# HELP {0}{1} {2}\n# TYPE {0}{1} gauge\n'.format(
+            PREFIX, name, help_))
+        for labels, value in samples[name]:
+            lines.append('{}{}{{{}}} {}\n'.format(PREFIX, name, ','.join(
+                '{}="{}"'.format(k, _escape(v)) for k, v in labels), value))
+    _write_atomically(path, ''.join(lines))
+
+
+def _write_atomically(path, text):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w', encoding='utf8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"')
+
+
+def print_report(records, baseline=None, current=None):
+    """Print the wall time and throughput of two runs side by side."""
+    runs = list(OrderedDict.fromkeys(r['run'] for r in records))
+    if current is None:
+        current = runs[-1] if runs else None
+        if baseline is None and len(runs) > 1:
+            baseline = runs[-2]
+    before, after = latest(records, baseline), latest(records, current)
+    if not after:
+        raise ValueError('no telemetry records for run {}'.format(current))
+    print('{:<32} {:>10} {:>10} {:>7}  {}'.format(
+        'stage', baseline or '-', current, 'change', 'throughput'))
+    for key, r in after.items():
+        name = '/'.join(filter(None, key))
+        old = before.get(key)
+        change = ''
+        if old is not None and old['wall_seconds']:
+            change = '{:+.0%}'.format(r['wall_seconds']/old['wall_seconds']-1)
+        rates = ', '.join('{:.0f} {}/s'.format(n, kind)
+                          for kind, n in r['per_second'].items()
+                          if n is not None)
+        print('{:<32} {:>10} {:>10.1f} {:>7}  {}{}'.format(
+            name, '-' if old is None else '{:.1f}'.format(old['wall_seconds']),
+            r['wall_seconds'], change, rates,
+            '' if r['status'] == 'ok' else ' (failed)'))
+
+
+if __name__ == '__main__':
+    main()
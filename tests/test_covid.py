@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Export collections and append them to the downloads with covid.py.
+"""
+
+
+import os
+import sys
+import gzip
+import json
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+
+# covid.py lives in the parent directory.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import covid
+
+
+# Merged CoNLL collections of three weekly updates.
+WEEKS = [
+    '# doc_id = 1\n'
+    'ACE2\t0\t4\tS-CHEBI:1\nbinds\t5\t10\tO\n\n'
+    'spike\t11\t16\tB-GO_BP:2\nprotein\t17\t24\tE-GO_BP:2\n\n'
+    '# doc_id = 2\n'
+    'virus\t0\t5\tS-NCBITaxon:1\n\n',
+    '# doc_id = 3\n'
+    'hydroxychloroquine\t0\t18\tS-CHEBI:5801\ntreats\t19\t25\tO\n\n',
+    '# doc_id = 4\n'
+    'lung\t0\t4\tS-UBERON:2048\ncells\t5\t10\tS-CL:0000000\n\n'
+    '# doc_id = 5\n'
+    'mRNA\t0\t4\tS-CHEBI:33699\n\n',
+]
+
+# Fails to parse after the first document.
+BROKEN = '# doc_id = 6\nspike\t0\t5\tO\n\n# doc_id = 7\nbroken\tx\t5\tO\n\n'
+
+
+class AppendTest(unittest.TestCase):
+    """Appended downloads must equal a full export."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+        self.weeks = []
+        for i, text in enumerate(WEEKS + [BROKEN]):
+            path = self.dir / 'week{}.conll'.format(i)
+            path.write_text(text, encoding='utf8')
+            self.weeks.append(str(path))
+        self.broken = self.weeks.pop()
+
+    def test_tar_append(self):
+        txt, tgz = self._seed_txt()
+        for week in self.weeks[1:]:
+            covid.export_collection({'txt': [txt, tgz]}, week, append=['txt'])
+
+        # The archive is a single tar stream (no --ignore-zeros needed).
+        with tarfile.open(tgz) as tar:
+            members = {m.name: tar.extractfile(m).read().decode('utf8')
+                       for m in tar}
+        expected = {'lit.txt/{}.txt'.format(n): path.read_text('utf8')
+                    for n, path in self._files(txt)}
+        self.assertEqual(sorted(expected), ['lit.txt/{}.txt'.format(n)
+                                            for n in range(1, 6)])
+        self.assertEqual(members, expected)
+
+    def test_gz_append(self):
+        collection = self.dir / 'full.conll'
+        collection.write_text(''.join(WEEKS), encoding='utf8')
+        full = str(self.dir / 'full.tsv')
+        covid.export_collection({'tsv': full}, str(collection))
+        tsv = str(self.dir / 'lit.tsv')
+        covid.export_collection({'tsv': tsv}, self.weeks[0])
+        self.assertTrue(covid.seed_archive(tsv + '.gz', tsv))
+        for week in self.weeks[1:]:
+            covid.export_collection({'tsv': tsv + '.gz'}, week,
+                                    append=['tsv'])
+
+        with gzip.open(tsv + '.gz', 'rt', encoding='utf8') as f:
+            appended = f.read()
+        self.assertEqual(appended, Path(full).read_text('utf8'))
+
+    def test_seed_rebuild(self):
+        txt = str(self.dir / 'lit.txt')
+        covid.export_collection({'txt': txt}, self.weeks[0])
+        tgz = txt + '.tgz'
+        # Like "tar -czf lit.txt.tgz /full/path/lit.txt".
+        with tarfile.open(tgz, 'w:gz') as tar:
+            tar.add(txt, arcname=txt.lstrip('/'))
+        with self.assertRaisesRegex(ValueError, 'seed_archive'):
+            covid.export_collection({'txt': tgz}, self.weeks[1],
+                                    append=['txt'])
+
+        self.assertTrue(covid.seed_archive(tgz, txt))
+        with tarfile.open(tgz) as tar:
+            self.assertEqual(sorted(tar.getnames()),
+                             ['lit.txt/1.txt', 'lit.txt/2.txt'])
+        data = Path(tgz).read_bytes()
+        self.assertFalse(covid.seed_archive(tgz, txt))
+        self.assertEqual(Path(tgz).read_bytes(), data)
+
+    def test_failed_export(self):
+        txt, tgz = self._seed_txt()
+        tsv = str(self.dir / 'lit.tsv')
+        covid.export_collection({'tsv': tsv}, self.weeks[0])
+        covid.seed_archive(tsv + '.gz', tsv)
+        before = {p.name: p.read_bytes() for p in self.dir.iterdir()
+                  if p.is_file()}
+
+        with self.assertRaises(ValueError):
+            covid.export_collection({'txt': tgz, 'tsv': tsv + '.gz'},
+                                    self.broken, append=['txt', 'tsv'])
+        after = {p.name: p.read_bytes() for p in self.dir.iterdir()
+                 if p.is_file()}
+        self.assertEqual(after, before)
+
+    def _seed_txt(self):
+        txt = str(self.dir / 'lit.txt')
+        covid.export_collection({'txt': txt}, self.weeks[0])
+        tgz = txt + '.tgz'
+        self.assertTrue(covid.seed_archive(tgz, txt))
+        return txt, tgz
+
+    @staticmethod
+    def _files(directory):
+        for name in os.listdir(directory):
+            yield int(name.split('.')[0]), Path(directory, name)
+
+
+class ExportTest(unittest.TestCase):
+    """Exports follow OGER's formats."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+    def test_pubanno_json(self):
+        collection = self.dir / 'week0.conll'
+        collection.write_text(WEEKS[0], encoding='utf8')
+        outpath = self.dir / 'pubannotation'
+        covid.export_collection({'pubanno_json': str(outpath)},
+                                str(collection), sourcedb='PMC')
+
+        formatter = covid.EXPORTERS['pubanno_json'](
+            covid.Router(pubanno_meta={'sourcedb': 'PMC'}), 'pubanno_json')
+        documents = covid._conll_server().iter_load(str(collection), 'conll')
+        for document in documents:
+            exported = (outpath / (document.id_ + '.json')).read_text('utf8')
+            self.assertNotIn('\n', exported)  # not indented
+            self.assertEqual(json.loads(exported),
+                             json.loads(formatter.dump(document)))
+            self.assertEqual(json.loads(exported)['sourcedb'], 'PMC')
+
+
+if __name__ == '__main__':
+    unittest.main()
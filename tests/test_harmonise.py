@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Compare the Python and NumPy engines of harmonise.py.
+"""
+
+
+import os
+import sys
+import csv
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# harmonise.py and benchmark.py live in the parent directory.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import harmonise
+import benchmark
+import offsets
+
+
+DNA = 'ACGT' * 16  # longer than 50 chars, truncated by biobert_predict.py
+
+# OGER rows (token, feature) per sentence, per document.
+OGER = {
+    '1001': [
+        [('ACE2', 'B-CHEBI:7;CHEBI:3'), ('binds', 'O'), ('\x07', 'O'),
+         ('spike', 'B-PR:5'), ('☃', 'O'), ('protein', 'I-PR:5'),
+         ('.', 'O')],
+        [(DNA, 'O'), ('from', 'O'), ('SARS', 'B-NCBITaxon:2697049'),
+         ('\x7f', 'B-PR:1'), ('CoV', 'I-NCBITaxon:2697049')],
+    ],
+    '1002': [
+        [('hydroxychloroquine', 'B-CHEBI:5801'), ('\ufffd', 'O'),
+         ('treats', 'O'), ('COVID', 'B-MONDO:100096'),
+         ('-', 'I-MONDO:100096'), ('19', 'E-MONDO:100096'),
+         ('patients', 'O')],
+    ],
+}
+
+# BioBERT output lines (token, span label, ID label).
+# The last lines of the second document are truncated into one line.
+BERT = [
+    ('[CLS]', '[CLS]', '[CLS]'),
+    ('ACE', 'B', 'B-CHEBI:3'),
+    ('##2', 'X', 'X'),
+    ('binds', 'O', 'I-GO:0005488'),
+    ('spike', 'B', 'O-NIL'),
+    ('[UNK]', 'I', 'O-NIL'),
+    ('protein', 'I', 'I-PR:9'),
+    ('.', 'E', 'O-NIL'),
+    ('[SEP]', '[SEP]', '[SEP]'),
+    ('[CLS]', '[CLS]', '[CLS]'),
+    ('ACGT', 'O', 'B-CHEBI:16991'),
+    *(('##' + DNA[i:i+4], 'X', 'X') for i in range(4, 50, 4)),
+    ('from', 'O', 'O-NIL'),
+    ('SARS', 'S', 'B-NCBITaxon:2697049'),
+    ('Co', 'B', 'O-NIL'),
+    ('##V', 'X', 'X'),
+    ('[SEP]', '[SEP]', '[SEP]'),
+    ('[CLS]', '[CLS]', '[CLS]'),
+    ('hydro', 'B', 'O-NIL'),
+    ('##xy', 'X', 'X'),
+    ('##chloro', 'X', 'X'),
+    ('##quine', 'X', 'X'),
+    ('treats', 'O', 'O-NIL'),
+    ('COVID', 'B', 'B-MONDO:100096'),
+    ('- 19 patients', 'I', 'I-MONDO:100096'),
+    ('[SEP]', '[SEP]', '[SEP]'),
+]
+
+
+class EngineTest(unittest.TestCase):
+    """The engines must produce byte-identical output."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+    def test_fixture(self):
+        paths = self._write_fixture()
+        for strategy in harmonise.STRATEGIES:
+            with self.subTest(strategy=strategy):
+                python, numpy = self._harmonise(paths, strategy)
+                self.assertEqual(python, numpy)
+                self.assertEqual(python.count(b'\n'), 24)
+
+    def test_synthetic(self):
+        for binary in (False, True):
+            directory = self.dir / ('binary' if binary else 'text')
+            directory.mkdir()
+            paths = benchmark.generate(directory, 30, binary=binary)
+            for strategy in harmonise.STRATEGIES:
+                with self.subTest(strategy=strategy, binary=binary):
+                    python, numpy = self._harmonise(paths, strategy)
+                    self.assertEqual(python, numpy)
+
+    def _harmonise(self, paths, strategy):
+        outputs = []
+        for engine in harmonise.ENGINES:
+            path = paths['oger'].with_name(f'{strategy}.{engine}.conll')
+            harmonise.harmonise(
+                path, paths['oger'], paths['tokens'],
+                span_pred=paths['spans'], id_pred=paths['ids'],
+                merge_strategy=strategy, engine=engine)
+            outputs.append(path.read_bytes())
+        return outputs
+
+    def _write_fixture(self):
+        paths = dict(
+            oger=self.dir / 'oger.conll',
+            tokens=self.dir / 'biobert.tokens',
+            spans=self.dir / 'spans.labels',
+            ids=self.dir / 'ids.labels',
+        )
+        with paths['oger'].open('w', encoding='utf8') as f:
+            writer = csv.writer(f, **harmonise.TSV_FORMAT)
+            for docid, sentences in OGER.items():
+                writer.writerow([f'# doc_id = {docid}'])
+                offset = 0
+                for sentence in sentences:
+                    for tok, feat in sentence:
+                        writer.writerow((tok, offset, offset+len(tok), feat))
+                        offset += len(tok) + 1
+                    writer.writerow(())
+        for i, name in enumerate(('tokens', 'spans', 'ids')):
+            with paths[name].open('w', encoding='utf8') as f:
+                f.writelines(f'{line[i]}\n' for line in BERT)
+        return paths
+
+
+class IndexTest(unittest.TestCase):
+    """Offset indices are rebuilt when stale, and split at unique IDs."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+    def test_rebuild(self):
+        path = self.dir / 'oger.conll'
+        self._write_conll(path, ['a', 'b'])
+        self.assertEqual([d.docid for d in offsets.doc_index(path)],
+                         ['a', 'b'])
+        # An up-to-date index is loaded, not rebuilt.
+        with mock.patch.object(offsets, '_scan_docs',
+                               side_effect=AssertionError):
+            self.assertEqual(len(offsets.doc_index(path)), 2)
+
+        self._write_conll(path, ['a', 'b', 'c'])
+        self.assertEqual([d.docid for d in offsets.doc_index(path)],
+                         ['a', 'b', 'c'])
+        # Same size, but a later modification time.
+        mtime = path.stat().st_mtime_ns
+        self._write_conll(path, ['x', 'y', 'z'])
+        os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+        self.assertEqual([d.docid for d in offsets.doc_index(path)],
+                         ['x', 'y', 'z'])
+
+        tokens = self.dir / 'biobert.tokens'
+        tokens.write_text('[CLS]\na\n[SEP]\n', encoding='utf8')
+        self.assertEqual(offsets.sentence_index(tokens), [(0, 0), (3, 14)])
+        with tokens.open('a', encoding='utf8') as f:
+            f.write('[CLS]\nb\n[SEP]\n')
+        self.assertEqual(offsets.sentence_index(tokens),
+                         [(0, 0), (3, 14), (6, 28)])
+
+    def test_split_duplicate(self):
+        path = self.dir / 'oger.conll'
+        docids = ['1', '2', '3', '2', '4', '5']
+        self._write_conll(path, docids)
+        for n in range(1, len(docids) + 2):
+            with self.subTest(n=n):
+                shards = offsets.split_docs(path, n)
+                self.assertLessEqual(len(shards), n)
+                # The shards resolve to contiguous index positions.
+                positions = [offsets.doc_positions(path, start, stop)
+                             for start, stop in shards]
+                self.assertEqual(positions[0][0], 0)
+                self.assertEqual(positions[-1][1], len(docids))
+                for (_, j), (i, _) in zip(positions, positions[1:]):
+                    self.assertEqual(i, j)
+
+    @staticmethod
+    def _write_conll(path, docids):
+        with path.open('w', encoding='utf8') as f:
+            for docid in docids:
+                f.write(f'# doc_id = {docid}\nword\t0\t4\tO\n\n')
+
+
+class ResumeTest(unittest.TestCase):
+    """A resumed run must produce the same output as a complete one."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+        self.paths = benchmark.generate(self.dir, 12)
+
+    def test_resume(self):
+        for engine in harmonise.ENGINES:
+            with self.subTest(engine=engine):
+                complete = self.dir / f'complete.{engine}.conll'
+                self._harmonise(complete, engine)
+                resumed = self.dir / f'resumed.{engine}.conll'
+                with self.assertRaises(RuntimeError):
+                    self._interrupt(resumed, engine, after=7)
+                self._harmonise(resumed, engine, resume=True)
+                self.assertEqual(resumed.read_bytes(),
+                                 complete.read_bytes())
+                self.assertFalse(harmonise.Checkpoint([resumed]).path.exists())
+
+    def _interrupt(self, path, engine, after):
+        """
+        Fail after some documents, as if killed after the last periodic
+        checkpoint, with part of a document written after it.
+        """
+        iter_merged = harmonise._iter_merged
+        saved = []
+
+        def failing(*args, **kwargs):
+            for n, doc in enumerate(iter_merged(*args, **kwargs)):
+                if n == after:
+                    raise RuntimeError('interrupted')
+                yield doc
+
+        def save(checkpoint, *state):
+            saved.append(state)
+            save_checkpoint(checkpoint, *state)
+
+        save_checkpoint = harmonise.Checkpoint.save
+        with mock.patch.object(harmonise, 'CHECKPOINT_INTERVAL', 3), \
+                mock.patch.object(harmonise, '_iter_merged', failing), \
+                mock.patch.object(harmonise.Checkpoint, 'save', save):
+            try:
+                self._harmonise(path, engine)
+            finally:
+                checkpoint = harmonise.Checkpoint([path])
+                position, docid, sizes = saved[-2]  # after 6 documents
+                self.assertEqual(position, 6)
+                self.assertLess(sizes[0], path.stat().st_size)
+                save_checkpoint(checkpoint, position, docid, sizes)
+                with path.open('a', encoding='utf8') as f:
+                    f.write('# doc_id = partial\nword\t0')
+
+    def _harmonise(self, path, engine, resume=False):
+        harmonise.harmonise(
+            path, self.paths['oger'], self.paths['tokens'],
+            span_pred=self.paths['spans'], id_pred=self.paths['ids'],
+            engine=engine, resume=resume)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+"""
+Run the BioBERT job scheduler on the local machine with a stub script.
+"""
+
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# scheduler.py lives in the biobert directory.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'biobert'))
+import scheduler
+
+
+# Writes its output like biobert_predict.py (with or without
+# --binary_labels=true). The first attempt of every job fails.
+STUB = '''\
+import os
+import sys
+from pathlib import Path
+
+flags = dict(arg[2:].split('=', 1) for arg in sys.argv[1:])
+attempted = Path(flags['output_dir']).with_suffix('.attempted')
+if not attempted.exists():
+    attempted.touch()
+    sys.exit(1)
+base = Path(flags['output_dir'], Path(flags['tf_record']).name)
+if flags.get('binary_labels') == 'true':
+    suffixes = ('.labels.npy', '.labels.vocab', '.labels.lengths.npy')
+else:
+    suffixes = ('.labels',)
+for suffix in suffixes:
+    with base.with_suffix(suffix).open('w') as f:
+        f.write(' '.join([flags['configuration'],
+                          Path(flags['init_checkpoint']).name,
+                          os.environ['TF_INTRA_OP_THREADS']]))
+'''
+
+
+class SchedulerTest(unittest.TestCase):
+    """Queue and run jobs, including a retry after a failure."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+    def test_run(self):
+        output_dir = self._run()
+        self.assertEqual(
+            sorted(p.name for p in output_dir.glob('*.labels*')),
+            ['CHEBI-ids.labels', 'CHEBI-spans.labels', 'CL-ids.labels'])
+        self.assertEqual((output_dir / 'CHEBI-spans.labels').read_text(),
+                         'spans model.ckpt-120 1')
+
+    def test_binary_labels(self):
+        moved = []
+        replace = os.replace
+
+        def record(src, dest):
+            moved.append(Path(dest).name)
+            replace(src, dest)
+
+        with mock.patch.object(scheduler.os, 'replace', record):
+            output_dir = self._run('--binary_labels=true')
+        suffixes = ('.labels.npy', '.labels.vocab', '.labels.lengths.npy')
+        self.assertEqual(
+            sorted(p.name for p in output_dir.glob('*.labels*')),
+            sorted(job + suffix
+                   for job in ('CHEBI-ids', 'CHEBI-spans', 'CL-ids')
+                   for suffix in suffixes))
+        # The .labels.npy file (opened by harmonise.py) is moved last.
+        moved = [name for name in moved if '.labels' in name]
+        for job in ('CHEBI-ids', 'CHEBI-spans', 'CL-ids'):
+            names = [name for name in moved if name.startswith(job + '.')]
+            self.assertEqual(len(names), 3)
+            self.assertEqual(names[-1], job + '.labels.npy')
+
+    def _run(self, *extra):
+        script = self.dir / 'stub_predict.py'
+        script.write_text(STUB)
+        models = self.dir / 'models'
+        for name in ('CHEBI-ids', 'CHEBI-spans', 'CL-ids'):
+            for step in (5, 120, 40):
+                path = models / name / 'model.ckpt-{}.index'.format(step)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.touch()
+        output_dir = self.dir / 'labels'
+        output_dir.mkdir()
+        # Dots in the input name must not end up in the output names.
+        tf_record = self.dir / 'pubmed.2020-09.tf_record'
+
+        queue = scheduler.JobQueue(output_dir / scheduler.QUEUE_NAME)
+        jobs = scheduler.prediction_jobs(
+            tf_record, output_dir, ['CHEBI', 'CL'], models=models,
+            extra=list(extra), exclude=['CL-spans'])
+        self.assertEqual(queue.add(jobs), 3)
+        ok = scheduler.run_jobs(
+            queue, [scheduler.LocalExecutor(2)], threads=1, attempts=2,
+            script=script)
+
+        self.assertTrue(ok)
+        self.assertEqual(
+            [(job['name'], job['state'], job['attempts'])
+             for job in queue.jobs()],
+            [('CHEBI-ids', 'done', 1), ('CHEBI-spans', 'done', 1),
+             ('CL-ids', 'done', 1)])
+        self.assertFalse(list(output_dir.glob('.*.tmp')))
+        return output_dir
+
+
+if __name__ == '__main__':
+    unittest.main()